@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks of the CPU-only parts of the library: building command
+frames, checksumming them, decoding state frames and timers, and the
+colour helpers.  No network is involved; commands are "sent" to a socket
+that throws the bytes away.
+
+For every case the script reports calls per second (best of --repeat
+timeit runs) and the memory one call allocates:
+
+* peak_bytes: the most memory held at once during a call, as seen by
+  tracemalloc; a rough measure of how much a call allocates
+* retained_bytes: memory still held per call after many calls, which
+  should be 0 for everything here
+
+    python benchmarks/codec.py
+    python benchmarks/codec.py --json > codec.json
+    python benchmarks/codec.py --filter LedTimer
+
+The flux_led package should live in the folder above this script.
+"""
+
+from __future__ import print_function
+import gc
+import json
+import os
+import platform
+import sys
+import timeit
+import tracemalloc
+from optparse import OptionParser
+
+this_folder = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(this_folder))
+from flux_led import WifiLedBulb, LedTimer, codec, utils
+from flux_led.simulator import (VirtualBulb, DEVICE_RGB, DEVICE_RGBW,
+                                DEVICE_RGBWW, DEVICE_ORIGINAL)
+
+CAPABILITIES = {
+    DEVICE_RGB: {'protocol': None, 'rgbwcapable': False,
+                 'rgbwprotocol': False, 'use_csum': True, 'query_len': 14},
+    DEVICE_RGBW: {'protocol': None, 'rgbwcapable': True,
+                  'rgbwprotocol': True, 'use_csum': True, 'query_len': 14},
+    DEVICE_RGBWW: {'protocol': 'LEDENET', 'rgbwcapable': True,
+                   'rgbwprotocol': False, 'use_csum': True, 'query_len': 14},
+    DEVICE_ORIGINAL: {'protocol': 'LEDENET_ORIGINAL', 'rgbwcapable': False,
+                      'rgbwprotocol': False, 'use_csum': False,
+                      'query_len': 11},
+}
+
+
+class NullSocket():
+    """Accepts and drops everything sent to it."""
+
+    def send(self, data):
+        return len(data)
+
+    def sendmsg(self, buffers):
+        return len(buffers[0]) + len(buffers[1])
+
+    def sendall(self, data):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+def offline_bulb(device_type):
+    """A WifiLedBulb for device_type that never touches the network."""
+    bulb = WifiLedBulb('127.0.0.1', lazy=True,
+                       capabilities=CAPABILITIES[device_type])
+    bulb._socket = NullSocket()
+    bulb._connected = True
+    bulb._initialized = True
+    bulb._process_state_response(VirtualBulb('', device_type).state_frame())
+    return bulb
+
+
+def cases():
+    """Return a list of (name, callable) to benchmark."""
+    rgbw = offline_bulb(DEVICE_RGBW)
+    rgb = offline_bulb(DEVICE_RGB)
+    ledenet = offline_bulb(DEVICE_RGBWW)
+    original = offline_bulb(DEVICE_ORIGINAL)
+
+    rgbw_state = VirtualBulb('', DEVICE_RGBW).state_frame()
+    ledenet_state = VirtualBulb('', DEVICE_RGBWW).state_frame()
+    original_state = VirtualBulb('', DEVICE_ORIGINAL).state_frame()
+
+    color_body = bytes(rgbw._rgbw_view(10, 20, 30, persist=False))
+
+    timer = LedTimer()
+    timer.setActive(True)
+    timer.setRepeatMask(LedTimer.Weekdays)
+    timer.setTime(17, 30)
+    timer.setModeColor(255, 0, 0)
+    timer_bytes = timer.toBytes()
+    timers = [timer] * 6
+    timer_reply = VirtualBulb('', DEVICE_RGBW).timers_frame()
+
+    return [
+        ('_rgbw_view rgbw', lambda: rgbw._rgbw_view(10, 20, 30, persist=False)),
+        ('_rgbw_view rgb', lambda: rgb._rgbw_view(10, 20, 30, persist=False)),
+        ('_rgbw_view ledenet', lambda: ledenet._rgbw_view(w=10, w2=20)),
+        ('_rgbw_view original', lambda: original._rgbw_view(10, 20, 30)),
+        ('_rgbw_view brightness',
+         lambda: rgbw._rgbw_view(10, 20, 30, brightness=128)),
+        ('codec.rgbw', lambda: codec.rgbw(10, 20, 30, None, None, False,
+                                          None, True)),
+        ('codec.send', lambda: codec.send(rgbw._socket, color_body)),
+        ('_send_msg checksum', lambda: rgbw._send_msg(color_body)),
+        ('setRgbw', lambda: rgbw.setRgbw(10, 20, 30, persist=False)),
+        ('setRgb', lambda: rgbw.setRgb(10, 20, 30, persist=False)),
+        ('turnOn', lambda: rgbw.turnOn()),
+        ('_process_state_response rgbw',
+         lambda: rgbw._process_state_response(rgbw_state)),
+        ('_process_state_response ledenet',
+         lambda: ledenet._process_state_response(ledenet_state)),
+        ('_process_state_response original',
+         lambda: original._process_state_response(original_state)),
+        ('brightness', lambda: rgbw.brightness),
+        ('getRgbww', lambda: ledenet.getRgbww()),
+        ('_determineMode color', lambda: rgbw._determineMode(0, 0x61)),
+        ('_determineMode preset', lambda: rgbw._determineMode(0, 0x30)),
+        ('LedTimer.fromBytes', lambda: LedTimer().fromBytes(timer_bytes)),
+        ('LedTimer.toBytes', lambda: timer.toBytes()),
+        ('_timers_msg', lambda: rgbw._timers_msg(timers)),
+        ('_parse_timers', lambda: rgbw._parse_timers(timer_reply)),
+        ('color_object_to_tuple tuple',
+         lambda: utils.color_object_to_tuple((10, 20, 30))),
+        ('color_object_to_tuple name',
+         lambda: utils.color_object_to_tuple('red')),
+        ('color_object_to_tuple hex',
+         lambda: utils.color_object_to_tuple('#ff8000')),
+        ('color_object_to_tuple string tuple',
+         lambda: utils.color_object_to_tuple('(10, 20, 30)')),
+        ('_calculateBrightness',
+         lambda: rgbw._calculateBrightness((10, 20, 30), 128)),
+    ]
+
+
+def calls_per_second(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return number / best
+
+
+def memory_per_call(fn, calls=1000):
+    """Return (peak bytes during one call, bytes retained per call)."""
+    fn()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes = max(peak - before, 0)
+
+        gc.collect()
+        start, _ = tracemalloc.get_traced_memory()
+        for i in range(calls):
+            fn()
+        gc.collect()
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak_bytes, max(end - start, 0) / calls
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--filter", dest="filter", default=None,
+                      help="Only run cases whose name contains this")
+    parser.add_option("--repeat", dest="repeat", type="int", default=5,
+                      help="timeit runs per case, the best is reported")
+    parser.add_option("--json", dest="json", action="store_true",
+                      default=False, help="Print the results as JSON")
+    (options, args) = parser.parse_args()
+
+    results = []
+    for name, fn in cases():
+        if options.filter and options.filter not in name:
+            continue
+        peak_bytes, retained_bytes = memory_per_call(fn)
+        results.append({
+            'name': name,
+            'per_second': round(calls_per_second(fn, options.repeat)),
+            'peak_bytes': peak_bytes,
+            'retained_bytes': round(retained_bytes, 1),
+        })
+
+    if options.json:
+        print(json.dumps({
+            'benchmark': 'codec',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }, indent=2, sort_keys=True))
+        return
+
+    width = max([len(r['name']) for r in results] + [4])
+    print("{:<{w}} {:>12} {:>11} {:>15}".format(
+        "case", "calls/s", "peak bytes", "retained bytes", w=width))
+    for r in results:
+        print("{:<{w}} {:>12,} {:>11} {:>15}".format(
+            r['name'], r['per_second'], r['peak_bytes'], r['retained_bytes'],
+            w=width))
+
+
+if __name__ == '__main__':
+    main()
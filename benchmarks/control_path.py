@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+"""
+End-to-end benchmarks of the WifiLedBulb control path.
+
+WifiLedBulb is run against bulbs from flux_led.simulator, so no hardware is
+needed.  For each number of bulbs the script reports, as JSON:
+
+* connect: the TCP connect alone
+* probe: the first update_state(), which probes the protocol and queries
+  the state
+* update_state, setRgb, turnOn and getTimers: total commands per second,
+  commands per second per bulb and p50/p95/p99 latency
+
+Save a run and compare it with another after changing the library:
+
+    python benchmarks/control_path.py --sizes 1,10,100,1000 > before.json
+
+The simulator runs in this process and competes with the client for the
+GIL, so the absolute numbers are pessimistic; they are meant for comparing
+runs on the same machine.  --latency, --jitter and --loss add simulated
+network faults.
+
+With --reactor the bulbs are flux_led.reactor.ReactorBulbs driven by a
+single reactor thread; every command for every bulb is submitted at once,
+so latencies include the time spent queued behind earlier commands.
+
+The flux_led package should live in the folder above this script.
+"""
+
+from __future__ import print_function
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from optparse import OptionParser
+
+this_folder = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(this_folder))
+from flux_led import WifiLedBulb
+from flux_led.reactor import Reactor, ReactorBulb
+from flux_led.simulator import (BulbSimulator, FaultProfile, DEVICE_RGB,
+                                DEVICE_RGBW, DEVICE_RGBWW, DEVICE_ORIGINAL)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+DEVICE_TYPES = {'rgb': DEVICE_RGB, 'rgbw': DEVICE_RGBW,
+                'rgbww': DEVICE_RGBWW, 'original': DEVICE_ORIGINAL}
+
+OPERATIONS = [
+    ('update_state', lambda bulb, i: bulb.update_state()),
+    ('setRgb', lambda bulb, i: bulb.setRgb(i & 0xff, 0x80, 255 - (i & 0xff),
+                                           persist=False)),
+    ('turnOn', lambda bulb, i: bulb.turnOn()),
+    ('getTimers', lambda bulb, i: bulb.getTimers()),
+]
+
+
+def raise_file_limit():
+    # every simulated bulb needs a listening socket, and a connection on
+    # each side, so large runs go past the usual limit of 1024
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(latencies, errors, seconds, bulb_count):
+    ordered = sorted(latencies)
+    count = len(ordered)
+
+    def ms(value):
+        if value is None:
+            return None
+        return round(value * 1000, 3)
+
+    per_second = count / seconds if seconds > 0 else None
+    return {
+        'count': count,
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'per_second': round(per_second, 1) if per_second else None,
+        'per_bulb_per_second':
+            round(per_second / bulb_count, 2) if per_second else None,
+        'p50_ms': ms(percentile(ordered, 0.50)),
+        'p95_ms': ms(percentile(ordered, 0.95)),
+        'p99_ms': ms(percentile(ordered, 0.99)),
+        'max_ms': ms(ordered[-1] if ordered else None),
+    }
+
+
+def timed(fn, *args):
+    """Run fn and return (seconds taken, True if it raised)."""
+    start = time.perf_counter()
+    try:
+        fn(*args)
+        failed = False
+    except Exception:
+        failed = True
+    return time.perf_counter() - start, failed
+
+
+def run_on_all(executor, bulbs, work):
+    """Run work(bulb) for every bulb; returns (latencies, errors, seconds)."""
+    start = time.perf_counter()
+    results = list(executor.map(work, bulbs))
+    seconds = time.perf_counter() - start
+    latencies = []
+    errors = 0
+    for bulb_latencies, bulb_errors in results:
+        latencies.extend(bulb_latencies)
+        errors += bulb_errors
+    return latencies, errors, seconds
+
+
+def run_on_reactor(bulbs, work, count=1):
+    """Submit count rounds of work(bulb, i), which returns a future.
+
+    Returns (latencies, errors, seconds).
+    """
+    latencies = []
+    errors = [0]
+
+    def track(future, started):
+        def done(future):
+            latencies.append(time.perf_counter() - started)
+            if future.cancelled() or future.exception() is not None:
+                errors[0] += 1
+        future.add_done_callback(done)
+        return future
+
+    start = time.perf_counter()
+    futures = [track(work(bulb, i), time.perf_counter())
+               for i in range(count) for bulb in bulbs]
+    wait(futures)
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def run_size_on_reactor(size, sim, options):
+    result = {'bulbs': size}
+    with Reactor() as reactor:
+        bulbs = [ReactorBulb(virtual.ipaddr, virtual.port,
+                             timeout=options.timeout, reactor=reactor)
+                 for virtual in sim.bulbs]
+        result['connect'] = summarize(
+            *run_on_reactor(bulbs, lambda bulb, i: bulb.connect()),
+            bulb_count=size)
+        latencies, errors, seconds = run_on_reactor(
+            bulbs, lambda bulb, i: bulb.update_state())
+        errors = sum(bulb.capabilities is None for bulb in bulbs)
+        result['probe'] = summarize(latencies, errors, seconds,
+                                    bulb_count=size)
+        for name, operation in OPERATIONS:
+            result[name] = summarize(
+                *run_on_reactor(bulbs, operation, options.count),
+                bulb_count=size)
+    return result
+
+
+def run_size(size, options):
+    faults = None
+    if options.latency or options.jitter or options.loss:
+        faults = FaultProfile(options.latency, options.jitter, options.loss,
+                              seed=options.seed)
+
+    if options.reactor:
+        with BulbSimulator() as sim:
+            sim.add_bulbs(size, DEVICE_TYPES[options.device_type],
+                          faults=faults)
+            return run_size_on_reactor(size, sim, options)
+
+    result = {'bulbs': size}
+    with BulbSimulator() as sim:
+        sim.add_bulbs(size, DEVICE_TYPES[options.device_type], faults=faults)
+        bulbs = [WifiLedBulb(virtual.ipaddr, virtual.port,
+                             timeout=options.timeout,
+                             persistent=options.persistent, lazy=True)
+                 for virtual in sim.bulbs]
+
+        executor = ThreadPoolExecutor(max_workers=min(options.threads, size))
+        try:
+            def connect(bulb):
+                seconds, failed = timed(bulb.connect)
+                return [seconds], int(failed)
+            result['connect'] = summarize(*run_on_all(executor, bulbs, connect),
+                                          bulb_count=size)
+
+            def probe(bulb):
+                seconds, failed = timed(bulb.update_state)
+                return [seconds], int(failed or bulb.capabilities is None)
+            result['probe'] = summarize(*run_on_all(executor, bulbs, probe),
+                                        bulb_count=size)
+
+            for name, operation in OPERATIONS:
+                def work(bulb):
+                    latencies = []
+                    errors = 0
+                    for i in range(options.count):
+                        seconds, failed = timed(operation, bulb, i)
+                        latencies.append(seconds)
+                        errors += failed
+                    return latencies, errors
+                result[name] = summarize(*run_on_all(executor, bulbs, work),
+                                         bulb_count=size)
+        finally:
+            executor.shutdown()
+            for bulb in bulbs:
+                bulb.close()
+    return result
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--sizes", dest="sizes", default="1,10,100,1000",
+                      help="Comma-separated numbers of bulbs to run with")
+    parser.add_option("-n", "--count", dest="count", type="int", default=20,
+                      help="Commands of each kind to send to every bulb")
+    parser.add_option("--threads", dest="threads", type="int", default=64,
+                      help="Most bulbs to drive at the same time")
+    parser.add_option("--type", dest="device_type", default="rgbw",
+                      help="Device type: rgb, rgbw, rgbww or original")
+    parser.add_option("--persistent", dest="persistent", action="store_true",
+                      default=False, help="Keep one connection open per bulb")
+    parser.add_option("--reactor", dest="reactor", action="store_true",
+                      default=False,
+                      help="Drive the bulbs from one reactor thread")
+    parser.add_option("--timeout", dest="timeout", type="float", default=5,
+                      help="Bulb socket timeout in seconds")
+    parser.add_option("--latency", dest="latency", type="float", default=0,
+                      help="Simulated seconds of delay before every reply")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0,
+                      help="Up to this many extra seconds of simulated delay")
+    parser.add_option("--loss", dest="loss", type="float", default=0,
+                      help="Probability of a simulated lost frame")
+    parser.add_option("--seed", dest="seed", type="int", default=None,
+                      help="Seed for the simulated faults")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Write the JSON here instead of to stdout")
+    (options, args) = parser.parse_args()
+
+    if options.device_type not in DEVICE_TYPES:
+        parser.error("unknown device type: {}".format(options.device_type))
+    try:
+        sizes = [int(size) for size in options.sizes.split(',')]
+    except ValueError:
+        parser.error("--sizes must be a comma-separated list of numbers")
+
+    raise_file_limit()
+    report = {
+        'benchmark': 'control_path',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {
+            'count': options.count,
+            'threads': options.threads,
+            'type': options.device_type,
+            'persistent': options.persistent,
+            'reactor': options.reactor,
+            'timeout': options.timeout,
+            'latency': options.latency,
+            'jitter': options.jitter,
+            'loss': options.loss,
+            'seed': options.seed,
+        },
+        'results': [],
+    }
+    for size in sizes:
+        print("running with {} bulb(s)".format(size), file=sys.stderr)
+        # the library prints some errors, keep them out of the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            report['results'].append(run_size(size, options))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,18 +17,13 @@ this_folder = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(this_folder)
 from flux_led import WifiLedBulb, BulbScanner, LedTimer
 
-def crossFade(bulb, color1, color2):
+def crossFade(bulb, color1, color2, fade_time=2):
 
-	r1,g1,b1 = color1
-	r2,g2,b2 = color2
-	
-	steps = 100
-	for i in range(1,steps+1):
-		r = r1 - int(i * float(r1 - r2)/steps)
-		g = g1 - int(i * float(g1 - g2)/steps)
-		b = b1 - int(i * float(b1 - b2)/steps)
-		# (use non-persistent mode to help preserve flash)
-		bulb.setRgb(r,g,b, persist=False)
+	# transition() paces the frames itself and uses non-persistent writes
+	# to help preserve flash, so the fade takes fade_time seconds however
+	# fast the network is.
+	bulb.transition(color2, duration=fade_time, easing="ease_in_out",
+					start=color1)
 
 def main():
 
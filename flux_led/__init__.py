@@ -1,4 +1,10 @@
 """Init file for Flux LED"""
-from .__main__ import PresetPattern, LedTimer, WifiLedBulb, BulbScanner, utils
+from .__main__ import (PresetPattern, LedTimer, WifiLedBulb, BulbGroup,
+                       BulbMetrics, BulbResult, BulbScanner, BulbState,
+                       CapabilityCache, DiscoveryService, RetryPolicy,
+                       Transition, utils)
 
-__all__ = ['PresetPattern', 'LedTimer', 'WifiLedBulb', 'BulbScanner', 'utils']
+__all__ = ['PresetPattern', 'LedTimer', 'WifiLedBulb', 'BulbGroup',
+           'BulbMetrics', 'BulbResult', 'BulbScanner', 'BulbState',
+           'CapabilityCache', 'DiscoveryService', 'RetryPolicy',
+           'Transition', 'utils']
@@ -39,13 +39,30 @@ package is installed.  (Easily done via pip, easy_install, or apt-get, etc.)
 
 from __future__ import print_function
 import socket
+import errno
 import time
 import sys
 import datetime
 import colorsys
+import math
 from optparse import OptionParser,OptionGroup
 import ast
+import collections
+import functools
+import ipaddress
+import json
+import logging
+import os
+import random
 import threading
+import weakref
+import concurrent.futures
+
+try:
+    from . import codec
+except ImportError:
+    # run as a script rather than as part of the package
+    import codec
 
 try:
     import webcolors
@@ -53,6 +70,8 @@ try:
 except:
     webcolors_available = False
 
+_LOGGER = logging.getLogger(__name__)
+
 class utils:
     @staticmethod
     def color_object_to_tuple(color):
@@ -496,27 +515,195 @@ class LedTimer():
 
         return txt
 
-class WifiLedBulb():
-    def __init__(self, ipaddr, port=5577, timeout=5):
+# Length of the replies a bulb sends, keyed by their header byte.  Clock,
+# timer and acknowledgement replies all start with 0x0f, so they can't be
+# told apart here and are read by the length the caller expects.
+FRAME_LENGTHS = {
+    0x81: 14,   # state
+    0x66: 11,   # state, original LEDENET protocol
+}
+
+
+class BulbState(collections.namedtuple('BulbState', [
+        'is_on', 'mode', 'pattern', 'speed', 'rgb', 'rgbw', 'rgbww',
+        'warm_white', 'cold_white', 'brightness'])):
+    """The state of a bulb, decoded once from a state frame.
+
+    WifiLedBulb.update_state() sets the bulb's state attribute to one of
+    these, and the bulb's properties (brightness, getRgb() and so on) just
+    return its fields.  It is a tuple, so it can't be changed, and two
+    states are equal when all their fields are.
+
+    is_on is None if the frame had an unknown power byte.  rgb, rgbw and
+    rgbww are the colour levels in colour mode and all 255 in other modes,
+    as getRgb() and friends have always returned.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def decode(cls, rx, mode, protocol=None):
+        """Decode a state frame; mode is what _determineMode() made of it."""
+        power_state = rx[2]
+        if power_state == 0x23:
+            is_on = True
+        elif power_state == 0x24:
+            is_on = False
+        else:
+            is_on = None
+        if mode == "color":
+            # the original protocol's frame ends after warm white
+            white2 = rx[11] if len(rx) > 12 else 0
+            rgb = (rx[6], rx[7], rx[8])
+            rgbw = rgb + (rx[9],)
+            rgbww = rgbw + (white2,)
+        else:
+            rgb = (255, 255, 255)
+            rgbw = (255, 255, 255, 255)
+            rgbww = (255, 255, 255, 255, 255)
+        if protocol == 'LEDENET':
+            warm_white, cold_white = rx[9], rx[11]
+        else:
+            warm_white = cold_white = 0
+        if mode == "ww":
+            brightness = int(rx[9])
+        else:
+            # the HSV value, as colorsys.rgb_to_hsv() would give it
+            brightness = max(rgb)
+        return cls(is_on, mode, rx[3], utils.delayToSpeed(rx[5]), rgb, rgbw,
+                   rgbww, warm_white, cold_white, brightness)
+
+    def diff(self, previous):
+        """Return {field: (old, new)} for the fields changed since previous.
+
+        previous may be None, in which case every field is returned.
+        """
+        if previous is None:
+            return dict((name, (None, value))
+                        for name, value in zip(self._fields, self))
+        return dict((name, (old, new))
+                    for name, old, new in zip(self._fields, previous, self)
+                    if old != new)
+
+
+class RetryPolicy():
+    """How a bulb tries a failed operation again.
+
+    retries is the number of tries after the first.  Before each retry the
+    bulb waits, starting with backoff seconds and multiplying the wait by
+    factor every time, up to max_backoff.  jitter (0-1) is the part of each
+    wait that is random, so bulbs that failed together don't all try again
+    at the same moment.
+
+    deadline, if given, is the time in seconds an operation may take in
+    all: no retry is made that would start after it.  A try that is
+    already under way can still take up to the bulb's timeout.
+
+    The retry argument of the bulb's methods overrides retries for a single
+    call; the policy is used for everything else.
+    """
+
+    def __init__(self, retries=2, backoff=0.05, factor=2.0, max_backoff=1.0,
+                 jitter=0.5, deadline=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def delay(self, retry_number):
+        """Seconds to wait before retry number retry_number (from 0)."""
+        delay = min(self.backoff * self.factor ** retry_number,
+                    self.max_backoff)
+        return delay * (1.0 - self.jitter * random.random())
+
+    def start(self, retries=None, deadline=None):
+        """Track one operation; retries=None means the policy's own.
+
+        deadline is an absolute time.monotonic() value, for an operation
+        that is part of another one and shares its deadline.
+        """
+        return _Attempts(self, retries, deadline)
+
+
+class _Attempts():
+    """The retries left to one operation under a RetryPolicy."""
+
+    def __init__(self, policy, retries, deadline):
+        self.policy = policy
+        self.retries_left = policy.retries if retries is None else retries
+        self.count = 0
+        if deadline is None and policy.deadline is not None:
+            deadline = time.monotonic() + policy.deadline
+        self.deadline = deadline
+
+    def next_delay(self):
+        """Use up a retry; returns the seconds to wait first, or None if
+        the operation should give up instead."""
+        if self.retries_left < 1:
+            return None
+        delay = self.policy.delay(self.count)
+        if (self.deadline is not None and
+                time.monotonic() + delay >= self.deadline):
+            return None
+        self.retries_left -= 1
+        self.count += 1
+        return delay
+
+
+class _BulbProtocol():
+    """The state of a bulb, and the messages of its protocol.
+
+    Shared by WifiLedBulb and the bulbs of flux_led.aio and flux_led.reactor,
+    which only differ in how the messages are sent; nothing here does any
+    I/O.
+    """
+
+    # TCP keepalive settings used for persistent connections (seconds)
+    keepalive_idle = 10
+    keepalive_interval = 5
+    keepalive_count = 3
+
+    def __init__(self, ipaddr, port, timeout, observer, retry_policy):
         self.ipaddr = ipaddr
         self.port = port
         self.timeout = timeout
+        self.observer = observer
+        self.retry_policy = retry_policy or RetryPolicy()
 
         self.protocol = None
         self.rgbwcapable = False
         self.rgbwprotocol = False
 
         self.raw_state = None
+        self.state = None
         self._is_on = False
         self._mode = None
-        self._socket = None
-        self._lock = threading.Lock()
         self._query_len = 0
         self._use_csum = True
 
-        self.connect(2)
-        self.update_state()
+    @property
+    def capabilities(self):
+        """What the protocol probe found out about the device.
 
+        None until the bulb has answered a state query.
+        """
+        if self._query_len == 0:
+            return None
+        return {
+            'protocol': self.protocol,
+            'rgbwcapable': self.rgbwcapable,
+            'rgbwprotocol': self.rgbwprotocol,
+            'use_csum': self._use_csum,
+            'query_len': self._query_len,
+        }
+
+    def _apply_capabilities(self, capabilities):
+        self.protocol = capabilities['protocol']
+        self.rgbwcapable = capabilities['rgbwcapable']
+        self.rgbwprotocol = capabilities['rgbwprotocol']
+        self._use_csum = capabilities['use_csum']
+        self._query_len = capabilities['query_len']
 
     @property
     def is_on(self):
@@ -528,17 +715,15 @@ class WifiLedBulb():
 
     @property
     def warm_white(self):
-        if self.protocol == 'LEDENET':
-            return self.raw_state[9]
-        else:
+        if self.state is None:
             return 0
+        return self.state.warm_white
 
     @property
     def cold_white(self):
-        if self.protocol == 'LEDENET':
-            return self.raw_state[11]
-        else:
+        if self.state is None:
             return 0
+        return self.state.cold_white
 
     @property
     def brightness(self):
@@ -547,30 +732,32 @@ class WifiLedBulb():
         For warm white return current led level. For RGB
         calculate the HSV and return the 'value'.
         """
-        if self.mode == "ww":
-            return int(self.raw_state[9])
-        else:
-            _, _, v = colorsys.rgb_to_hsv(*self.getRgb())
-            return v
-
-    def connect(self, retry=0):
-        self.close()
-        try:
-            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self._socket.settimeout(self.timeout)
-            self._socket.connect((self.ipaddr, self.port))
-        except socket.error:
-            if retry < 1:
-                return
-            self.connect(max(retry-1, 0))
-
-    def close(self):
-        if self._socket is None:
+        return self.state.brightness
+
+    def _set_keepalive(self, sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # the finer grained options are not available on every platform
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                            self.keepalive_idle)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                            self.keepalive_interval)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                            self.keepalive_count)
+
+    def _emit(self, event, **info):
+        # callers check self.observer first, so nothing is built for it
+        # unless someone is listening
+        observer = self.observer
+        if observer is None:
             return
+        info['ipaddr'] = self.ipaddr
         try:
-            self._socket.close()
-        except socket.error:
-            pass
+            observer(event, info)
+        except Exception:
+            _LOGGER.exception("Error in bulb observer")
 
     def _determineMode(self, ww_level, pattern_code):
         mode = "unknown"
@@ -591,65 +778,20 @@ class WifiLedBulb():
             mode = BuiltInTimer.valtostr(pattern_code)
         return mode
 
- 
-    def _determine_query_len(self, retry = 2):
-
-        # determine the type of protocol based of first 2 bytes.
-        self._send_msg(bytearray([0x81, 0x8a, 0x8b]))
-        rx = self._read_msg(2)
-        # if any response is recieved, use the default protocol
-        if len(rx) == 2:
-            self._query_len = 14
-            return
-        # if no response from default received, next try the original protocol
-        self._send_msg(bytearray([0xef, 0x01, 0x77]))
-        rx = self._read_msg(2)
-        if rx[1] == 0x01:
-            self.protocol = 'LEDENET_ORIGINAL'
-            self._use_csum = False
-            self._query_len = 11
-            return
-        else:
-            self._use_csum = True
-        if rx == None and retry > 0:
-            self._determine_query_len(max(retry -1,0))
-        
- 
-    def query_state(self, retry=2, led_type = None):
-        if self._query_len == 0:
-            self._determine_query_len()
-            
+    def _query_msg(self, led_type=None):
         # default value
         msg = bytearray([0x81, 0x8a, 0x8b])
         # alternative for original protocol
         if self.protocol == 'LEDENET_ORIGINAL' or led_type == 'LEDENET_ORIGINAL':
             msg =  bytearray([0xef, 0x01, 0x77])
-            led_type = 'LEDENET_ORIGINAL'
-
-        try:
-            self.connect()
-            self._send_msg(msg)
-            rx = self._read_msg(self._query_len)
-        except socket.error:
-            if retry < 1:
-                self._is_on = False
-                return
-            self.connect()
-            return self.query_state(max(retry-1, 0), led_type)
-        if rx is None or len(rx) < self._query_len:
-            if retry < 1:
-                self._is_on = False
-                return rx
-            return self.query_state(max(retry-1, 0), led_type)
-        return rx
+        return msg
 
+    def _process_state_response(self, rx):
+        """Apply a state frame to this bulb.
 
-    def update_state(self, retry=2 ):
-        rx = self.query_state(retry)
-        if rx is None or len(rx) < self._query_len:
-            self._is_on = False
-            return
-      
+        Returns False if the mode in the frame could not be determined, in
+        which case the current state is left untouched.
+        """
         # typical response:
         #pos  0  1  2  3  4  5  6  7  8  9 10
         #    66 01 24 39 21 0a ff 00 00 01 99
@@ -687,11 +829,51 @@ class WifiLedBulb():
         #     msg head
         #
 
+        detected = self._state_capabilities(rx)
+        if detected['rgbwprotocol']:
+            self.rgbwprotocol = True
+        if detected['rgbwcapable']:
+            self.rgbwcapable = True
+        if detected['protocol'] is not None:
+            self.protocol = detected['protocol']
+        if not detected['use_csum']:
+            self._use_csum = False
+
+        pattern = rx[3]
+        ww_level = rx[9]
+        mode = self._determineMode(ww_level, pattern)
+        if mode == "unknown":
+            return False
+        power_state = rx[2]
+
+        if power_state == 0x23:
+            self._is_on = True
+        elif power_state == 0x24:
+            self._is_on = False
+        state = BulbState.decode(rx, mode, self.protocol)
+        if self.observer is not None and state != self.state:
+            self._emit("state_changed", changes=state.diff(self.state))
+        self.raw_state = rx
+        self.state = state
+        self._mode = mode
+        return True
+
+    @staticmethod
+    def _state_capabilities(rx):
+        """Work out the device capabilities from the type byte of a state frame."""
+        capabilities = {
+            'protocol': None,
+            'rgbwcapable': False,
+            'rgbwprotocol': False,
+            'use_csum': True,
+            'query_len': len(rx),
+        }
+
         # Devices that don't require a separate rgb/w bit
         if (rx[1] == 0x04 or
             rx[1] == 0x33 or
             rx[1] == 0x81):
-            self.rgbwprotocol = True
+            capabilities['rgbwprotocol'] = True
 
         # Devices that actually support rgbw
         if (rx[1] == 0x04 or
@@ -699,63 +881,44 @@ class WifiLedBulb():
             rx[1] == 0x33 or
             rx[1] == 0x81 or
             rx[1] == 0x44):
-            self.rgbwcapable = True
+            capabilities['rgbwcapable'] = True
 
         # Devices that use an 8-byte protocol
         if (rx[1] == 0x25 or
             rx[1] == 0x27 or
             rx[1] == 0x35):
-            self.protocol = "LEDENET"
+            capabilities['protocol'] = "LEDENET"
 
         # Devices that use the original LEDENET protocol
         if rx[1] == 0x01:
-            self.protocol = "LEDENET_ORIGINAL"
-            self._use_csum = False
-
-        pattern = rx[3]
-        ww_level = rx[9]
-        mode = self._determineMode(ww_level, pattern)
-        if mode == "unknown":
-            if retry < 1:
-                return
-            self.update_state(max(retry-1, 0))
-            return
-        power_state = rx[2]
+            capabilities['protocol'] = "LEDENET_ORIGINAL"
+            capabilities['use_csum'] = False
 
-        if power_state == 0x23:
-            self._is_on = True
-        elif power_state == 0x24:
-            self._is_on = False
-        self.raw_state = rx
-        self._mode = mode
+        return capabilities
 
     def __str__(self):
         rx = self.raw_state
-        mode = self.mode
+        state = self.state
+        mode = state.mode
 
-        pattern = rx[3]
-        ww_level = rx[9]
-        power_state = rx[2]
+        pattern = state.pattern
         power_str = "Unknown power state"
 
-        if power_state == 0x23:
+        if state.is_on is True:
             power_str = "ON "
-        elif power_state == 0x24:
+        elif state.is_on is False:
             power_str = "OFF "
 
-        delay = rx[5]
-        speed = utils.delayToSpeed(delay)
+        speed = state.speed
         if mode == "color":
-            red = rx[6]
-            green = rx[7]
-            blue = rx[8]
-            mode_str = "Color: {}".format((red, green, blue))
+            mode_str = "Color: {}".format(state.rgb)
             if self.rgbwcapable:
-                mode_str += " White: {}".format(rx[9])
+                mode_str += " White: {}".format(state.rgbw[3])
             else:
-                mode_str += " Brightness: {}".format(self.brightness)
+                mode_str += " Brightness: {}".format(state.brightness)
         elif mode == "ww":
-            mode_str = "Warm White: {}%".format(utils.byteToPercent(ww_level))
+            mode_str = "Warm White: {}%".format(
+                utils.byteToPercent(state.brightness))
         elif mode == "preset":
             pat = PresetPattern.valtostr(pattern)
             mode_str = "Pattern: {} (Speed {}%)".format(pat, speed)
@@ -772,39 +935,8 @@ class WifiLedBulb():
           mode_str += str(_r) + ","
         return "{} [{}]".format(power_str, mode_str)
 
-
-    def _change_state(self, retry, turn_on = True):
-
-        if self.protocol == 'LEDENET_ORIGINAL':
-            msg_on =  bytearray([0xcc, 0x23, 0x33])
-            msg_off =  bytearray([0xcc, 0x24, 0x33])
-        else:
-            msg_on = bytearray([0x71, 0x23, 0x0f])
-            msg_off = bytearray([0x71, 0x24, 0x0f])
-
-        if turn_on:
-            msg = msg_on
-        else:
-            msg = msg_off
-
-        try:
-            self._send_msg(msg)
-        except socket.error:
-            if retry > 0:
-                self.connect()
-                self._change_state(max(retry-1, 0), turn_on)
-                return
-            self._is_on = False
-
-
-    def turnOn(self, retry=2):
-        self._is_on = True
-        self._change_state(retry, turn_on = True)
-
-    def turnOff(self, retry=2):
-        self._is_on = False
-        self._change_state(retry, turn_on = False)
-
+    def _power_msg(self, turn_on=True):
+        return codec.power(turn_on, self.protocol)
 
     def isOn(self):
         return self.is_on
@@ -814,20 +946,8 @@ class WifiLedBulb():
             return 255
         return self.brightness
 
-    def setWarmWhite(self, level, persist=True, retry=2):
-        self.setWarmWhite255(utils.percentToByte(level), persist, retry)
-
-    def setWarmWhite255(self, level, persist=True, retry=2):
-        self.setRgbw(w=level, persist=persist, brightness=None, retry=retry)
-
-    def setColdWhite(self, level, persist=True, retry=2):
-        self.setColdWhite255(utils.percentToByte(level), persist, retry)
-
-    def setColdWhite255(self, level, persist=True, retry=2):
-        self.setRgbw(persist=persist, brightness=None, retry=retry, w2=level)
-
-    def setWhiteTemperature(self, temperature, brightness, persist=True,
-                            retry=2):
+    @staticmethod
+    def _white_levels(temperature, brightness):
         # Assume output temperature of between 2700 and 6500 Kelvin, and scale
         # the warm and cold LEDs linearly to provide that
         temperature = max(temperature-2700, 0)
@@ -835,34 +955,26 @@ class WifiLedBulb():
         cold = min(255 * temperature/3800, 255)
         warm *= brightness/255
         cold *= brightness/255
-        self.setRgbw(w=warm, w2=cold, persist=persist, retry=retry)
+        return warm, cold
 
     def getRgbw(self):
-        if self.mode != "color":
-            return (255, 255, 255, 255)
-        red = self.raw_state[6]
-        green = self.raw_state[7]
-        blue = self.raw_state[8]
-        white = self.raw_state[9]
-        return (red, green, blue, white)
-    
+        return self.state.rgbw
+
     def getRgbww(self):
-        if self.mode != "color":
-            return (255, 255, 255, 255, 255)
-        red = self.raw_state[6]
-        green = self.raw_state[7]
-        blue = self.raw_state[8]
-        white = self.raw_state[9]
-        white2 = self.raw_state[11]
-        return (red, green, blue, white, white2)
+        return self.state.rgbww
 
     def getSpeed(self):
-        delay = self.raw_state[5]
-        speed = utils.delayToSpeed(delay)
-        return speed
+        return self.state.speed
 
-    def setRgbw(self, r=None, g=None, b=None, w=None, persist=True,
-                brightness=None, retry=2, w2=None):
+    def _rgbw_msg(self, r=None, g=None, b=None, w=None, persist=True,
+                  brightness=None, w2=None):
+        return bytes(self._rgbw_view(r, g, b, w, persist, brightness, w2))
+
+    def _rgbw_view(self, r=None, g=None, b=None, w=None, persist=True,
+                   brightness=None, w2=None):
+        # Like _rgbw_msg, but returns a codec view, which is reused by the
+        # next message built on this thread.  Only for callers that send it
+        # before anything else can run on the thread.
 
         if (r or g or b) and (w or w2) and not self.rgbwcapable:
             print("RGBW command sent to non-RGBW device")
@@ -921,86 +1033,11 @@ class WifiLedBulb():
         if brightness != None:
             (r, g, b) = self._calculateBrightness((r, g, b), brightness)
 
-        # The original LEDENET protocol
-        if self.protocol == 'LEDENET_ORIGINAL':
-            msg = bytearray([0x56])
-            msg.append(int(r))
-            msg.append(int(g))
-            msg.append(int(b))
-            msg.append(0xaa)
-        else:
-            # all other devices
-
-            #assemble the message
-            if persist:
-                msg = bytearray([0x31])
-            else:
-                msg = bytearray([0x41])
-
-            if r is not None:
-                msg.append(int(r))
-            else:
-                msg.append(int(0))
-            if g is not None:
-                msg.append(int(g))
-            else:
-                msg.append(int(0))
-            if b is not None:
-                msg.append(int(b))
-            else:
-                msg.append(int(0))
-            if w is not None:
-                msg.append(int(w))
-            else:
-                msg.append(int(0))
-
-            if self.protocol == "LEDENET":
-                # LEDENET devices support two white outputs for cold and warm. We set
-                # the second one here - if we're only setting a single white value,
-                # we set the second output to be the same as the first
-                if w2 is not None:
-                    msg.append(int(w2))
-                elif w is not None:
-                    msg.append(int(w))
-                else:
-                    msg.append(0)
-
-            # write mask, default to writing color and whites simultaneously
-            write_mask = 0x00
-            # rgbwprotocol devices always overwrite both color & whites
-            if not self.rgbwprotocol:
-                if w is None and w2 is None:
-                    # Mask out whites
-                    write_mask |= 0xf0
-                elif r is None and g is None and b is None:
-                    # Mask out colors
-                    write_mask |= 0x0f
-
-            msg.append(write_mask)
-
-            # Message terminator
-            msg.append(0x0f)
-
-        # send the message
-        try:
-            self._send_msg(msg)
-        except socket.error:
-            if retry:
-                self.connect()
-                self.setRgbw(r,g,b,w, persist=persist, brightness=brightness,
-                             retry=max(retry-1, 0), w2=w2)
+        return codec.rgbw(r, g, b, w, w2, persist, self.protocol,
+                          self.rgbwprotocol)
 
     def getRgb(self):
-        if self.mode != "color":
-            return (255, 255, 255)
-        red = self.raw_state[6]
-        green = self.raw_state[7]
-        blue = self.raw_state[8]
-        return (red, green, blue)
-
-    def setRgb(self, r,g,b, persist=True, brightness=None, retry=2):
-        self.setRgbw(r, g, b, persist=persist, brightness=brightness,
-                     retry=retry)
+        return self.state.rgb
 
     def _calculateBrightness(self, rgb, level):
         r = rgb[0]
@@ -1009,39 +1046,8 @@ class WifiLedBulb():
         hsv = colorsys.rgb_to_hsv(r, g, b)
         return colorsys.hsv_to_rgb(hsv[0], hsv[1], level)
 
-    def _send_msg(self, bytes):
-        # calculate checksum of byte array and add to end
-        if self._use_csum:
-            csum = sum(bytes) & 0xFF
-            bytes.append(csum)
-        with self._lock:
-            self._socket.send(bytes)
-
-    def _read_msg(self, expected):
-        remaining = expected
-        rx = bytearray()
-        begin = time.time()
-        while remaining > 0:
-            if time.time() - begin > self.timeout:
-                break
-            try:
-                with self._lock:
-                    self._socket.setblocking(0)
-                    chunk = self._socket.recv(remaining)
-                    if chunk:
-                        begin = time.time()
-                    remaining -= len(chunk)
-                    rx.extend(chunk)
-            except socket.error:
-                pass
-            finally:
-                self._socket.setblocking(1)
-        return rx
-
-    def getClock(self):
-        msg = bytearray([0x11, 0x1a, 0x1b, 0x0f])
-        self._send_msg(msg)
-        rx = self._read_msg(12)
+    @staticmethod
+    def _parse_clock(rx):
         if len(rx) != 12:
             return
         year =  rx[3] + 2000
@@ -1057,7 +1063,8 @@ class WifiLedBulb():
             dt = None
         return dt
 
-    def setClock(self):
+    @staticmethod
+    def _clock_msg():
         msg = bytearray([0x10, 0x14])
         now = datetime.datetime.now()
         msg.append(now.year-2000)
@@ -1069,13 +1076,26 @@ class WifiLedBulb():
         msg.append(now.isoweekday()) # day of week
         msg.append(0x00)
         msg.append(0x0f)
-        self._send_msg(msg)
+        return msg
 
     def setProtocol(self, protocol):
         self.protocol = protocol.upper()
 
-    def setPresetPattern(self, pattern, speed):
+    def update_address(self, ipaddr):
+        """Point the bulb at a new ip address, e.g. after a DHCP change."""
+        if ipaddr == self.ipaddr:
+            return
+        self.ipaddr = ipaddr
+        # the next request connects to the new address
+        self.close()
+
+    @classmethod
+    def _preset_msg(cls, pattern, speed):
+        return bytes(cls._preset_view(pattern, speed))
 
+    @staticmethod
+    def _preset_view(pattern, speed):
+        # a codec view, see _rgbw_view
         PresetPattern.valtostr(pattern)
         if not PresetPattern.valid(pattern):
             #print "Pattern must be between 0x25 and 0x38"
@@ -1083,18 +1103,11 @@ class WifiLedBulb():
 
         delay = utils.speedToDelay(speed)
         #print "speed {}, delay 0x{:02x}".format(speed,delay)
-        pattern_set_msg = bytearray([0x61])
-        pattern_set_msg.append(pattern)
-        pattern_set_msg.append(delay)
-        pattern_set_msg.append(0x0f)
-
-        self._send_msg(pattern_set_msg)
+        return codec.preset(pattern, delay)
 
-    def getTimers(self):
-        msg = bytearray([0x22, 0x2a, 0x2b, 0x0f])
-        self._send_msg(msg)
+    @staticmethod
+    def _parse_timers(rx):
         resp_len = 88
-        rx = self._read_msg(resp_len)
         if len(rx) != resp_len:
             print("response too short!")
             raise Exception
@@ -1111,7 +1124,8 @@ class WifiLedBulb():
 
         return timer_list
 
-    def sendTimers(self, timer_list):
+    @staticmethod
+    def _timers_msg(timer_list):
         # remove inactive or expired timers from list
         for t in timer_list:
             if not t.isActive() or t.isExpired():
@@ -1136,13 +1150,10 @@ class WifiLedBulb():
         for t in timer_list:
             msg.extend(t.toBytes())
         msg.extend(msg_end)
-        self._send_msg(msg)
-
-        # not sure what the resp is, prob some sort of ack?
-        rx = self._read_msg(1)
-        rx = self._read_msg(3)
+        return msg
 
-    def setCustomPattern(self, rgb_list, speed, transition_type):
+    @staticmethod
+    def _custom_msg(rgb_list, speed, transition_type):
         # truncate if more than 16
         if len(rgb_list) > 16:
             print("too many colors, truncating list")
@@ -1151,7 +1162,7 @@ class WifiLedBulb():
         # quit if too few
         if len(rgb_list) == 0:
             print("no colors, aborting")
-            return
+            return None
 
         msg = bytearray()
 
@@ -1184,75 +1195,1508 @@ class WifiLedBulb():
             msg.append(0x3a)
         msg.append(0xff)
         msg.append(0x0f)
+        return msg
+
+
+class WifiLedBulb(_BulbProtocol):
+    # the thread pool shared by the submit_* methods of every bulb
+    executor_workers = 32
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, ipaddr, port=5577, timeout=5, persistent=False,
+                 lazy=False, capabilities=None, capability_cache=None,
+                 bulb_id=None, observer=None, coalesce=False,
+                 retry_policy=None):
+        """Create a bulb and read its current state.
+
+        By default a fresh connection is opened for every state query.  With
+        persistent=True a single connection is kept open and reused; it is
+        only re-established once the bulb drops it or a send fails.
+
+        With lazy=True nothing is sent over the network here; the bulb is
+        connected and probed when it is first used.  capabilities takes a
+        dict saved from the capabilities property of an earlier object for
+        the same bulb, which skips the protocol probe.
+
+        capability_cache takes a CapabilityCache to look the capabilities up
+        in and keep up to date, keyed by bulb_id (the id reported by
+        BulbScanner) if given, or else by the ip address.
+
+        observer is called as observer(event, info) as the bulb talks to
+        the device; see BulbMetrics for the events.  It may be set or
+        changed at any time through the observer attribute.
+
+        With coalesce=True colour and power commands return straight away
+        and are sent from a background thread.  While one is waiting to go
+        out, a newer command of the same kind replaces it, so only the
+        latest colour and power state are sent once the socket is free.
+        Presets and custom patterns count as colours.  Anything that reads
+        from the bulb waits for the queued commands to be sent first; use
+        flush() to wait for them explicitly.
+
+        retry_policy takes a RetryPolicy for how failed operations are
+        retried; by default up to 2 retries, with a short growing wait
+        between them.
+        """
+        super().__init__(ipaddr, port, timeout, observer, retry_policy)
+        self.persistent = persistent
 
-        self._send_msg(msg)
-
-    def refreshState(self):
-        return self.update_state()
-
+        self._socket = None
+        self._connected = False
+        # _lock covers a single send; _request_lock a request and the
+        # reading of its reply, so concurrent callers can't take each
+        # other's replies
+        self._lock = threading.Lock()
+        self._request_lock = threading.RLock()
+        self._initialized = False
+        self._queue = _CommandQueue(self) if coalesce else None
+        self._submitted = collections.deque()
+        self._submitted_lock = threading.Lock()
+        self._submitted_running = False
+        # frames held back by batch(), per thread; _batching counts the
+        # threads with a batch open so _send_msg can skip the lookup
+        self._batch_local = threading.local()
+        self._batching = 0
+
+        self._capability_cache = capability_cache
+        self._cache_key = bulb_id or ipaddr
+        self._capabilities_cached = False
+        if capabilities is None and capability_cache is not None:
+            capabilities = capability_cache.get(self._cache_key)
+            self._capabilities_cached = capabilities is not None
+        if capabilities is not None:
+            self._apply_capabilities(capabilities)
+        if not lazy:
+            self.connect(self.retry_policy.retries)
+            self.update_state()
+
+    def _ensure_initialized(self):
+        # a lazily created bulb is connected, and probed if its capabilities
+        # aren't known, before the first command is built
+        if self._initialized:
+            return
+        if self._query_len == 0:
+            # the probe needs a connection, as in __init__
+            if not self._connected:
+                self.connect(self.retry_policy.retries)
+            self.update_state()
+        else:
+            self._initialized = True
+            self.connect(self.retry_policy.retries)
 
-class  BulbScanner():
-    def __init__(self):
-        self.found_bulbs = []
+    def connect(self, retry=0):
+        # a request in flight would lose its reply with the old socket
+        with self._request_lock:
+            self._reconnect(retry)
+
+    def _reconnect(self, retry=0):
+        # connect() without the request lock
+        attempts = self.retry_policy.start(retry)
+        while not self._connect() and self._retry("connect", attempts):
+            pass
 
-    def getBulbInfoByID(self, id):
-        for b in self.found_bulbs:
-            if b['id'] == id:
-                return b
-        return b
+    def _connect(self):
+        """Make a single connection attempt; returns True if it worked."""
+        self.close()
+        # read once, the observer may be set while this runs
+        observer = self.observer
+        if observer is not None:
+            start = time.time()
+        sock = None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            # frames are tiny, don't let Nagle hold them back
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.persistent:
+                self._set_keepalive(sock)
+            sock.connect((self.ipaddr, self.port))
+            # only handed to senders once it is connected
+            self._socket = sock
+            self._connected = True
+        except socket.error as e:
+            if sock is not None:
+                sock.close()
+                # sends fail with socket.error until a connect works
+                self._socket = sock
+            if observer is not None:
+                self._emit("connect", seconds=time.time() - start, error=e)
+            return False
+        if observer is not None:
+            self._emit("connect", seconds=time.time() - start, error=None)
+        return True
 
-    def getBulbInfo(self):
-        return self.found_bulbs
+    def _retry(self, method, attempts):
+        """Wait before trying method again; False if it should give up."""
+        delay = attempts.next_delay()
+        if delay is None:
+            return False
+        if self.observer is not None:
+            self._emit("retry", method=method,
+                       retries_left=attempts.retries_left, delay=delay)
+        if delay > 0:
+            time.sleep(delay)
+        return True
 
-    def scan(self, timeout=10):
+    def close(self):
+        self._connected = False
+        if self._socket is None:
+            return
+        # not in the middle of someone's send
+        with self._lock:
+            try:
+                self._socket.close()
+            except socket.error:
+                pass
 
-        DISCOVERY_PORT = 48899
+    def _connection_alive(self):
+        """Check a persistent connection before reusing it.
 
-        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        sock.bind(('', DISCOVERY_PORT))
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        Any bytes left over from an earlier reply are discarded so they
+        can't be mistaken for the answer to the next request.  Returns False
+        if the bulb has closed or reset the connection.
+        """
+        if not self._connected:
+            return False
+        try:
+            self._socket.setblocking(0)
+            while True:
+                try:
+                    if not self._socket.recv(1024):
+                        return False
+                except socket.error as e:
+                    # nothing pending, the connection is still good
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return True
+                    return False
+        finally:
+            self._socket.settimeout(self.timeout)
 
-        msg = "HF-A11ASSISTHREAD".encode('ascii')
+    def _determine_query_len(self, attempts=None):
+        # attempts is shared with the caller, so a failed probe uses up the
+        # caller's retries rather than multiplying them
+        if attempts is None:
+            attempts = self.retry_policy.start()
+        while True:
+            # determine the type of protocol based of first 2 bytes.
+            self._send_msg(bytearray([0x81, 0x8a, 0x8b]))
+            rx = self._read_msg(2)
+            # if any response is recieved, use the default protocol
+            if len(rx) == 2:
+                self._query_len = 14
+                self._skip_probe_reply()
+                return
+            # if no response from default received, next try the original protocol
+            self._send_msg(bytearray([0xef, 0x01, 0x77]))
+            rx = self._read_msg(2)
+            if len(rx) == 2 and rx[1] == 0x01:
+                self.protocol = 'LEDENET_ORIGINAL'
+                self._use_csum = False
+                self._query_len = 11
+                self._skip_probe_reply()
+                return
+            else:
+                self._use_csum = True
+            # try again only if neither probe was answered
+            if len(rx) == 2 or not self._retry("_determine_query_len",
+                                               attempts):
+                return
 
-        # set the time at which we will quit the search
-        quit_time = time.time() + timeout
+    def _skip_probe_reply(self):
+        # Only the first 2 bytes of the probe reply were read.  A fresh
+        # connection is made for the next query unless the connection is
+        # persistent, so only then does the rest of the frame need reading.
+        if self.persistent:
+            self._read_msg(self._query_len - 2)
 
-        response_list = []
-        # outer loop for query send
-        while True:
-            if time.time() > quit_time:
-                break
-            # send out a broadcast query
-            sock.sendto(msg, ('<broadcast>', DISCOVERY_PORT))
+    def query_state(self, retry=None, led_type = None):
+        return self._query_state(self.retry_policy.start(retry), led_type)
 
-            # inner loop waiting for responses
+    def _query_state(self, attempts, led_type=None):
+        with self._request_lock:
             while True:
+                self._initialized = True
+                if self._query_len == 0:
+                    # a lazy bulb may not have connected yet
+                    if not self._connected:
+                        self.connect()
+                    self._determine_query_len(attempts)
+                    if self._query_len == 0:
+                        # the probe has used up the retries
+                        self._is_on = False
+                        return
+
+                msg = self._query_msg(led_type)
+                if self.protocol == 'LEDENET_ORIGINAL':
+                    led_type = 'LEDENET_ORIGINAL'
 
-                sock.settimeout(1)
                 try:
-                    data, addr = sock.recvfrom(64)
-                except socket.timeout:
-                    data = None
-                    if time.time() > quit_time:
-                        break
-
-                if data is None:
+                    # persistent connections are checked in _send_msg instead
+                    if not self.persistent:
+                        self.connect()
+                    self._send_msg(msg)
+                    rx = self._read_msg(self._query_len)
+                except socket.error:
+                    if not self._retry("query_state", attempts):
+                        self._is_on = False
+                        return
+                    self.connect()
                     continue
-                if  data == msg:
+                if rx is None or len(rx) < self._query_len:
+                    if not self._retry("query_state", attempts):
+                        self._is_on = False
+                        return rx
                     continue
+                return rx
+
+
+    def update_state(self, retry=None):
+        attempts = self.retry_policy.start(retry)
+        while True:
+            # each query may use the retries left over, within the deadline
+            rx = self._query_state(self.retry_policy.start(
+                attempts.retries_left, attempts.deadline))
+            if ((rx is None or len(rx) < self._query_len) and
+                    self._capabilities_cached and self._connected):
+                # The bulb is up but didn't answer the query the cache told us
+                # to send; forget the cache and probe it properly.
+                self._forget_cached_capabilities()
+                rx = self._query_state(self.retry_policy.start(
+                    attempts.retries_left, attempts.deadline))
+            # an empty reply also means no answer, even when the probe failed
+            # and _query_len is still 0
+            if not rx or len(rx) < self._query_len:
+                self._is_on = False
+                return
+            if not self._process_state_response(rx):
+                if not self._retry("update_state", attempts):
+                    return
+                continue
+            if self._capability_cache is not None:
+                self._update_capability_cache(rx)
+            return
+
+    def _update_capability_cache(self, rx):
+        if self._capabilities_cached:
+            cached = self.capabilities
+            detected = self._state_capabilities(rx)
+            if detected != cached:
+                # the bulb disagrees with the cache, believe the bulb
+                self._apply_capabilities(detected)
+            self._capabilities_cached = False
+        self._capability_cache.set(self._cache_key, self.capabilities)
+
+    def _forget_cached_capabilities(self):
+        self._capability_cache.discard(self._cache_key)
+        self._capabilities_cached = False
+        self.protocol = None
+        self.rgbwcapable = False
+        self.rgbwprotocol = False
+        self._use_csum = True
+        self._query_len = 0
+
+    def _change_state(self, retry, turn_on = True):
+        self._ensure_initialized()
+        msg = self._power_msg(turn_on)
+        if self._queue is not None:
+            self._queue.put("power", msg)
+            return
+
+        attempts = self.retry_policy.start(retry)
+        while True:
+            try:
+                self._send_msg(msg)
+                return
+            except socket.error:
+                if not self._retry("_change_state", attempts):
+                    self._is_on = False
+                    return
+                self.connect()
+
+
+    def turnOn(self, retry=None):
+        self._is_on = True
+        self._change_state(retry, turn_on = True)
+
+    def turnOff(self, retry=None):
+        self._is_on = False
+        self._change_state(retry, turn_on = False)
+
+
+    def setWarmWhite(self, level, persist=True, retry=None):
+        self.setWarmWhite255(utils.percentToByte(level), persist, retry)
+
+    def setWarmWhite255(self, level, persist=True, retry=None):
+        self.setRgbw(w=level, persist=persist, brightness=None, retry=retry)
+
+    def setColdWhite(self, level, persist=True, retry=None):
+        self.setColdWhite255(utils.percentToByte(level), persist, retry)
+
+    def setColdWhite255(self, level, persist=True, retry=None):
+        self.setRgbw(persist=persist, brightness=None, retry=retry, w2=level)
+
+    def setWhiteTemperature(self, temperature, brightness, persist=True,
+                            retry=None):
+        warm, cold = self._white_levels(temperature, brightness)
+        self.setRgbw(w=warm, w2=cold, persist=persist, retry=retry)
+
+    def setRgbw(self, r=None, g=None, b=None, w=None, persist=True,
+                brightness=None, retry=None, w2=None):
+        self._ensure_initialized()
+        msg = self._rgbw_view(r, g, b, w, persist, brightness, w2)
+        if self._queue is not None:
+            self._queue.put("color", msg)
+            return
+
+        # send the message
+        attempts = self.retry_policy.start(retry)
+        while True:
+            try:
+                self._send_msg(msg)
+                return
+            except socket.error:
+                if not self._retry("setRgbw", attempts):
+                    return
+                self.connect()
+
+    def setRgb(self, r,g,b, persist=True, brightness=None, retry=None):
+        self.setRgbw(r, g, b, persist=persist, brightness=brightness,
+                     retry=retry)
+
+    def _send_msg(self, bytes):
+        if self._batching:
+            buffer = getattr(self._batch_local, 'buffer', None)
+            if buffer is not None:
+                buffer += bytes
+                if self._use_csum:
+                    buffer.append(sum(bytes) & 0xFF)
+                return
+        self._write(bytes, self._use_csum)
+
+    def _write(self, bytes, use_csum):
+        if self._queue is not None and not self._queue.is_sender():
+            # keep queued commands ahead of anything sent directly, so a
+            # query sees their effect
+            self._queue.wait_idle()
+        # The check reads away stale bytes, which would eat the reply to
+        # another thread's request; that request notices a dead connection
+        # itself, so skip the check while one is in flight.
+        if self.persistent and self._request_lock.acquire(False):
+            try:
+                if not self._connection_alive():
+                    if self.observer is not None:
+                        self._emit("reconnect")
+                    self.connect()
+            finally:
+                self._request_lock.release()
+        # the checksum is sent after the message, which is left as it is
+        # so it can be sent again on a retry
+        if self.observer is None:
+            with self._lock:
+                codec.send(self._socket, bytes, use_csum)
+            return
+        start = time.time()
+        with self._lock:
+            codec.send(self._socket, bytes, use_csum)
+        self._emit("send", bytes=len(bytes) + (1 if use_csum else 0),
+                   seconds=time.time() - start)
+
+    def _read_msg(self, expected):
+        """Read a reply of up to `expected` bytes.
+
+        Blocks in recv() with the socket timeout rather than polling, and
+        gives up once nothing has arrived for `timeout` seconds.  Once the
+        header byte is in, a reply that is known to be shorter than
+        `expected` is returned as soon as it is complete.
+        """
+        if self._batching:
+            # the request being answered may still be in the batch
+            self._flush_batch()
+        remaining = expected
+        rx = bytearray()
+        observer = self.observer
+        if observer is not None:
+            start = time.time()
+        outcome = "frame"
+        # The caller holds _request_lock, so no other reader can be here.
+        # Senders only need _lock, and aren't stalled while this waits.
+        try:
+            self._socket.settimeout(self.timeout)
+            while remaining > 0:
+                chunk = self._socket.recv(remaining)
+                if not chunk:
+                    # connection closed by the bulb
+                    self._connected = False
+                    outcome = "closed"
+                    break
+                if not rx:
+                    if observer is not None:
+                        self._emit("first_byte", seconds=time.time() - start)
+                    frame_len = FRAME_LENGTHS.get(chunk[0])
+                    if frame_len is not None and frame_len < expected:
+                        remaining = frame_len
+                remaining -= len(chunk)
+                rx.extend(chunk)
+        except socket.timeout:
+            outcome = "timeout"
+        except socket.error:
+            self._connected = False
+            outcome = "closed"
+        if observer is not None:
+            self._emit(outcome, expected=expected, bytes=len(rx),
+                       seconds=time.time() - start)
+        return rx
+
+    def batch(self):
+        """Collect the commands sent in a with block and send them at once.
+
+            with bulb.batch():
+                bulb.setRgb(255, 0, 0)
+                bulb.turnOn()
+
+        Each command keeps its own checksum, and the lot goes out in a
+        single send when the block ends, or earlier if a reply has to be
+        read in the meantime.  The batch belongs to the thread that opened
+        it; other threads' commands go out as usual.  Nothing is sent if
+        the block raises, and errors from the final send are raised from
+        the with statement.  Commands queued by coalesce=True are not
+        batched.
+        """
+        return _Batch(self)
+
+    def _flush_batch(self):
+        buffer = getattr(self._batch_local, 'buffer', None)
+        if buffer:
+            self._batch_local.buffer = bytearray()
+            self._write(buffer, False)
+
+    def _request(self, msg, expected):
+        """Send msg and read its reply, without letting another thread in."""
+        with self._request_lock:
+            self._send_msg(msg)
+            return self._read_msg(expected)
+
+    def getClock(self):
+        self._ensure_initialized()
+        msg = bytearray([0x11, 0x1a, 0x1b, 0x0f])
+        rx = self._request(msg, 12)
+        return self._parse_clock(rx)
+
+    def setClock(self):
+        self._ensure_initialized()
+        self._send_msg(self._clock_msg())
+
+    def setPresetPattern(self, pattern, speed):
+        self._ensure_initialized()
+        self._send_command("color", self._preset_view(pattern, speed))
+
+    def _send_command(self, kind, msg):
+        if self._queue is not None:
+            self._queue.put(kind, msg)
+        else:
+            self._send_msg(msg)
+
+    def flush(self, timeout=None):
+        """Wait until the commands queued with coalesce=True have been sent.
+
+        Returns False if they are still pending after timeout seconds.
+        """
+        if self._queue is None:
+            return True
+        return self._queue.wait_idle(timeout)
+
+    def transition(self, target, duration=1.0, easing="linear", fps=20,
+                   persist=False, start=None):
+        """Fade to the colour target over duration seconds.
+
+        See Transition for the arguments.  Blocks until the fade is done
+        and returns the number of frames sent.
+        """
+        result = Transition([self], target, duration, easing, fps,
+                            persist, start).run()[0]
+        if result.error is not None:
+            raise result.error
+        return result.value
+
+    def getTimers(self):
+        self._ensure_initialized()
+        msg = bytearray([0x22, 0x2a, 0x2b, 0x0f])
+        rx = self._request(msg, 88)
+        return self._parse_timers(rx)
+
+    def sendTimers(self, timer_list):
+        self._ensure_initialized()
+        with self._request_lock:
+            self._send_msg(self._timers_msg(timer_list))
+
+            # not sure what the resp is, prob some sort of ack?
+            rx = self._read_msg(1)
+            rx = self._read_msg(3)
+
+    def setCustomPattern(self, rgb_list, speed, transition_type):
+        self._ensure_initialized()
+        msg = self._custom_msg(rgb_list, speed, transition_type)
+        if msg is not None:
+            self._send_command("color", msg)
+
+    def refreshState(self):
+        return self.update_state()
+
+    @classmethod
+    def shared_executor(cls):
+        """Return the thread pool that runs the submit_* methods.
+
+        It is created on first use with executor_workers threads, and is
+        shared by all bulbs in the process.
+        """
+        with WifiLedBulb._executor_lock:
+            return cls._shared_executor_locked()
+
+    @classmethod
+    def _shared_executor_locked(cls):
+        if WifiLedBulb._executor is None:
+            WifiLedBulb._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=cls.executor_workers)
+        return WifiLedBulb._executor
+
+    @classmethod
+    def set_executor_size(cls, max_workers):
+        """Change the number of threads in the shared pool.
+
+        Commands already submitted still run on the old pool.
+        """
+        with WifiLedBulb._executor_lock:
+            WifiLedBulb.executor_workers = max_workers
+            old = WifiLedBulb._executor
+            WifiLedBulb._executor = None
+            # under the lock, so nothing is submitted to it after this
+            if old is not None:
+                old.shutdown(wait=False)
+
+    def _submit_call(self, method, *args, **kwargs):
+        # calls run one at a time and in order for each bulb, so a bulb
+        # never holds more than one thread of the shared pool
+        future = concurrent.futures.Future()
+        with self._submitted_lock:
+            self._submitted.append((future, method, args, kwargs))
+            if self._submitted_running:
+                return future
+            self._submitted_running = True
+        self._schedule_submitted()
+        return future
+
+    def _schedule_submitted(self):
+        try:
+            with WifiLedBulb._executor_lock:
+                self._shared_executor_locked().submit(self._run_submitted)
+        except Exception as e:
+            # nothing will run the queue, so fail what is waiting in it
+            with self._submitted_lock:
+                pending = list(self._submitted)
+                self._submitted.clear()
+                self._submitted_running = False
+            for future, method, args, kwargs in pending:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+
+    def _run_submitted(self):
+        with self._submitted_lock:
+            future, method, args, kwargs = self._submitted.popleft()
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(method(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        with self._submitted_lock:
+            if not self._submitted:
+                self._submitted_running = False
+                return
+        # back of the line, so busy bulbs don't starve the others
+        self._schedule_submitted()
+
+    def submit_setRgb(self, r, g, b, persist=True, brightness=None,
+                      retry=None):
+        """Like setRgb, but run on the shared pool; returns a Future.
+
+        The other submit_* methods work the same way.  Calls submitted for
+        one bulb run in the order they were made.
+        """
+        return self._submit_call(self.setRgb, r, g, b, persist=persist,
+                                 brightness=brightness, retry=retry)
+
+    def submit_setRgbw(self, r=None, g=None, b=None, w=None, persist=True,
+                       brightness=None, retry=None, w2=None):
+        return self._submit_call(self.setRgbw, r, g, b, w, persist=persist,
+                                 brightness=brightness, retry=retry, w2=w2)
+
+    def submit_turnOn(self, retry=None):
+        return self._submit_call(self.turnOn, retry=retry)
+
+    def submit_turnOff(self, retry=None):
+        return self._submit_call(self.turnOff, retry=retry)
+
+    def submit_update_state(self, retry=None):
+        return self._submit_call(self.update_state, retry=retry)
+
+    def submit_getTimers(self):
+        return self._submit_call(self.getTimers)
+
+    def submit_setClock(self):
+        return self._submit_call(self.setClock)
+
+
+class _Batch():
+    """Context manager returned by WifiLedBulb.batch()."""
+
+    def __init__(self, bulb):
+        self._bulb = bulb
+        self._nested = False
+
+    def __enter__(self):
+        bulb = self._bulb
+        if getattr(bulb._batch_local, 'buffer', None) is not None:
+            # already batching, the outer block sends
+            self._nested = True
+            return self
+        bulb._batch_local.buffer = bytearray()
+        with bulb._lock:
+            bulb._batching += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._nested:
+            return False
+        bulb = self._bulb
+        buffer = bulb._batch_local.buffer
+        bulb._batch_local.buffer = None
+        with bulb._lock:
+            bulb._batching -= 1
+        if buffer and exc_type is None:
+            bulb._write(buffer, False)
+        return False
+
+
+class _CommandQueue():
+    """Latest-wins queue of outgoing commands for one bulb.
+
+    Holds at most one command of each kind.  A new command replaces a
+    pending one of its kind and goes to the back of the queue, so commands
+    of different kinds still reach the bulb in the order they were last
+    given.  A daemon thread sends them, and exits once the queue has been
+    empty for idle_timeout seconds.
+    """
+
+    idle_timeout = 1.0
+
+    def __init__(self, bulb):
+        self._bulb = bulb
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._sending = False
+        self._thread = None
+
+    def put(self, kind, msg):
+        bulb = self._bulb
+        with self._cond:
+            # copied, as the caller may reuse the buffer (codec views are)
+            replaced = self._pending.pop(kind, None) is not None
+            self._pending[kind] = bytearray(msg)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="flux_led {}".format(bulb.ipaddr))
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        if replaced and bulb.observer is not None:
+            bulb._emit("coalesced", kind=kind)
+
+    def is_sender(self):
+        return threading.current_thread() is self._thread
+
+    def wait_idle(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self._pending and not self._sending, timeout)
+
+    def _run(self):
+        self._cond.acquire()
+        try:
+            while True:
+                if not self._pending:
+                    self._cond.notify_all()
+                    self._cond.wait(self.idle_timeout)
+                    if not self._pending:
+                        self._thread = None
+                        return
+                    continue
+                kind = next(iter(self._pending))
+                msg = self._pending.pop(kind)
+                self._sending = True
+                self._cond.release()
+                try:
+                    self._send(msg)
+                finally:
+                    self._cond.acquire()
+                    self._sending = False
+        finally:
+            self._cond.release()
+
+    def _send(self, msg):
+        bulb = self._bulb
+        # nothing may escape from here, or the queue would stop for good
+        attempts = bulb.retry_policy.start(1)
+        while True:
+            try:
+                bulb._send_msg(msg)
+                return
+            except Exception as e:
+                error = e
+            try:
+                if not bulb._retry("queue", attempts):
+                    break
+                # Not connect(): a thread can hold the request lock while
+                # it waits for this queue.  The send failed, so no reply
+                # can be lost with the old socket.
+                bulb._reconnect()
+            except Exception as e:
+                error = e
+                break
+        _LOGGER.warning("Dropped a command for %s: %s", bulb.ipaddr, error)
+
+
+class BulbMetrics():
+    """An observer for WifiLedBulb and BulbScanner that keeps totals.
+
+    Pass it as observer= to any number of bulbs and scanners.  Bulbs send
+    these events, each with an info dict that includes 'ipaddr':
+
+    connect      a connection attempt; 'seconds' and 'error' (None if it
+                 worked)
+    reconnect    a persistent connection was found closed before a send
+    send         a message went out; 'bytes' and 'seconds'
+    first_byte   the first byte of a reply arrived; 'seconds' since the
+                 read started
+    frame        a reply was read in full; 'expected', 'bytes', 'seconds'
+    timeout      a read gave up waiting; 'expected', 'bytes', 'seconds'
+    closed       the bulb closed or reset the connection during a read;
+                 'expected', 'bytes', 'seconds'
+    retry        a command failed and is being tried again; 'method',
+                 'retries_left' and 'delay', the seconds waited first
+    coalesced    a queued command was replaced by a newer one before it
+                 was sent (coalesce=True); 'kind'
+    state_changed  a state frame differed from the last one; 'changes' as
+                 returned by BulbState.diff()
+
+    Scanners send "discovery_probe" for every probe sent ('address') and
+    "discovery_reply" for every bulb found ('ipaddr', 'id', 'model' and
+    'seconds' since the search started).
+
+    A bulb that keeps timing out is dead, or unreachable; one with a slow
+    first_byte is just slow.
+    """
+
+    _TIMED_EVENTS = ("connect", "send", "first_byte", "frame", "timeout",
+                     "closed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.seconds = {}
+        self.max_seconds = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.bulbs = {}
+
+    def __call__(self, event, info):
+        with self._lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            seconds = info.get('seconds')
+            if seconds is not None and event in self._TIMED_EVENTS:
+                self.seconds[event] = self.seconds.get(event, 0) + seconds
+                self.max_seconds[event] = max(
+                    self.max_seconds.get(event, 0), seconds)
+            if event == "send":
+                self.bytes_out += info['bytes']
+            elif event in ("frame", "timeout", "closed"):
+                self.bytes_in += info['bytes']
+            ipaddr = info.get('ipaddr')
+            if ipaddr is not None:
+                counts = self.bulbs.setdefault(ipaddr, {})
+                counts[event] = counts.get(event, 0) + 1
+
+    def mean_seconds(self, event):
+        """Average duration of an event, or None if it hasn't happened."""
+        with self._lock:
+            count = self.counts.get(event)
+            if not count or event not in self.seconds:
+                return None
+            return self.seconds[event] / count
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+            self.seconds = {}
+            self.max_seconds = {}
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.bulbs = {}
+
+
+class CapabilityCache():
+    """Remembers what the protocol probe found out about each bulb.
+
+    The capabilities are kept in a small JSON file, keyed by bulb id or ip
+    address, so that a new WifiLedBulb for a known bulb can skip probing.
+    A bulb whose answers disagree with the cache gets its entry replaced.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _save(self):
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, separators=(',', ':'), sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        with self._lock:
+            capabilities = self._entries.get(key)
+            if capabilities is None:
+                return None
+            return dict(capabilities)
+
+    def set(self, key, capabilities):
+        with self._lock:
+            if self._entries.get(key) == capabilities:
+                return
+            self._entries[key] = dict(capabilities)
+            self._save()
+
+    def discard(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
 
-                data = data.decode('ascii')
-                data_split = data.split(',')
-                if len(data_split) < 3:
+class BulbResult():
+    """Outcome of a BulbGroup command for a single bulb."""
+    def __init__(self, bulb, value=None, error=None, latency=None):
+        self.bulb = bulb
+        self.value = value
+        self.error = error
+        # seconds from the start of the call until it returned
+        self.latency = latency
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.ok:
+            outcome = "value={!r}".format(self.value)
+        else:
+            outcome = "error={!r}".format(self.error)
+        latency = "-" if self.latency is None else "{:.3f}s".format(self.latency)
+        return "<BulbResult {} {} {}>".format(self.bulb.ipaddr, outcome, latency)
+
+
+class Transition():
+    """A fade of one or more bulbs to a colour over a fixed time.
+
+    target is a tuple of 3 (rgb), 4 (rgbw) or 5 (rgb, warm and cold white)
+    levels, or anything utils.color_object_to_tuple understands.  Each bulb
+    fades from the colour in its last known state, or from start if that
+    is given (as the same kind of colour).  easing is a name from EASINGS or
+    a function that maps the fraction of time gone, 0 to 1, to how far the
+    fade should have got.
+
+    Frames are paced at no more than fps per second against a monotonic
+    clock.  Every frame shows where the fade should be at the moment it is
+    sent, so when sending falls behind the late frames are dropped instead
+    of queued up, and the fade ends on time however slow the link is.  The
+    frames in between use non-persistent (0x41) writes so the flash isn't
+    worn; the final colour is only stored if persist is True.
+    """
+
+    EASINGS = {
+        'linear': lambda t: t,
+        'ease_in': lambda t: t * t,
+        'ease_out': lambda t: t * (2 - t),
+        'ease_in_out': lambda t: t * t * (3 - 2 * t),
+    }
+
+    def __init__(self, bulbs, target, duration=1.0, easing="linear", fps=20,
+                 persist=False, start=None):
+        self.target = self._levels(target)
+        self.start = None
+        if start is not None:
+            self.start = self._levels(start)
+            if len(self.start) != len(self.target):
+                raise ValueError("start and target colors don't match")
+        if callable(easing):
+            self.easing = easing
+        elif easing in self.EASINGS:
+            self.easing = self.EASINGS[easing]
+        else:
+            raise ValueError("Unknown easing: {}".format(easing))
+        self.bulbs = list(bulbs)
+        self.duration = max(duration, 0)
+        if fps <= 0:
+            raise ValueError("fps must be positive: {}".format(fps))
+        self.interval = 1.0 / fps
+        self.persist = persist
+
+        # frame slots sent, and skipped because sending was behind
+        self.frames = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _levels(color):
+        if isinstance(color, list):
+            color = tuple(color)
+        levels = utils.color_object_to_tuple(color)
+        if levels is None:
+            raise ValueError("Invalid color: {}".format(color))
+        return tuple(int(level) for level in levels)
+
+    def _current(self, bulb):
+        if self.start is not None:
+            return self.start
+        if bulb.state is None:
+            bulb.update_state()
+        if len(self.target) == 5:
+            return bulb.getRgbww()
+        elif len(self.target) == 4:
+            return bulb.getRgbw()
+        return bulb.getRgb()
+
+    @staticmethod
+    def _send(bulb, levels, persist, retry):
+        # not setRgbw, which gives up quietly once out of retries; a bulb
+        # that stops answering has to show up in the results
+        bulb._ensure_initialized()
+        w2 = levels[4] if len(levels) == 5 else None
+        msg = bulb._rgbw_view(*levels[:4], persist=persist, w2=w2)
+        attempts = bulb.retry_policy.start(retry)
+        while True:
+            try:
+                bulb._send_command("color", msg)
+                return
+            except socket.error:
+                if not bulb._retry("setRgbw", attempts):
+                    raise
+                bulb.connect()
+
+    def run(self):
+        """Run the fade; returns a BulbResult per bulb with the frames sent."""
+        clock = time.monotonic
+        begin = clock()
+        count = len(self.bulbs)
+        sent = [0] * count
+        errors = [None] * count
+        starts = [None] * count
+        last = [None] * count
+        for i, bulb in enumerate(self.bulbs):
+            try:
+                starts[i] = self._current(bulb)
+            except Exception as e:
+                errors[i] = e
+
+        next_frame = begin
+        while True:
+            now = clock()
+            elapsed = now - begin
+            if elapsed >= self.duration:
+                break
+            if now < next_frame:
+                time.sleep(min(next_frame, begin + self.duration) - now)
+                continue
+
+            progress = self.easing(elapsed / self.duration)
+            for i, bulb in enumerate(self.bulbs):
+                if errors[i] is not None:
                     continue
-                item = dict()
-                item['ipaddr'] = data_split[0]
-                item['id'] = data_split[1]
-                item['model'] = data_split[2]
-                response_list.append(item)
-
-        self.found_bulbs = response_list
-        return response_list
+                levels = tuple(int(round(a + (b - a) * progress))
+                               for a, b in zip(starts[i], self.target))
+                if levels == last[i]:
+                    continue
+                try:
+                    # no retries here, the next frame will do instead
+                    self._send(bulb, levels, False, 0)
+                except Exception as e:
+                    errors[i] = e
+                    continue
+                sent[i] += 1
+                last[i] = levels
+            self.frames += 1
+
+            next_frame += self.interval
+            now = clock()
+            if now > next_frame:
+                # sending took longer than a frame, skip the ones now late
+                late = int((now - next_frame) / self.interval) + 1
+                self.dropped += late
+                next_frame += late * self.interval
+
+        results = []
+        for i, bulb in enumerate(self.bulbs):
+            if errors[i] is None:
+                try:
+                    self._send(bulb, self.target, self.persist, 2)
+                    sent[i] += 1
+                except Exception as e:
+                    errors[i] = e
+            results.append(BulbResult(bulb, value=sent[i], error=errors[i],
+                                      latency=clock() - begin))
+        return results
+
+
+class BulbGroup():
+    """Send the same command to many bulbs at once.
+
+    Commands are run on the group's own pool of at most max_workers
+    threads, so a slow or offline bulb only delays its own result.  Every
+    command returns a list of BulbResult in the same order as the bulbs.
+    If timeout is given, bulbs that haven't answered after that many
+    seconds get a TimeoutError result; their calls keep a thread until
+    they finish.
+
+    max_workers=None uses the pool shared with WifiLedBulb's submit_*
+    methods instead.  Calls to hung bulbs then hold threads that
+    unrelated submit_* callers are waiting for, so only opt in when the
+    bulbs are known to answer.
+    """
+    def __init__(self, bulbs=None, max_workers=16, timeout=None):
+        self.bulbs = list(bulbs or [])
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.bulbs)
+
+    def __iter__(self):
+        return iter(self.bulbs)
+
+    def add(self, bulb):
+        self.bulbs.append(bulb)
+
+    def remove(self, bulb):
+        self.bulbs.remove(bulb)
+
+    def _get_executor(self):
+        if self.max_workers is None:
+            return WifiLedBulb.shared_executor()
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers)
+            return self._executor
+
+    def close(self):
+        """Release the worker threads.  Calls still running are not waited for.
+
+        The shared pool is left running.
+        """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    @staticmethod
+    def _call(bulb, name, args, kwargs):
+        begin = time.time()
+        try:
+            value = getattr(bulb, name)(*args, **kwargs)
+        except Exception as e:
+            return BulbResult(bulb, error=e, latency=time.time() - begin)
+        return BulbResult(bulb, value=value, latency=time.time() - begin)
+
+    def call(self, name, *args, **kwargs):
+        """Call the bulb method `name` on every bulb in the group."""
+        executor = self._get_executor()
+        futures = [executor.submit(self._call, bulb, name, args, kwargs)
+                   for bulb in self.bulbs]
+        concurrent.futures.wait(futures, timeout=self.timeout)
+
+        results = []
+        for bulb, future in zip(self.bulbs, futures):
+            if future.done():
+                results.append(future.result())
+            else:
+                future.cancel()
+                results.append(BulbResult(bulb, error=concurrent.futures.TimeoutError(
+                    "No answer from bulb at {} within {}s".format(bulb.ipaddr, self.timeout))))
+        return results
+
+    def update_state(self, retry=None):
+        return self.call('update_state', retry=retry)
+
+    def turnOn(self, retry=None):
+        return self.call('turnOn', retry=retry)
+
+    def turnOff(self, retry=None):
+        return self.call('turnOff', retry=retry)
+
+    def setRgb(self, r, g, b, persist=True, brightness=None, retry=None):
+        return self.call('setRgb', r, g, b, persist=persist,
+                         brightness=brightness, retry=retry)
+
+    def setRgbw(self, r=None, g=None, b=None, w=None, persist=True,
+                brightness=None, retry=None, w2=None):
+        return self.call('setRgbw', r, g, b, w, persist=persist,
+                         brightness=brightness, retry=retry, w2=w2)
+
+    def setWarmWhite(self, level, persist=True, retry=None):
+        return self.call('setWarmWhite', level, persist, retry)
+
+    def setColdWhite(self, level, persist=True, retry=None):
+        return self.call('setColdWhite', level, persist, retry)
+
+    def setPresetPattern(self, pattern, speed):
+        return self.call('setPresetPattern', pattern, speed)
+
+    def transition(self, target, duration=1.0, easing="linear", fps=20,
+                   persist=False, start=None):
+        """Fade every bulb to the colour target together.
+
+        Runs one Transition for the whole group in this thread, rather than
+        one per bulb on the pool, so the bulbs stay in step.  Returns a
+        BulbResult per bulb with the number of frames sent.
+        """
+        return Transition(self.bulbs, target, duration, easing, fps,
+                          persist, start).run()
+
+
+class  BulbScanner():
+    DISCOVERY_PORT = 48899
+    DISCOVERY_MSG = "HF-A11ASSISTHREAD".encode('ascii')
+
+    def __init__(self, observer=None):
+        self.found_bulbs = []
+        self._bulbs_by_id = {}
+        # called as observer(event, info), see BulbMetrics
+        self.observer = observer
+
+    def _emit(self, event, **info):
+        try:
+            self.observer(event, info)
+        except Exception:
+            _LOGGER.exception("Error in scanner observer")
+
+    def getBulbInfoByID(self, id):
+        return self._bulbs_by_id.get(id)
+
+    def getBulbInfo(self):
+        return self.found_bulbs
+
+    @staticmethod
+    def _parse_response(data):
+        try:
+            data = data.decode('ascii')
+        except UnicodeDecodeError:
+            return None
+        data_split = data.split(',')
+        if len(data_split) < 3:
+            return None
+        item = dict()
+        item['ipaddr'] = data_split[0]
+        item['id'] = data_split[1]
+        item['model'] = data_split[2]
+        return item
+
+    def _add_bulb(self, item):
+        """Record a discovered bulb.  Returns False if it was already known."""
+        if item['id'] in self._bulbs_by_id:
+            return False
+        self._bulbs_by_id[item['id']] = item
+        self.found_bulbs.append(item)
+        return True
+
+    def _discover(self, sock, probes, interval, linger, ids=None, count=None):
+        """Send discovery probes and yield each new bulb that answers.
+
+        probes are the addresses to send to, one every interval seconds.
+        Answers are collected until linger seconds after the last probe, or
+        until all of ids, or count bulbs, have been found.
+        """
+        self.found_bulbs = []
+        self._bulbs_by_id = {}
+        wanted = set(ids) if ids else None
+
+        probes = iter(probes)
+        address = next(probes, None)
+        if address is None:
+            # nothing to probe, so nothing can answer
+            return
+        next_send = start = time.time()
+        quit_time = None
+        observer = self.observer
+        while True:
+            now = time.time()
+            # send whatever probes are due, catching up in a burst if needed
+            while address is not None and now >= next_send:
+                try:
+                    sock.sendto(self.DISCOVERY_MSG, address)
+                except socket.error:
+                    # e.g. no route to this host, carry on with the rest
+                    pass
+                if observer is not None:
+                    self._emit("discovery_probe", address=address)
+                next_send += interval
+                address = next(probes, None)
+                if address is None:
+                    quit_time = now + linger
+            if quit_time is not None and now >= quit_time:
+                break
+
+            if address is not None:
+                wait = next_send - now
+            else:
+                wait = quit_time - now
+            sock.settimeout(max(wait, 0.001))
+            try:
+                data, addr = sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            if data == self.DISCOVERY_MSG:
+                continue
+
+            item = self._parse_response(data)
+            if item is None or not self._add_bulb(item):
+                continue
+            if observer is not None:
+                self._emit("discovery_reply", seconds=time.time() - start,
+                           **item)
+            yield item
+
+            if wanted is not None:
+                wanted.discard(item['id'])
+                if not wanted:
+                    break
+            if count is not None and len(self.found_bulbs) >= count:
+                break
+
+    def scan_iter(self, timeout=10, ids=None, count=None):
+        """Search for bulbs, yielding each one as soon as it answers.
+
+        Every bulb is yielded once, however many times it answers.  The
+        search stops after timeout seconds, or earlier once all the bulbs in
+        ids, or count bulbs in total, have been found.
+        """
+        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        try:
+            sock.bind(('', self.DISCOVERY_PORT))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+            # send out a broadcast query every second until the timeout
+            sends = max(int(math.ceil(timeout)), 1)
+            probes = [('<broadcast>', self.DISCOVERY_PORT)] * sends
+            linger = timeout - (sends - 1)
+            for item in self._discover(sock, probes, 1, linger, ids, count):
+                yield item
+        finally:
+            sock.close()
+
+    def scan(self, timeout=10, ids=None, count=None):
+        for item in self.scan_iter(timeout, ids, count):
+            pass
+        return self.found_bulbs
+
+    def sweep_iter(self, networks, timeout=2, rate=500, ids=None, count=None,
+                   port=None):
+        """Search for bulbs by probing every address in the given networks.
+
+        For networks that drop broadcasts.  networks is a CIDR string such
+        as "192.168.1.0/24", or a list of them.  The probes go out from a
+        single socket at no more than rate packets per second, and answers
+        are collected until timeout seconds after the last probe.  Bulbs
+        are yielded as they answer, as with scan_iter().
+        """
+        if port is None:
+            port = self.DISCOVERY_PORT
+        if isinstance(networks, str):
+            networks = [networks]
+        networks = [ipaddress.ip_network(u"{}".format(n), strict=False)
+                    for n in networks]
+        probes = ((str(host), port)
+                  for network in networks for host in self._hosts(network))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(('', 0))
+            for item in self._discover(sock, probes, 1.0 / rate, timeout,
+                                       ids, count):
+                yield item
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _hosts(network):
+        # before python 3.8 a single address network has no hosts()
+        if network.num_addresses == 1:
+            return [network.network_address]
+        return network.hosts()
+
+    def sweep(self, networks, timeout=2, rate=500, ids=None, count=None,
+              port=None):
+        for item in self.sweep_iter(networks, timeout, rate, ids, count, port):
+            pass
+        return self.found_bulbs
+
+
+class DiscoveryService():
+    """Keeps track of the bulbs on the network from a background thread.
+
+    The network is searched every `interval` seconds, by broadcast or, if
+    networks are given, by sweeping them (see BulbScanner.sweep_iter).  The
+    result is a registry of bulb id -> info dict with 'ipaddr', 'id',
+    'model' and 'last_seen' (a time.time() timestamp).
+
+    Callbacks added with subscribe() are called as callback(event, info)
+    from the service thread, with event "added" for a new bulb and "moved"
+    when a bulb turns up at a different address.  Bulbs registered with
+    track() are pointed at the new address automatically.
+
+    Use DiscoveryService.shared() to get one service for the whole process
+    rather than having every caller bind its own discovery socket.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, interval=60, timeout=2, networks=None, scanner=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.networks = networks
+        self._scanner = scanner or BulbScanner()
+        self._registry = {}
+        self._subscribers = []
+        self._tracked = {}
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def shared(cls, **kwargs):
+        """Return the process wide service, creating and starting it if needed.
+
+        kwargs are only used when the service is created.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**kwargs)
+                cls._shared.start()
+            return cls._shared
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name="flux_led discovery")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        self._stop.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                _LOGGER.exception("Bulb discovery failed")
+            self._stop.wait(self.interval)
+
+    def refresh(self):
+        """Search the network now and update the registry."""
+        # only one search at a time can own the discovery socket
+        with self._scan_lock:
+            if self.networks:
+                found = self._scanner.sweep_iter(self.networks, self.timeout)
+            else:
+                found = self._scanner.scan_iter(self.timeout)
+            for item in found:
+                self._seen(item)
+
+    def _seen(self, item):
+        info = dict(item)
+        info['last_seen'] = time.time()
+        with self._lock:
+            previous = self._registry.get(info['id'])
+            self._registry[info['id']] = info
+            if previous is None:
+                event = "added"
+            elif previous['ipaddr'] != info['ipaddr']:
+                event = "moved"
+            else:
+                return
+            bulbs = [ref() for ref in self._tracked.get(info['id'], [])]
+            subscribers = list(self._subscribers)
+
+        for bulb in bulbs:
+            if bulb is not None:
+                bulb.update_address(info['ipaddr'])
+        for callback in subscribers:
+            try:
+                callback(event, dict(info))
+            except Exception:
+                _LOGGER.exception("Error in discovery subscriber")
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+    def track(self, bulb, bulb_id):
+        """Keep bulb pointed at wherever the bulb with id bulb_id is found.
+
+        Only a weak reference is kept, so tracking doesn't keep bulbs alive.
+        """
+        with self._lock:
+            refs = [ref for ref in self._tracked.get(bulb_id, [])
+                    if ref() is not None]
+            refs.append(weakref.ref(bulb))
+            self._tracked[bulb_id] = refs
+            info = self._registry.get(bulb_id)
+        if info is not None:
+            bulb.update_address(info['ipaddr'])
+
+    def get(self, bulb_id):
+        with self._lock:
+            info = self._registry.get(bulb_id)
+            if info is None:
+                return None
+            return dict(info)
+
+    def bulbs(self):
+        with self._lock:
+            return [dict(info) for info in self._registry.values()]
+
 #=======================================================================
 def showUsageExamples():
     example_text = """
@@ -1574,6 +3018,9 @@ def parseArgs():
     parser.add_option("-s", "--scan",
                       action="store_true", dest="scan", default=False,
                       help="Search for bulbs on local network")
+    parser.add_option("--sweep", dest="sweep", default=None, metavar="NETWORKS",
+                      help="Search by probing every address in NETWORKS, a comma-separated " +
+                        "list like 192.168.1.0/24, for networks that drop broadcasts (implies -s)")
     parser.add_option("-S", "--scanresults",
                       action="store_true", dest="scanresults", default=False,
                       help="Operate on scan results instead of arg list")
@@ -1631,6 +3078,15 @@ def parseArgs():
     other_group.add_option("-v", "--volatile",
                       action="store_true", dest="volatile", default=False,
                       help="Don't persist mode setting with hard power cycle (RGB and WW modes only).")
+    other_group.add_option("--concurrency", dest="concurrency", default=1,
+                      metavar="N", type="int",
+                      help="Number of bulbs to operate on at the same time (default 1)")
+    other_group.add_option("--capcache", dest="capcache", default=None,
+                      metavar="FILE",
+                      help="Remember the bulbs' protocol details in FILE to skip probing them next time")
+    other_group.add_option("--deadline", dest="deadline", default=None,
+                      metavar="SECONDS", type="float",
+                      help="Give up on a bulb that hasn't finished within SECONDS")
     parser.add_option_group(other_group)
 
     parser.usage = "usage: %prog [-sS10cwpCiltThe] [addr1 [addr2 [addr3] ...]."
@@ -1659,6 +3115,14 @@ def parseArgs():
             print("webcolors package doesn't seem to be installed. No color names available")
         sys.exit(0)
 
+    if options.sweep:
+        options.scan = True
+        try:
+            options.sweep = [ipaddress.ip_network(u"{}".format(n.strip()), strict=False)
+                             for n in options.sweep.split(',')]
+        except ValueError as e:
+            parser.error("bad network for --sweep: {}".format(e))
+
     if options.settimer:
         new_timer = processSetTimerArgs(parser, options.settimer)
         options.new_timer = new_timer
@@ -1712,6 +3176,154 @@ def parseArgs():
 
 
     return (options, args)
+
+
+def processBulb(info, options, capability_cache=None):
+    """Perform the requested operations on one bulb.
+
+    Returns the lines to print, so bulbs can be handled in parallel while
+    the output is still printed in a stable order.
+    """
+    output = []
+    bulb_id = info['id'] if info['id'] != 'Unknown ID' else None
+    try:
+        bulb = WifiLedBulb(info['ipaddr'], capability_cache=capability_cache,
+                           bulb_id=bulb_id)
+    except Exception as e:
+        output.append("Unable to connect to bulb at [{}]: {}".format(info['ipaddr'],e))
+        return output
+
+    if options.getclock:
+        output.append("{} [{}] {}".format(info['id'], info['ipaddr'],bulb.getClock()))
+
+    if options.setclock:
+        bulb.setClock()
+
+    if options.protocol:
+        bulb.setProtocol(options.protocol)
+
+    if options.ww is not None:
+        output.append("Setting warm white mode, level: {}%".format(options.ww))
+        bulb.setWarmWhite(options.ww, not options.volatile)
+
+    if options.cw is not None:
+        output.append("Setting cold white mode, level: {}%".format(options.cw))
+        bulb.setColdWhite(options.cw, not options.volatile)
+
+    if options.color is not None:
+        output.append("Setting color RGB:{}".format(options.color))
+        name = utils.color_tuple_to_string(options.color)
+        if name is None:
+            output.append("")
+        else:
+            output.append("[{}]".format(name))
+        if len(options.color) == 3:
+            bulb.setRgb(options.color[0],options.color[1],options.color[2], not options.volatile)
+        elif len(options.color) == 4:
+            bulb.setRgbw(options.color[0],options.color[1],options.color[2],options.color[3], not options.volatile)
+        elif len(options.color) == 5:
+            bulb.setRgbw(options.color[0],options.color[1],options.color[2],options.color[3], not options.volatile, None, options.color[4])
+
+    elif options.custom is not None:
+        bulb.setCustomPattern(options.custom[2],
+                              options.custom[1],
+                              options.custom[0])
+        output.append("Setting custom pattern: {}, Speed={}%, {}".format(
+            options.custom[0], options.custom[1], options.custom[2]))
+
+    elif options.preset is not None:
+        output.append("Setting preset pattern: {}, Speed={}%".
+                      format(PresetPattern.valtostr(options.preset[0]),
+                             options.preset[1]))
+        bulb.setPresetPattern(options.preset[0], options.preset[1])
+
+    if options.on:
+        output.append("Turning on bulb at {}".format(bulb.ipaddr))
+        bulb.turnOn()
+    elif options.off:
+        output.append("Turning off bulb at {}".format(bulb.ipaddr))
+        bulb.turnOff()
+
+    if options.info:
+        bulb.update_state()
+        output.append("{} [{}] {}".format(info['id'], info['ipaddr'], bulb))
+
+    if options.settimer:
+        timers = bulb.getTimers()
+        num = int(options.settimer[0])
+        output.append("New Timer ---- #{}: {}".format(num, options.new_timer))
+        if options.new_timer.isExpired():
+            output.append("[timer is already expired, will be deactivated]")
+        timers[num-1] = options.new_timer
+        bulb.sendTimers(timers)
+
+    if options.showtimers:
+        timers = bulb.getTimers()
+        num = 0
+        for t in timers:
+            num += 1
+            output.append("  Timer #{}: {}".format(num, t))
+        output.append("")
+
+    return output
+
+
+def runInOrder(jobs, concurrency=1, deadline=None):
+    """Run callables on up to `concurrency` threads.
+
+    Yields a (result, error) pair for each job, in the order of `jobs`, as
+    soon as that job has finished.  A job still running `deadline` seconds
+    after it started is given up on: it yields a TimeoutError and is left to
+    finish on its own daemon thread without holding up the rest.
+    """
+    count = len(jobs)
+    results = [None] * count
+    started = [None] * count
+    begun = [threading.Event() for i in range(count)]
+    done = [threading.Event() for i in range(count)]
+    released = [False] * count
+    slots = threading.Semaphore(max(concurrency, 1))
+    lock = threading.Lock()
+
+    def release(i):
+        with lock:
+            if released[i]:
+                return
+            released[i] = True
+        slots.release()
+
+    def worker(i):
+        try:
+            results[i] = (jobs[i](), None)
+        except Exception as e:
+            results[i] = (None, e)
+        finally:
+            done[i].set()
+            release(i)
+
+    def dispatch():
+        for i in range(count):
+            slots.acquire()
+            started[i] = time.time()
+            begun[i].set()
+            t = threading.Thread(target=worker, args=(i,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=dispatch)
+    t.daemon = True
+    t.start()
+
+    for i in range(count):
+        if deadline is None:
+            done[i].wait()
+        else:
+            begun[i].wait()
+            if not done[i].wait(max(started[i] + deadline - time.time(), 0)):
+                release(i)
+                yield (None, TimeoutError("gave up after {}s".format(deadline)))
+                continue
+        yield results[i]
 #-------------------------------------------
 def main():
 
@@ -1719,7 +3331,10 @@ def main():
 
     if options.scan:
         scanner = BulbScanner()
-        scanner.scan(timeout=2)
+        if options.sweep:
+            scanner.sweep(options.sweep)
+        else:
+            scanner.scan(timeout=2)
         bulb_info_list = scanner.getBulbInfo()
         # we have a list of buld info dicts
         addrs = []
@@ -1744,84 +3359,17 @@ def main():
 
 
     # now we have our bulb list, perform same operation on all of them
-    for info in bulb_info_list:
-        try:
-            bulb = WifiLedBulb(info['ipaddr'])
-        except Exception as e:
-            print("Unable to connect to bulb at [{}]: {}".format(info['ipaddr'],e))
-            continue
-
-        if options.getclock:
-            print("{} [{}] {}".format(info['id'], info['ipaddr'],bulb.getClock()))
-
-        if options.setclock:
-            bulb.setClock()
-
-        if options.protocol:
-            bulb.setProtocol(options.protocol)
-
-        if options.ww is not None:
-            print("Setting warm white mode, level: {}%".format(options.ww))
-            bulb.setWarmWhite(options.ww, not options.volatile)
-
-        if options.cw is not None:
-            print("Setting cold white mode, level: {}%".format(options.cw))
-            bulb.setColdWhite(options.cw, not options.volatile)
-
-        if options.color is not None:
-            print("Setting color RGB:{}".format(options.color),)
-            name = utils.color_tuple_to_string(options.color)
-            if name is None:
-                print()
-            else:
-                print("[{}]".format(name))
-            if len(options.color) == 3:
-                bulb.setRgb(options.color[0],options.color[1],options.color[2], not options.volatile)
-            elif len(options.color) == 4:
-                bulb.setRgbw(options.color[0],options.color[1],options.color[2],options.color[3], not options.volatile)
-            elif len(options.color) == 5:
-                bulb.setRgbw(options.color[0],options.color[1],options.color[2],options.color[3], not options.volatile, None, options.color[4])
-
-        elif options.custom is not None:
-            bulb.setCustomPattern(options.custom[2],
-                                  options.custom[1],
-                                  options.custom[0])
-            print("Setting custom pattern: {}, Speed={}%, {}".format(
-                options.custom[0], options.custom[1], options.custom[2]))
-
-        elif options.preset is not None:
-            print("Setting preset pattern: {}, Speed={}%".
-                  format(PresetPattern.valtostr(options.preset[0]),
-                         options.preset[1]))
-            bulb.setPresetPattern(options.preset[0], options.preset[1])
-
-        if options.on:
-            print("Turning on bulb at {}".format(bulb.ipaddr))
-            bulb.turnOn()
-        elif options.off:
-            print("Turning off bulb at {}".format(bulb.ipaddr))
-            bulb.turnOff()
-
-        if options.info:
-            bulb.update_state()
-            print("{} [{}] {}".format(info['id'], info['ipaddr'], bulb))
-
-        if options.settimer:
-            timers = bulb.getTimers()
-            num = int(options.settimer[0])
-            print("New Timer ---- #{}: {}".format(num, options.new_timer))
-            if options.new_timer.isExpired():
-                print("[timer is already expired, will be deactivated]")
-            timers[num-1] = options.new_timer
-            bulb.sendTimers(timers)
-
-        if options.showtimers:
-            timers = bulb.getTimers()
-            num = 0
-            for t in timers:
-                num += 1
-                print("  Timer #{}: {}".format(num, t))
-            print("")
+    capability_cache = None
+    if options.capcache:
+        capability_cache = CapabilityCache(options.capcache)
+    jobs = [functools.partial(processBulb, info, options, capability_cache)
+            for info in bulb_info_list]
+    results = runInOrder(jobs, options.concurrency, options.deadline)
+    for info, (output, error) in zip(bulb_info_list, results):
+        if error is not None:
+            output = ["Error on bulb at [{}]: {}".format(info['ipaddr'], error)]
+        for line in output:
+            print(line)
 
     sys.exit(0)
 
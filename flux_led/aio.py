@@ -0,0 +1,299 @@
+"""
+asyncio based client for the Flux WiFi LED bulbs.
+
+AsyncWifiLedBulb speaks the same protocol as WifiLedBulb but uses asyncio
+streams instead of blocking sockets, so a single event loop can drive many
+bulbs at once:
+
+    bulb = await AsyncWifiLedBulb.create("192.168.1.100")
+    await bulb.setRgb(255, 0, 0)
+    await bulb.turnOn()
+
+This module needs python 3.5 or later and is not imported by the package
+itself; import it as flux_led.aio.
+
+The connection is kept open between commands and is only re-established
+when a send fails or the bulb closes it.
+"""
+
+import asyncio
+import socket
+
+from .__main__ import FRAME_LENGTHS, _BulbProtocol, utils
+
+
+class AsyncWifiLedBulb(_BulbProtocol):
+    def __init__(self, ipaddr, port=5577, timeout=5, capabilities=None,
+                 retry_policy=None):
+        # nothing is sent here, that is left to connect()/update_state()
+        super().__init__(ipaddr, port, timeout, None, retry_policy)
+
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+        if capabilities is not None:
+            self._apply_capabilities(capabilities)
+
+    @classmethod
+    async def create(cls, ipaddr, port=5577, timeout=5, capabilities=None,
+                     retry_policy=None):
+        """Connect to a bulb and fetch its state, like WifiLedBulb()."""
+        bulb = cls(ipaddr, port, timeout, capabilities, retry_policy)
+        await bulb.connect(bulb.retry_policy.retries)
+        await bulb.update_state()
+        return bulb
+
+    def _get_lock(self):
+        # created lazily so the lock binds to the loop that is running
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def connected(self):
+        return self._writer is not None
+
+    async def _retry(self, method, attempts):
+        # WifiLedBulb._retry, but waiting without blocking the loop
+        delay = attempts.next_delay()
+        if delay is None:
+            return False
+        if self.observer is not None:
+            self._emit("retry", method=method,
+                       retries_left=attempts.retries_left, delay=delay)
+        await asyncio.sleep(delay)
+        return True
+
+    async def connect(self, retry=0):
+        attempts = self.retry_policy.start(retry)
+        while True:
+            self.close()
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.ipaddr, self.port),
+                    self.timeout)
+                break
+            except (socket.error, asyncio.TimeoutError):
+                self._reader = self._writer = None
+                if not await self._retry("connect", attempts):
+                    return
+        sock = self._writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self._writer is None:
+            return
+        try:
+            self._writer.close()
+        except socket.error:
+            pass
+        self._reader = self._writer = None
+
+    async def _send_msg(self, bytes):
+        if self._writer is None:
+            await self.connect()
+            if self._writer is None:
+                raise socket.error("Unable to connect to bulb at {}".format(self.ipaddr))
+        # calculate checksum of byte array and add to end; the caller's
+        # buffer is left alone so it can be resent on retry
+        if self._use_csum:
+            bytes = bytearray(bytes)
+            bytes.append(sum(bytes) & 0xFF)
+        self._writer.write(bytes)
+        await self._writer.drain()
+
+    async def _read_msg(self, expected):
+        remaining = expected
+        rx = bytearray()
+        if self._reader is None:
+            return rx
+        while remaining > 0:
+            try:
+                chunk = await asyncio.wait_for(
+                    self._reader.read(remaining), self.timeout)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                # connection closed by the bulb
+                self.close()
+                break
+            if not rx:
+                frame_len = FRAME_LENGTHS.get(chunk[0])
+                if frame_len is not None and frame_len < expected:
+                    remaining = frame_len
+            remaining -= len(chunk)
+            rx.extend(chunk)
+        return rx
+
+    async def _request(self, msg, expected):
+        async with self._get_lock():
+            await self._send_msg(msg)
+            return await self._read_msg(expected)
+
+    async def _send(self, msg):
+        # _send_msg under the lock, so a command isn't written, or the
+        # connection closed, in the middle of another request's reply
+        async with self._get_lock():
+            await self._send_msg(msg)
+
+    async def _determine_query_len(self, attempts=None):
+        # attempts is shared with the caller, see WifiLedBulb
+        if attempts is None:
+            attempts = self.retry_policy.start()
+        while True:
+            # the rest of the reply is read under the same lock, so another
+            # request can't start in the middle of it
+            async with self._get_lock():
+                # determine the type of protocol based of first 2 bytes.
+                await self._send_msg(bytearray([0x81, 0x8a, 0x8b]))
+                rx = await self._read_msg(2)
+                # if any response is recieved, use the default protocol
+                if len(rx) == 2:
+                    self._query_len = 14
+                    # the connection is reused, so drop the rest of the
+                    # state frame
+                    await self._read_msg(self._query_len - 2)
+                    return
+                # if no response from default received, next try the
+                # original protocol
+                await self._send_msg(bytearray([0xef, 0x01, 0x77]))
+                rx = await self._read_msg(2)
+                if len(rx) == 2 and rx[1] == 0x01:
+                    self.protocol = 'LEDENET_ORIGINAL'
+                    self._use_csum = False
+                    self._query_len = 11
+                    await self._read_msg(self._query_len - 2)
+                    return
+            self._use_csum = True
+            # try again only if neither probe was answered
+            if len(rx) == 2 or not await self._retry(
+                    "_determine_query_len", attempts):
+                return
+
+    async def query_state(self, retry=None, led_type=None):
+        return await self._query_state(self.retry_policy.start(retry),
+                                       led_type)
+
+    async def _query_state(self, attempts, led_type=None):
+        if self._query_len == 0:
+            await self._determine_query_len(attempts)
+            if self._query_len == 0:
+                self._is_on = False
+                return
+
+        if self.protocol == 'LEDENET_ORIGINAL':
+            led_type = 'LEDENET_ORIGINAL'
+        msg = self._query_msg(led_type)
+
+        while True:
+            try:
+                rx = await self._request(msg, self._query_len)
+            except socket.error:
+                self.close()
+                if not await self._retry("query_state", attempts):
+                    self._is_on = False
+                    return
+                continue
+            if len(rx) < self._query_len:
+                # a partial frame leaves the stream out of step; start over
+                self.close()
+                if not await self._retry("query_state", attempts):
+                    self._is_on = False
+                    return rx
+                continue
+            return rx
+
+    async def update_state(self, retry=None):
+        attempts = self.retry_policy.start(retry)
+        while True:
+            rx = await self._query_state(self.retry_policy.start(
+                attempts.retries_left, attempts.deadline))
+            if rx is None or len(rx) < self._query_len:
+                self._is_on = False
+                return
+            if self._process_state_response(rx):
+                return
+            if not await self._retry("update_state", attempts):
+                return
+
+    async def refreshState(self):
+        return await self.update_state()
+
+    async def _send_command(self, name, msg, retry):
+        attempts = self.retry_policy.start(retry)
+        while True:
+            async with self._get_lock():
+                try:
+                    await self._send_msg(msg)
+                    return True
+                except socket.error:
+                    self.close()
+            if not await self._retry(name, attempts):
+                return False
+
+    async def _change_state(self, retry, turn_on=True):
+        sent = await self._send_command("_change_state",
+                                        self._power_msg(turn_on), retry)
+        if not sent:
+            self._is_on = False
+
+    async def turnOn(self, retry=None):
+        self._is_on = True
+        await self._change_state(retry, turn_on=True)
+
+    async def turnOff(self, retry=None):
+        self._is_on = False
+        await self._change_state(retry, turn_on=False)
+
+    async def setRgbw(self, r=None, g=None, b=None, w=None, persist=True,
+                      brightness=None, retry=None, w2=None):
+        msg = self._rgbw_msg(r, g, b, w, persist, brightness, w2)
+        await self._send_command("setRgbw", msg, retry)
+
+    async def setRgb(self, r, g, b, persist=True, brightness=None, retry=None):
+        await self.setRgbw(r, g, b, persist=persist, brightness=brightness,
+                           retry=retry)
+
+    async def setWarmWhite(self, level, persist=True, retry=None):
+        await self.setWarmWhite255(utils.percentToByte(level), persist, retry)
+
+    async def setWarmWhite255(self, level, persist=True, retry=None):
+        await self.setRgbw(w=level, persist=persist, brightness=None,
+                           retry=retry)
+
+    async def setColdWhite(self, level, persist=True, retry=None):
+        await self.setColdWhite255(utils.percentToByte(level), persist, retry)
+
+    async def setColdWhite255(self, level, persist=True, retry=None):
+        await self.setRgbw(persist=persist, brightness=None, retry=retry,
+                           w2=level)
+
+    async def setWhiteTemperature(self, temperature, brightness, persist=True,
+                                  retry=None):
+        warm, cold = self._white_levels(temperature, brightness)
+        await self.setRgbw(w=warm, w2=cold, persist=persist, retry=retry)
+
+    async def setPresetPattern(self, pattern, speed):
+        await self._send(self._preset_msg(pattern, speed))
+
+    async def setCustomPattern(self, rgb_list, speed, transition_type):
+        msg = self._custom_msg(rgb_list, speed, transition_type)
+        if msg is not None:
+            await self._send(msg)
+
+    async def getClock(self):
+        rx = await self._request(bytearray([0x11, 0x1a, 0x1b, 0x0f]), 12)
+        return self._parse_clock(rx)
+
+    async def setClock(self):
+        await self._send(self._clock_msg())
+
+    async def getTimers(self):
+        rx = await self._request(bytearray([0x22, 0x2a, 0x2b, 0x0f]), 88)
+        return self._parse_timers(rx)
+
+    async def sendTimers(self, timer_list):
+        # not sure what the resp is, prob some sort of ack?
+        await self._request(self._timers_msg(timer_list), 4)
@@ -0,0 +1,149 @@
+"""
+Wire format of the commands that are sent most often.
+
+The encoders here fill preallocated templates and return a memoryview of
+the message body, so building a message allocates nothing.  Each thread
+has its own set of templates, which makes a view valid until the same
+thread encodes another message of that kind; copy it with bytearray() to
+keep it for longer.
+
+The checksum isn't part of the body.  send() adds it with a scatter/gather
+write of the body and a preallocated checksum byte, which goes out as
+a single packet without the body being copied or changed.
+"""
+
+import threading
+
+# one preallocated byte string for each possible checksum
+CHECKSUM_BYTES = [bytes(bytearray([i])) for i in range(256)]
+
+POWER_ON = b'\x71\x23\x0f'
+POWER_OFF = b'\x71\x24\x0f'
+# the original LEDENET protocol
+POWER_ON_ORIGINAL = b'\xcc\x23\x33'
+POWER_OFF_ORIGINAL = b'\xcc\x24\x33'
+
+_local = threading.local()
+
+
+class _Templates():
+    __slots__ = ('rgbw', 'rgbw_view', 'ledenet', 'ledenet_view',
+                 'original', 'original_view', 'preset', 'preset_view')
+
+    def __init__(self):
+        #  0  1  2  3  4  5  6
+        # 31 90 fa 77 00 00 0f
+        #  |  |  |  |  |  |  |
+        #  |  |  |  |  |  |  terminator
+        #  |  |  |  |  |  write mask
+        #  |  |  |  |  white
+        #  |  |  |  blue
+        #  |  |  green
+        #  |  red
+        #  persistence (31 for true / 41 for false)
+        self.rgbw = bytearray([0x31, 0, 0, 0, 0, 0, 0x0f])
+        # as above, with the cold white level before the write mask
+        self.ledenet = bytearray([0x31, 0, 0, 0, 0, 0, 0, 0x0f])
+        # 56 r g b aa, and no checksum
+        self.original = bytearray([0x56, 0, 0, 0, 0xaa])
+        # 61 pattern delay 0f
+        self.preset = bytearray([0x61, 0, 0, 0x0f])
+        self.rgbw_view = memoryview(self.rgbw)
+        self.ledenet_view = memoryview(self.ledenet)
+        self.original_view = memoryview(self.original)
+        self.preset_view = memoryview(self.preset)
+
+
+def _templates():
+    # only reached the first time a thread encodes anything
+    _local.templates = _Templates()
+    return _local.templates
+
+
+def checksum(data):
+    return sum(data) & 0xFF
+
+
+def rgbw(r, g, b, w, w2, persist, protocol, rgbwprotocol):
+    """Encode a colour/white message; see WifiLedBulb.setRgbw.
+
+    Levels that are None are sent as 0 and, unless the device always
+    writes colours and whites together (rgbwprotocol), left out of the
+    write mask.
+    """
+    try:
+        templates = _local.templates
+    except AttributeError:
+        templates = _templates()
+    if protocol == 'LEDENET_ORIGINAL':
+        msg = templates.original
+        msg[1] = int(r)
+        msg[2] = int(g)
+        msg[3] = int(b)
+        return templates.original_view
+
+    # write mask, default to writing color and whites simultaneously
+    write_mask = 0x00
+    if not rgbwprotocol:
+        if w is None and w2 is None:
+            # Mask out whites
+            write_mask = 0xf0
+        elif r is None and g is None and b is None:
+            # Mask out colors
+            write_mask = 0x0f
+
+    if protocol == 'LEDENET':
+        msg = templates.ledenet
+        view = templates.ledenet_view
+        # a single white level is used for both outputs
+        if w2 is None:
+            w2 = w
+        msg[5] = 0 if w2 is None else int(w2)
+        msg[6] = write_mask
+    else:
+        msg = templates.rgbw
+        view = templates.rgbw_view
+        msg[5] = write_mask
+    msg[0] = 0x31 if persist else 0x41
+    msg[1] = 0 if r is None else int(r)
+    msg[2] = 0 if g is None else int(g)
+    msg[3] = 0 if b is None else int(b)
+    msg[4] = 0 if w is None else int(w)
+    return view
+
+
+def power(turn_on, protocol):
+    if protocol == 'LEDENET_ORIGINAL':
+        return POWER_ON_ORIGINAL if turn_on else POWER_OFF_ORIGINAL
+    return POWER_ON if turn_on else POWER_OFF
+
+
+def preset(pattern, delay):
+    try:
+        templates = _local.templates
+    except AttributeError:
+        templates = _templates()
+    templates.preset[1] = pattern
+    templates.preset[2] = delay
+    return templates.preset_view
+
+
+def send(sock, body, use_csum=True):
+    """Send a message body, followed by its checksum if use_csum is set.
+
+    Returns once everything has been handed to the socket, like sendall().
+    """
+    if not use_csum:
+        sock.sendall(body)
+        return
+    csum = CHECKSUM_BYTES[sum(body) & 0xFF]
+    try:
+        sendmsg = sock.sendmsg
+    except AttributeError:
+        # no scatter/gather (e.g. Windows), so join them
+        sock.sendall(bytes(body) + csum)
+        return
+    sent = sendmsg((body, csum))
+    if sent <= len(body):
+        # a short write; rare enough that joining the rest is fine
+        sock.sendall((bytes(body) + csum)[sent:])
@@ -0,0 +1,244 @@
+"""
+Colour effects computed for many bulbs at once.
+
+Each effect works out one frame, a colour per bulb, in a single call:
+
+    frame = effects.rainbow(len(bulbs), offset=time.time() / 10)
+    effects.send_frame(bulbs, frame)
+
+When numpy is installed the colour maths (HSV conversion, brightness
+scaling, easing) is done on whole arrays and the command frames are built
+as one block of bytes; a frame is then an array with a row of (r, g, b)
+per bulb.  Without numpy the same results come from plain python, and a
+frame is a list of (r, g, b) tuples.  Either kind can be passed to
+encode_frame() and send_frame().
+
+This module is not imported by the package itself; import it as
+flux_led.effects.
+"""
+
+import colorsys
+
+from .__main__ import BulbResult, Transition
+
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
+
+
+def _easing(easing):
+    if callable(easing):
+        return easing
+    try:
+        return Transition.EASINGS[easing]
+    except KeyError:
+        raise ValueError("Unknown easing: {}".format(easing))
+
+
+def _clip(level):
+    # int() truncates, as the bulb's own message builder does
+    return min(max(int(level), 0), 255)
+
+
+def hsv_to_rgb(h, s, v):
+    """Convert hue and saturation (0-1) and value (0-255) to a frame.
+
+    The arguments may be sequences, one entry per bulb, or single numbers
+    applied to all of them.
+    """
+    if numpy_available:
+        h, s, v = numpy.broadcast_arrays(
+            numpy.asarray(h, dtype=float), numpy.asarray(s, dtype=float),
+            numpy.asarray(v, dtype=float))
+        h6 = (h % 1.0) * 6.0
+        i = numpy.floor(h6).astype(int) % 6
+        f = h6 - numpy.floor(h6)
+        p = v * (1.0 - s)
+        q = v * (1.0 - s * f)
+        t = v * (1.0 - s * (1.0 - f))
+        r = numpy.choose(i, [v, q, p, p, t, v])
+        g = numpy.choose(i, [t, v, v, q, p, p])
+        b = numpy.choose(i, [p, p, t, v, v, q])
+        rgb = numpy.stack([r, g, b], axis=-1)
+        return numpy.clip(rgb, 0, 255).astype(numpy.uint8).reshape(-1, 3)
+
+    lengths = [len(x) for x in (h, s, v) if hasattr(x, '__len__')]
+    count = max(lengths) if lengths else 1
+    h, s, v = [x if hasattr(x, '__len__') else [x] * count for x in (h, s, v)]
+    return [tuple(_clip(c) for c in colorsys.hsv_to_rgb(h[i] % 1.0, s[i], v[i]))
+            for i in range(count)]
+
+
+def rgb_to_hsv(frame):
+    """Split a frame into hue and saturation (0-1) and value (0-255)."""
+    if numpy_available:
+        rgb = numpy.asarray(frame, dtype=float).reshape(-1, 3)
+        r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+        maxc = rgb.max(axis=1)
+        minc = rgb.min(axis=1)
+        delta = maxc - minc
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            s = numpy.where(maxc > 0, delta / maxc, 0.0)
+            rc = numpy.where(delta > 0, (maxc - r) / delta, 0.0)
+            gc = numpy.where(delta > 0, (maxc - g) / delta, 0.0)
+            bc = numpy.where(delta > 0, (maxc - b) / delta, 0.0)
+        h = numpy.select([r == maxc, g == maxc], [bc - gc, 2.0 + rc - bc],
+                         4.0 + gc - rc)
+        h = numpy.where(delta > 0, (h / 6.0) % 1.0, 0.0)
+        return h, s, maxc
+
+    hsv = [colorsys.rgb_to_hsv(*color[:3]) for color in frame]
+    return ([x[0] for x in hsv], [x[1] for x in hsv], [x[2] for x in hsv])
+
+
+def scale_brightness(frame, level):
+    """Set the brightness (HSV value, 0-255) of every colour in a frame.
+
+    level is a single number or one per bulb.  Gives the same colours as
+    the brightness argument of WifiLedBulb.setRgb.
+    """
+    h, s, v = rgb_to_hsv(frame)
+    return hsv_to_rgb(h, s, level)
+
+
+def blend(start, end, progress, easing="linear"):
+    """Colours part way from the frame start to the frame end.
+
+    progress runs from 0 (start) to 1 (end), and may be given per bulb.
+    """
+    ease = _easing(easing)
+    if numpy_available:
+        start = numpy.asarray(start, dtype=float).reshape(-1, 3)
+        end = numpy.asarray(end, dtype=float).reshape(-1, 3)
+        amount = ease(numpy.clip(numpy.asarray(progress, dtype=float), 0, 1))
+        amount = numpy.broadcast_to(amount, (len(start),))[:, None]
+        rgb = numpy.rint(start + (end - start) * amount)
+        return numpy.clip(rgb, 0, 255).astype(numpy.uint8)
+
+    if not hasattr(progress, '__len__'):
+        progress = [progress] * len(start)
+    frame = []
+    for a, b, p in zip(start, end, progress):
+        amount = ease(min(max(p, 0.0), 1.0))
+        frame.append(tuple(_clip(round(x + (y - x) * amount))
+                           for x, y in zip(a[:3], b[:3])))
+    return frame
+
+
+def gradient(count, start, end, easing="linear"):
+    """A frame fading from the colour start on the first bulb to end on the last."""
+    if count < 2:
+        positions = [0.0] * count
+    else:
+        positions = [i / float(count - 1) for i in range(count)]
+    return blend([start] * count, [end] * count, positions, easing)
+
+
+def rainbow(count, offset=0.0, saturation=1.0, value=255):
+    """A frame with the hues spread evenly over the bulbs.
+
+    offset (0-1) turns the wheel; move it over time to make the colours run.
+    """
+    if numpy_available:
+        hues = offset + numpy.arange(count) / float(max(count, 1))
+    else:
+        hues = [offset + i / float(max(count, 1)) for i in range(count)]
+    return hsv_to_rgb(hues, saturation, value)
+
+
+def breathe(frame, phase, low=0.1, easing="ease_in_out"):
+    """The colours of frame, dimmed and brightened in a slow pulse.
+
+    phase (0-1) is the position in the pulse: full brightness at 0, at its
+    dimmest, low times the brightness, at 0.5.  It may be given per bulb.
+    """
+    ease = _easing(easing)
+    if numpy_available:
+        phase = numpy.asarray(phase, dtype=float) % 1.0
+        level = low + (1.0 - low) * ease(numpy.abs(1.0 - 2.0 * phase))
+        h, s, v = rgb_to_hsv(frame)
+        return hsv_to_rgb(h, s, v * level)
+
+    h, s, v = rgb_to_hsv(frame)
+    if not hasattr(phase, '__len__'):
+        phase = [phase] * len(v)
+    levels = [v[i] * (low + (1.0 - low) * ease(abs(1.0 - 2.0 * (phase[i] % 1.0))))
+              for i in range(len(v))]
+    return hsv_to_rgb(h, s, levels)
+
+
+def encode_frame(bulbs, frame, persist=False):
+    """Build the colour command for each bulb, without the checksum.
+
+    Returns a bytearray per bulb, as WifiLedBulb.setRgb would send for the
+    colour in the same row of the frame.  The bulbs' protocols must already
+    be known, i.e. they have been connected to or given capabilities.
+    """
+    if not numpy_available:
+        # copied, _rgbw_view reuses its buffer
+        return [bytearray(bulb._rgbw_view(color[0], color[1], color[2],
+                                          persist=persist))
+                for bulb, color in zip(bulbs, frame)]
+
+    rgb = numpy.asarray(frame, dtype=numpy.uint8).reshape(-1, 3)
+    count = len(bulbs)
+    # every layout fits in 8 columns:
+    #   original:  56 r g b aa
+    #   default:   31/41 r g b 00 mask 0f
+    #   LEDENET:   31/41 r g b 00 00 mask 0f
+    rows = numpy.zeros((count, 8), dtype=numpy.uint8)
+    rows[:, 0] = 0x31 if persist else 0x41
+    rows[:, 1:4] = rgb[:count]
+    lengths = []
+    for i, bulb in enumerate(bulbs):
+        mask = 0x00 if bulb.rgbwprotocol else 0xf0
+        if bulb.protocol == 'LEDENET_ORIGINAL':
+            rows[i, 0] = 0x56
+            rows[i, 4] = 0xaa
+            lengths.append(5)
+        elif bulb.protocol == 'LEDENET':
+            rows[i, 6] = mask
+            rows[i, 7] = 0x0f
+            lengths.append(8)
+        else:
+            rows[i, 5] = mask
+            rows[i, 6] = 0x0f
+            lengths.append(7)
+    data = rows.tobytes()
+    return [bytearray(data[i * 8:i * 8 + length])
+            for i, length in enumerate(lengths)]
+
+
+def send_frame(bulbs, frame, persist=False):
+    """Send a frame, one colour per bulb.
+
+    Returns a BulbResult per bulb; a bulb that fails doesn't stop the rest.
+    Bulbs created with coalesce=True queue the colour as setRgb does.
+    flux_led.reactor bulbs are all sent their colour before any of them is
+    waited for.
+    """
+    bulbs = list(bulbs)
+    errors = [None] * len(bulbs)
+    for i, bulb in enumerate(bulbs):
+        try:
+            bulb._ensure_initialized()
+        except Exception as e:
+            errors[i] = e
+    messages = encode_frame(bulbs, frame, persist)
+    pending = {}
+    for i, bulb in enumerate(bulbs):
+        if errors[i] is None:
+            try:
+                # reactor bulbs return a future
+                pending[i] = bulb._send_command("color", messages[i])
+            except Exception as e:
+                errors[i] = e
+    for i, future in pending.items():
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                errors[i] = e
+    return [BulbResult(bulb, error=errors[i]) for i, bulb in enumerate(bulbs)]
@@ -0,0 +1,677 @@
+"""
+Drive any number of bulbs from a single thread, without asyncio.
+
+A Reactor is one thread that owns the sockets of all its bulbs and waits on
+them together with selectors.  ReactorBulb has the commands of WifiLedBulb,
+but each call only queues the command for the reactor and returns a
+concurrent.futures.Future:
+
+    reactor = Reactor()
+    bulbs = [ReactorBulb(ip, reactor=reactor) for ip in addresses]
+    concurrent.futures.wait([bulb.update_state() for bulb in bulbs])
+    futures = [bulb.setRgb(255, 0, 0) for bulb in bulbs]
+    ...
+    reactor.close()
+
+A bulb runs its commands one at a time, in the order they were made, over a
+single connection that is kept open and re-established when needed.
+Different bulbs run at the same time, so a thousand bulbs cost one thread
+rather than a thousand.
+
+A command's future raises socket.error if the bulb can't be reached once
+the retries are used up.  update_state()'s future gives the new BulbState,
+or None if the bulb didn't answer, the same case in which WifiLedBulb only
+marks the bulb as off; query_state()'s gives the raw state frame.
+Observers are called from the reactor thread.
+
+This module is not imported by the package itself; import it as
+flux_led.reactor.
+"""
+
+import collections
+import concurrent.futures
+import errno
+import heapq
+import itertools
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from .__main__ import FRAME_LENGTHS, _BulbProtocol, utils
+from . import codec
+
+_LOGGER = logging.getLogger(__name__)
+
+# The steps a command takes, yielded by the command generators to the
+# reactor:
+#   (_CONNECT,)                close and reconnect; sends back None
+#   (_CLOSE,)                  close the connection; sends back None
+#   (_SEND, msg, expected)     send msg, then read a reply of up to
+#                              `expected` bytes (none if 0); sends back the
+#                              reply, which is short if the bulb didn't
+#                              finish it in time
+#   (_WAIT, seconds)           do nothing for a while; sends back None
+# If the bulb can't be reached the reactor throws socket.error into the
+# generator instead.
+_CONNECT = 0
+_SEND = 1
+_CLOSE = 2
+_WAIT = 3
+
+
+class _Channel():
+    """A bulb's connection and command queue; only used by the reactor."""
+
+    def __init__(self, bulb):
+        self.bulb = bulb
+        self.sock = None
+        self.connecting = False
+        self.commands = collections.deque()
+        self.command = None
+        self.future = None
+        # the step waiting for the connection, the read in progress, or
+        # a wait
+        self.step = None
+        self.out = b''
+        self.reading = False
+        self.rx = None
+        self.expected = 0
+        self.remaining = 0
+        self.started = 0
+        # bumped whenever a wait ends, so stale timers can be told apart
+        self.token = 0
+
+
+class Reactor():
+    """A thread that does the network I/O for any number of ReactorBulbs.
+
+    The thread starts with the reactor and runs until close().
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ, None)
+        self._lock = threading.Lock()
+        self._submitted = collections.deque()
+        self._channels = set()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="flux_led reactor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def shared(cls):
+        """Return the process wide reactor, creating it if needed."""
+        with cls._shared_lock:
+            if cls._shared is None or cls._shared._closed:
+                cls._shared = cls()
+            return cls._shared
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Stop the thread and close every bulb's connection.
+
+        Commands that haven't finished are cancelled.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._wake()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def submit(self, bulb, command):
+        """Queue a command generator for bulb and return its future."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Reactor is closed")
+            self._submitted.append((bulb, command, future))
+        self._wake()
+        return future
+
+    def _wake(self):
+        try:
+            self._waker.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # already more wake ups pending than the reactor needs
+            pass
+        except socket.error:
+            pass
+
+    def _run(self):
+        try:
+            while not self._closed:
+                timeout = None
+                if self._timers:
+                    timeout = max(self._timers[0][0] - time.monotonic(), 0)
+                for key, events in self._selector.select(timeout):
+                    channel = key.data
+                    if channel is None:
+                        self._drain_wakeups()
+                        continue
+                    if events & selectors.EVENT_WRITE:
+                        self._on_writable(channel)
+                    if events & selectors.EVENT_READ and channel.sock is not None:
+                        self._on_readable(channel)
+                self._take_submitted()
+                self._run_timers()
+        except Exception:
+            _LOGGER.exception("Bulb reactor stopped")
+        finally:
+            self._shutdown()
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _take_submitted(self):
+        while self._submitted:
+            bulb, command, future = self._submitted.popleft()
+            channel = bulb._channel
+            self._channels.add(channel)
+            channel.commands.append((command, future))
+            if channel.command is None:
+                self._next_command(channel)
+
+    def _shutdown(self):
+        with self._lock:
+            self._closed = True
+            submitted = list(self._submitted)
+            self._submitted.clear()
+        for bulb, command, future in submitted:
+            command.close()
+            future.cancel()
+        for channel in self._channels:
+            if channel.command is not None:
+                channel.command.close()
+                # it is running, so can't be cancelled
+                channel.future.set_exception(RuntimeError("Reactor is closed"))
+                channel.command = channel.future = None
+            for command, future in channel.commands:
+                command.close()
+                future.cancel()
+            channel.commands.clear()
+            self._disconnect(channel)
+        self._channels.clear()
+        self._selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+    # timers
+
+    def _wait_until(self, channel, seconds):
+        channel.token += 1
+        heapq.heappush(self._timers, (time.monotonic() + seconds,
+                                      next(self._sequence), channel,
+                                      channel.token))
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, channel, token = heapq.heappop(self._timers)
+            if token != channel.token:
+                continue
+            if channel.connecting:
+                self._connection_failed(channel, socket.timeout("timed out"))
+            elif channel.reading:
+                self._finish_read(channel, "timeout")
+            elif channel.step is not None and channel.step[0] == _WAIT:
+                channel.step = None
+                self._resume(channel, None)
+
+    # commands
+
+    def _next_command(self, channel):
+        channel.command = channel.future = None
+        while channel.commands:
+            command, future = channel.commands.popleft()
+            if not future.set_running_or_notify_cancel():
+                command.close()
+                continue
+            channel.command = command
+            channel.future = future
+            self._resume(channel, None)
+            if channel.command is not None:
+                return
+
+    def _resume(self, channel, value, error=None):
+        """Run the current command up to its next step."""
+        try:
+            if error is None:
+                step = channel.command.send(value)
+            else:
+                step = channel.command.throw(error)
+        except StopIteration as e:
+            channel.future.set_result(e.value)
+            self._next_command(channel)
+            return
+        except Exception as e:
+            channel.future.set_exception(e)
+            self._next_command(channel)
+            return
+        self._start_step(channel, step)
+
+    def _start_step(self, channel, step):
+        if step[0] == _CLOSE:
+            self._disconnect(channel)
+            self._resume(channel, None)
+            return
+        if step[0] == _WAIT:
+            channel.step = step
+            self._wait_until(channel, step[1])
+            return
+        if step[0] == _CONNECT:
+            self._disconnect(channel)
+            channel.step = step
+            self._connect(channel)
+            return
+        _, msg, expected = step
+        # encoded now, as codec templates are reused by the next command
+        data = bytes(msg)
+        if channel.bulb._use_csum:
+            data += codec.CHECKSUM_BYTES[sum(data) & 0xFF]
+        channel.step = (_SEND, data, expected)
+        if channel.sock is None:
+            self._connect(channel)
+        elif not channel.connecting:
+            self._write(channel)
+
+    def _connect(self, channel):
+        bulb = channel.bulb
+        channel.started = time.time()
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            bulb._set_keepalive(sock)
+            err = sock.connect_ex((bulb.ipaddr, bulb.port))
+        except socket.error as e:
+            self._connection_failed(channel, e)
+            return
+        channel.sock = sock
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._connection_failed(channel, socket.error(
+                err, "Unable to connect to bulb at {}".format(bulb.ipaddr)))
+            return
+        channel.connecting = True
+        self._selector.register(sock, selectors.EVENT_WRITE, channel)
+        self._wait_until(channel, bulb.timeout)
+
+    def _connection_failed(self, channel, error):
+        bulb = channel.bulb
+        if bulb.observer is not None:
+            bulb._emit("connect", seconds=time.time() - channel.started,
+                       error=error)
+        self._disconnect(channel)
+        channel.step = None
+        self._resume(channel, None, error)
+
+    def _disconnect(self, channel):
+        channel.token += 1
+        channel.connecting = False
+        channel.reading = False
+        channel.out = b''
+        channel.bulb._connected = False
+        sock = channel.sock
+        if sock is None:
+            return
+        channel.sock = None
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+    def _on_writable(self, channel):
+        if channel.connecting:
+            err = channel.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._connection_failed(channel, socket.error(
+                    err, "Unable to connect to bulb at {}".format(
+                        channel.bulb.ipaddr)))
+                return
+            bulb = channel.bulb
+            channel.connecting = False
+            channel.token += 1
+            bulb._connected = True
+            self._selector.modify(channel.sock, selectors.EVENT_READ, channel)
+            if bulb.observer is not None:
+                bulb._emit("connect", seconds=time.time() - channel.started,
+                           error=None)
+            if channel.step[0] == _CONNECT:
+                channel.step = None
+                self._resume(channel, None)
+            else:
+                self._write(channel)
+            return
+        self._write(channel)
+
+    def _write(self, channel):
+        if not channel.out:
+            channel.out = channel.step[1]
+            channel.started = time.time()
+        try:
+            sent = channel.sock.send(channel.out)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except socket.error as e:
+            self._connection_failed(channel, e)
+            return
+        channel.out = channel.out[sent:]
+        if channel.out:
+            # the socket buffer is full, finish once there is room
+            self._selector.modify(channel.sock,
+                                  selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                  channel)
+            return
+        self._selector.modify(channel.sock, selectors.EVENT_READ, channel)
+        bulb = channel.bulb
+        _, data, expected = channel.step
+        if bulb.observer is not None:
+            bulb._emit("send", bytes=len(data),
+                       seconds=time.time() - channel.started)
+        if expected == 0:
+            channel.step = None
+            self._resume(channel, bytearray())
+            return
+        channel.reading = True
+        channel.rx = bytearray()
+        channel.expected = channel.remaining = expected
+        channel.started = time.time()
+        self._wait_until(channel, bulb.timeout)
+
+    def _on_readable(self, channel):
+        if channel.connecting:
+            return
+        try:
+            chunk = channel.sock.recv(channel.remaining if channel.reading
+                                      else 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            chunk = b''
+        if not channel.reading:
+            # nothing was asked for, so it's either the bulb closing the
+            # connection or a stray reply, which is dropped
+            if not chunk:
+                self._disconnect(channel)
+            return
+        if not chunk:
+            self._finish_read(channel, "closed")
+            return
+        if not channel.rx:
+            bulb = channel.bulb
+            if bulb.observer is not None:
+                bulb._emit("first_byte", seconds=time.time() - channel.started)
+            frame_len = FRAME_LENGTHS.get(chunk[0])
+            if frame_len is not None and frame_len < channel.expected:
+                channel.remaining = frame_len
+        channel.remaining -= len(chunk)
+        channel.rx.extend(chunk)
+        if channel.remaining <= 0:
+            self._finish_read(channel, "frame")
+
+    def _finish_read(self, channel, outcome):
+        bulb = channel.bulb
+        rx = channel.rx
+        channel.reading = False
+        channel.rx = None
+        channel.step = None
+        channel.token += 1
+        if outcome != "frame":
+            # a late reply would be taken for the answer to the next
+            # request, so start over on a new connection
+            self._disconnect(channel)
+        if bulb.observer is not None:
+            bulb._emit(outcome, expected=channel.expected, bytes=len(rx),
+                       seconds=time.time() - channel.started)
+        self._resume(channel, rx)
+
+
+class ReactorBulb(_BulbProtocol):
+    """A bulb whose commands run on a Reactor and return futures.
+
+    reactor defaults to the process wide Reactor.shared().  Nothing is
+    sent until the first command; a command that needs to know the
+    device's protocol probes it first, unless capabilities are given.
+    """
+
+    def __init__(self, ipaddr, port=5577, timeout=5, capabilities=None,
+                 observer=None, reactor=None, retry_policy=None):
+        # nothing is sent here, that is left to the reactor
+        super().__init__(ipaddr, port, timeout, observer, retry_policy)
+        self._connected = False
+
+        self.reactor = reactor or Reactor.shared()
+        self._channel = _Channel(self)
+
+        if capabilities is not None:
+            self._apply_capabilities(capabilities)
+
+    def _submit(self, command):
+        return self.reactor.submit(self, command)
+
+    # command generators, run by the reactor
+
+    def _retry_steps(self, method, attempts):
+        # _retry without blocking the reactor thread
+        delay = attempts.next_delay()
+        if delay is None:
+            return False
+        if self.observer is not None:
+            self._emit("retry", method=method,
+                       retries_left=attempts.retries_left, delay=delay)
+        if delay > 0:
+            yield (_WAIT, delay)
+        return True
+
+    def _connect_steps(self, retry):
+        attempts = self.retry_policy.start(retry)
+        while True:
+            try:
+                yield (_CONNECT,)
+                return
+            except socket.error:
+                if not (yield from self._retry_steps("connect", attempts)):
+                    raise
+
+    def _close_steps(self):
+        yield (_CLOSE,)
+
+    def _probe_steps(self):
+        # the default protocol answers the probe with a full state frame,
+        # which is kept as the first reply
+        rx = yield (_SEND, bytearray([0x81, 0x8a, 0x8b]), 14)
+        if len(rx) >= 2:
+            self._query_len = 14
+            return rx
+        rx = yield (_SEND, bytearray([0xef, 0x01, 0x77]), 11)
+        if len(rx) >= 2 and rx[1] == 0x01:
+            self.protocol = 'LEDENET_ORIGINAL'
+            self._use_csum = False
+            self._query_len = 11
+            return rx
+        return None
+
+    def _query_steps(self, led_type=None):
+        try:
+            if self._query_len == 0:
+                rx = yield from self._probe_steps()
+                if self._query_len == 0 or len(rx) == self._query_len:
+                    return rx
+            rx = yield (_SEND, self._query_msg(led_type), self._query_len)
+        except socket.error:
+            return None
+        return rx
+
+    def _query_state_steps(self, retry, led_type):
+        attempts = self.retry_policy.start(retry)
+        while True:
+            rx = yield from self._query_steps(led_type)
+            if rx and len(rx) >= self._query_len:
+                return rx
+            if not (yield from self._retry_steps("query_state", attempts)):
+                self._is_on = False
+                return rx
+
+    def _update_state_steps(self, retry):
+        attempts = self.retry_policy.start(retry)
+        while True:
+            rx = yield from self._query_steps()
+            if (rx and len(rx) >= self._query_len and
+                    self._process_state_response(rx)):
+                return self.state
+            if not (yield from self._retry_steps("update_state", attempts)):
+                self._is_on = False
+                return None
+
+    def _ensure_probed(self):
+        if self._query_len == 0:
+            yield from self._update_state_steps(None)
+            if self._query_len == 0:
+                raise socket.error(
+                    "Unable to reach bulb at {}".format(self.ipaddr))
+
+    def _command_steps(self, name, build, retry):
+        # the message is built here, once the protocol is known; None means
+        # there is nothing to send
+        yield from self._ensure_probed()
+        msg = build()
+        if msg is None:
+            return
+        # copied, as other bulbs' commands run on this thread while a retry
+        # waits
+        msg = bytes(msg)
+        attempts = self.retry_policy.start(retry)
+        while True:
+            try:
+                yield (_SEND, msg, 0)
+                return
+            except socket.error:
+                if not (yield from self._retry_steps(name, attempts)):
+                    raise
+
+    def _request_steps(self, msg, expected, parse):
+        msg = bytes(msg)
+        yield from self._ensure_probed()
+        rx = yield (_SEND, msg, expected)
+        return parse(rx)
+
+    # the commands
+
+    def connect(self, retry=0):
+        return self._submit(self._connect_steps(retry))
+
+    def close(self):
+        """Close the connection once the commands already made are done."""
+        return self._submit(self._close_steps())
+
+    def query_state(self, retry=None, led_type=None):
+        return self._submit(self._query_state_steps(retry, led_type))
+
+    def update_state(self, retry=None):
+        return self._submit(self._update_state_steps(retry))
+
+    def refreshState(self):
+        return self.update_state()
+
+    def turnOn(self, retry=None):
+        self._is_on = True
+        return self._submit(self._command_steps(
+            "turnOn", lambda: self._power_msg(True), retry))
+
+    def turnOff(self, retry=None):
+        self._is_on = False
+        return self._submit(self._command_steps(
+            "turnOff", lambda: self._power_msg(False), retry))
+
+    def setRgbw(self, r=None, g=None, b=None, w=None, persist=True,
+                brightness=None, retry=None, w2=None):
+        return self._submit(self._command_steps(
+            "setRgbw",
+            lambda: self._rgbw_msg(r, g, b, w, persist, brightness, w2),
+            retry))
+
+    def setRgb(self, r, g, b, persist=True, brightness=None, retry=None):
+        return self.setRgbw(r, g, b, persist=persist, brightness=brightness,
+                            retry=retry)
+
+    def setWarmWhite(self, level, persist=True, retry=None):
+        return self.setWarmWhite255(utils.percentToByte(level), persist, retry)
+
+    def setWarmWhite255(self, level, persist=True, retry=None):
+        return self.setRgbw(w=level, persist=persist, brightness=None,
+                            retry=retry)
+
+    def setColdWhite(self, level, persist=True, retry=None):
+        return self.setColdWhite255(utils.percentToByte(level), persist, retry)
+
+    def setColdWhite255(self, level, persist=True, retry=None):
+        return self.setRgbw(persist=persist, brightness=None, retry=retry,
+                            w2=level)
+
+    def setWhiteTemperature(self, temperature, brightness, persist=True,
+                            retry=None):
+        warm, cold = self._white_levels(temperature, brightness)
+        return self.setRgbw(w=warm, w2=cold, persist=persist, retry=retry)
+
+    def setPresetPattern(self, pattern, speed):
+        return self._submit(self._command_steps(
+            "setPresetPattern", lambda: self._preset_msg(pattern, speed), 0))
+
+    def setCustomPattern(self, rgb_list, speed, transition_type):
+        return self._submit(self._command_steps(
+            "setCustomPattern",
+            lambda: self._custom_msg(rgb_list, speed, transition_type), 0))
+
+    def getClock(self):
+        return self._submit(self._request_steps(
+            bytearray([0x11, 0x1a, 0x1b, 0x0f]), 12, self._parse_clock))
+
+    def setClock(self):
+        return self._submit(self._command_steps("setClock", self._clock_msg,
+                                                0))
+
+    def getTimers(self):
+        return self._submit(self._request_steps(
+            bytearray([0x22, 0x2a, 0x2b, 0x0f]), 88, self._parse_timers))
+
+    def sendTimers(self, timer_list):
+        # not sure what the resp is, prob some sort of ack?
+        return self._submit(self._request_steps(
+            self._timers_msg(timer_list), 4, lambda rx: None))
+
+    # what effects.send_frame needs, which builds the messages itself;
+    # these block, so not for the reactor thread
+
+    def _ensure_initialized(self):
+        if self._query_len == 0:
+            self.update_state().result()
+            if self._query_len == 0:
+                raise socket.error(
+                    "Unable to reach bulb at {}".format(self.ipaddr))
+
+    def _send_command(self, kind, msg):
+        # the future is for the caller to wait on
+        return self._submit(self._command_steps(kind, lambda: msg, 0))
@@ -0,0 +1,590 @@
+"""
+Simulated Flux WiFi LED bulbs for tests and benchmarks.
+
+A BulbSimulator runs any number of VirtualBulbs on the loopback interface
+from a single thread.  Each virtual bulb listens on its own TCP port and
+answers the same frames a real device does:
+
+* state queries (0x81 frames, or 0xef for the original LEDENET protocol)
+* colour/white changes (0x31/0x41, or 0x56 for the original protocol)
+* power (0x71, or 0xcc for the original protocol)
+* preset and custom patterns (0x61, 0x51)
+* timers (0x22 to read, 0x21 to write) and the clock (0x11 to read,
+  0x10 to write)
+
+A UDP responder answers the HF-A11ASSISTHREAD discovery probe for all of
+the simulator's bulbs.
+
+    with BulbSimulator() as sim:
+        virtual = sim.add_bulb()
+        bulb = WifiLedBulb(virtual.ipaddr, virtual.port)
+
+The simulator can also be run on its own, for benchmarking a client in
+another process:
+
+    python -m flux_led.simulator --count 1000
+
+Bad networks can be reproduced by giving bulbs a FaultProfile, which adds
+latency, frame loss, fragmented or truncated replies, connection resets and
+refused connections:
+
+    faults = FaultProfile(latency=0.05, jitter=0.2, loss=0.01, seed=1)
+    sim.add_bulbs(100, faults=faults)
+"""
+
+from __future__ import print_function
+import datetime
+import errno
+import heapq
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+from optparse import OptionParser
+
+from .__main__ import BulbScanner, LedTimer
+
+# state frame type bytes for some known devices
+DEVICE_RGB = 0x45           # RGB with a separate warm white mode
+DEVICE_RGBW = 0x33          # RGBW, colours and white written together
+DEVICE_RGBWW = 0x25         # RGB + warm white + cold white (LEDENET)
+DEVICE_ORIGINAL = 0x01      # original LEDENET protocol, no checksums
+
+_LEDENET_TYPES = (0x25, 0x27, 0x35)
+_RGBW_TYPES = (0x04, 0x25, 0x33, 0x81, 0x44)
+
+
+def _checksum(frame):
+    return sum(frame) & 0xFF
+
+
+class FaultProfile():
+    """Network faults applied to a virtual bulb.
+
+    latency is the base delay in seconds before each reply is sent; jitter
+    adds up to that many seconds more, drawn from an exponential
+    distribution so that most replies are quick and a few are very late.
+    For any other distribution pass a callable as latency; it is called
+    with the profile's random.Random and returns the delay.
+
+    The remaining arguments are probabilities between 0 and 1:
+
+    * loss: an incoming frame is dropped without being handled
+    * fragment: a reply is sent in two pieces, fragment_delay seconds apart
+    * truncate: only the first part of a reply is sent
+    * reset: the connection is reset (RST) when data arrives
+    * refuse: a new connection is reset as soon as it is accepted
+
+    Replies on a connection are never reordered, however the delays fall.
+    Pass seed to make a run reproducible.
+    """
+
+    def __init__(self, latency=0, jitter=0, loss=0, fragment=0,
+                 fragment_delay=0.05, truncate=0, reset=0, refuse=0,
+                 seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.fragment = fragment
+        self.fragment_delay = fragment_delay
+        self.truncate = truncate
+        self.reset = reset
+        self.refuse = refuse
+        self.random = random.Random(seed)
+
+    def delay(self):
+        """Seconds to hold back the next reply."""
+        if callable(self.latency):
+            return max(self.latency(self.random), 0)
+        delay = self.latency
+        if self.jitter:
+            delay += min(self.random.expovariate(3.0 / self.jitter), self.jitter)
+        return delay
+
+    def hit(self, probability):
+        return probability > 0 and self.random.random() < probability
+
+
+class VirtualBulb():
+    """The state and protocol handling of one simulated device."""
+
+    def __init__(self, bulb_id, device_type=DEVICE_RGBW,
+                 model="HF-LPB100-ZJ200", ipaddr="127.0.0.1"):
+        self.id = bulb_id
+        self.device_type = device_type
+        self.model = model
+        self.ipaddr = ipaddr
+        self.port = None
+
+        self.is_on = True
+        self.pattern = 0x61
+        self.delay = 0x10
+        self.red = 255
+        self.green = 255
+        self.blue = 255
+        self.warm_white = 0
+        self.cold_white = 0
+        self.color_mode = 0xf0
+        self.timers = [LedTimer().toBytes() for i in range(6)]
+        self.clock_offset = datetime.timedelta(0)
+
+        # counters, handy for tests and benchmarks
+        self.frames = 0
+        self.persistent_writes = 0
+        self.frames_lost = 0
+        self.resets = 0
+        self.refused = 0
+
+        self.faults = None
+
+    @property
+    def original(self):
+        return self.device_type == DEVICE_ORIGINAL
+
+    @property
+    def rgbwcapable(self):
+        return self.device_type in _RGBW_TYPES
+
+    def _frame_length(self, head):
+        """Length of an incoming frame, by its first byte.  None if unknown."""
+        if self.original:
+            return {0xef: 3, 0x56: 5, 0xcc: 3}.get(head)
+        if head in (0x31, 0x41):
+            if self.device_type in _LEDENET_TYPES:
+                return 9
+            return 8
+        return {0x81: 4, 0x71: 4, 0x61: 5, 0x51: 70, 0x22: 5, 0x21: 88,
+                0x11: 5, 0x10: 12}.get(head)
+
+    def feed(self, buf):
+        """Handle the complete frames at the start of buf.
+
+        Returns the number of bytes used and the bytes to send back.
+        """
+        used = 0
+        replies = bytearray()
+        while used < len(buf):
+            length = self._frame_length(buf[used])
+            if length is None:
+                # not a frame we know, skip a byte and try to resync
+                used += 1
+                continue
+            if len(buf) - used < length:
+                break
+            frame = buf[used:used + length]
+            used += length
+            if not self.original and frame[-1] != _checksum(frame[:-1]):
+                continue
+            if self.faults is not None and self.faults.hit(self.faults.loss):
+                self.frames_lost += 1
+                continue
+            self.frames += 1
+            reply = self.handle(frame)
+            if reply:
+                replies.extend(reply)
+        return used, bytes(replies)
+
+    def handle(self, frame):
+        """Apply a single frame and return the reply, if any."""
+        head = frame[0]
+        if head == 0x81 or head == 0xef:
+            return self.state_frame()
+        elif head in (0x31, 0x41):
+            if head == 0x31:
+                self.persistent_writes += 1
+            self._set_levels(frame)
+        elif head == 0x56:
+            self.red, self.green, self.blue = frame[1], frame[2], frame[3]
+            self.pattern = 0x41
+        elif head == 0x71 or head == 0xcc:
+            self.is_on = frame[1] == 0x23
+        elif head == 0x61:
+            self.pattern = frame[1]
+            self.delay = frame[2]
+        elif head == 0x51:
+            self.pattern = 0x60
+            self.delay = frame[65]
+        elif head == 0x22:
+            return self.timers_frame()
+        elif head == 0x21:
+            self.timers = [bytearray(frame[1 + i * 14:15 + i * 14]) for i in range(6)]
+            return self._with_checksum(bytearray([0x0f, 0x21, 0x0f]))
+        elif head == 0x11:
+            return self.clock_frame()
+        elif head == 0x10:
+            try:
+                device_time = datetime.datetime(frame[2] + 2000, frame[3], frame[4],
+                                                frame[5], frame[6], frame[7])
+                self.clock_offset = device_time - datetime.datetime.now()
+            except ValueError:
+                pass
+        return None
+
+    def _set_levels(self, frame):
+        if self.device_type in _LEDENET_TYPES:
+            r, g, b, w, w2, mask = frame[1:7]
+        else:
+            r, g, b, w, mask = frame[1:6]
+            w2 = self.cold_white
+        self.pattern = 0x61
+        if mask in (0x00, 0xf0):
+            self.red, self.green, self.blue = r, g, b
+        if mask in (0x00, 0x0f):
+            self.warm_white, self.cold_white = w, w2
+        if not self.rgbwcapable:
+            # these devices show either colours or white, not both
+            if mask == 0xf0:
+                self.warm_white = 0
+            elif mask == 0x0f:
+                self.red = self.green = self.blue = 0
+        self.color_mode = mask
+
+    @staticmethod
+    def _with_checksum(frame):
+        frame.append(_checksum(frame))
+        return frame
+
+    def state_frame(self):
+        power = 0x23 if self.is_on else 0x24
+        if self.original:
+            return bytearray([0x66, 0x01, power, self.pattern, 0x21, self.delay,
+                              self.red, self.green, self.blue, 0x01, 0x99])
+        return self._with_checksum(bytearray([
+            0x81, self.device_type, power, self.pattern, 0x21, self.delay,
+            self.red, self.green, self.blue, self.warm_white, 0x04,
+            self.cold_white, self.color_mode]))
+
+    def timers_frame(self):
+        frame = bytearray([0x0f, 0x22])
+        for timer in self.timers:
+            frame.extend(timer)
+        frame.append(0x00)
+        return self._with_checksum(frame)
+
+    def clock_frame(self):
+        now = datetime.datetime.now() + self.clock_offset
+        return self._with_checksum(bytearray([
+            0x0f, 0x11, 0x14, now.year - 2000, now.month, now.day,
+            now.hour, now.minute, now.second, now.isoweekday(), 0x00]))
+
+    def discovery_reply(self):
+        return "{},{},{}".format(self.ipaddr, self.id, self.model).encode('ascii')
+
+
+class _Connection():
+    def __init__(self, sock, bulb):
+        self.sock = sock
+        self.bulb = bulb
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.closed = False
+        # when the last delayed reply is due, to keep replies in order
+        self.send_at = 0
+
+
+class BulbSimulator():
+    """Serves many VirtualBulbs from one thread using a selector."""
+
+    def __init__(self, host="127.0.0.1", discovery_port=0):
+        self.host = host
+        self.bulbs = []
+        self._selector = selectors.DefaultSelector()
+        self._thread = None
+        self._running = False
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._timers = []
+        self._timer_seq = 0
+        self._next_id = 1
+
+        # wakes the selector when work is queued from another thread
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+        self._discovery = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._discovery.bind((host, discovery_port))
+        self._discovery.setblocking(False)
+        self.discovery_port = self._discovery.getsockname()[1]
+        self._selector.register(self._discovery, selectors.EVENT_READ,
+                                self._on_discovery)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_bulb(self, device_type=DEVICE_RGBW, bulb_id=None, faults=None,
+                 **kwargs):
+        """Add a virtual bulb listening on its own port; returns it.
+
+        faults is an optional FaultProfile; bulbs may share one.
+        """
+        if bulb_id is None:
+            bulb_id = "ACCF23{:06X}".format(self._next_id)
+            self._next_id += 1
+        bulb = VirtualBulb(bulb_id, device_type, ipaddr=self.host, **kwargs)
+        bulb.faults = faults
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, 0))
+        listener.listen(128)
+        listener.setblocking(False)
+        bulb.port = listener.getsockname()[1]
+        bulb._listener = listener
+        self.bulbs.append(bulb)
+        self._call_soon(self._selector.register, listener,
+                        selectors.EVENT_READ,
+                        lambda key, mask: self._on_accept(key, bulb))
+        return bulb
+
+    def add_bulbs(self, count, device_type=DEVICE_RGBW, **kwargs):
+        return [self.add_bulb(device_type, **kwargs) for i in range(count)]
+
+    def _call_soon(self, fn, *args):
+        """Run fn on the simulator thread (or right away if not running)."""
+        if not self._running:
+            fn(*args)
+            return
+        with self._pending_lock:
+            self._pending.append((fn, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except socket.error:
+            pass
+
+    def _call_later(self, delay, fn, *args):
+        """Run fn on the simulator thread after delay seconds.
+
+        Only call this from the simulator thread.
+        """
+        self._timer_seq += 1
+        heapq.heappush(self._timers, (time.monotonic() + delay,
+                                      self._timer_seq, fn, args))
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="flux_led simulator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving and close every socket.  The simulator can't be reused."""
+        if self._running:
+            self._running = False
+            self._wakeup_w.send(b'\0')
+            self._thread.join()
+        if self._selector.get_map() is None:
+            return
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+        self._wakeup_w.close()
+
+    def _run(self):
+        while self._running:
+            timeout = 1
+            if self._timers:
+                timeout = min(max(self._timers[0][0] - time.monotonic(), 0), 1)
+            for key, mask in self._selector.select(timeout=timeout):
+                if key.data is None:
+                    self._drain_wakeup()
+                else:
+                    key.data(key, mask)
+            self._run_pending()
+            self._run_timers()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _run_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        for fn, args in pending:
+            fn(*args)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            when, seq, fn, args = heapq.heappop(self._timers)
+            fn(*args)
+
+    def _on_accept(self, key, bulb):
+        try:
+            sock, addr = key.fileobj.accept()
+        except socket.error:
+            return
+        if bulb.faults is not None and bulb.faults.hit(bulb.faults.refuse):
+            # a listening socket can't refuse a single connection, so reset
+            # it instead; the client sees the connection drop straight away
+            bulb.refused += 1
+            self._reset(sock)
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = _Connection(sock, bulb)
+        self._selector.register(sock, selectors.EVENT_READ,
+                                lambda key, mask: self._on_connection(conn, mask))
+
+    def _on_connection(self, conn, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = conn.sock.recv(4096)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                data = b''
+            if not data:
+                self._close(conn)
+                return
+            faults = conn.bulb.faults
+            if faults is not None and faults.hit(faults.reset):
+                conn.bulb.resets += 1
+                self._close(conn, reset=True)
+                return
+            conn.inbuf.extend(data)
+            used, reply = conn.bulb.feed(conn.inbuf)
+            del conn.inbuf[:used]
+            if reply:
+                if faults is None:
+                    self._send(conn, reply)
+                else:
+                    self._send_faulty(conn, reply, faults)
+        if mask & selectors.EVENT_WRITE:
+            self._flush(conn)
+
+    def _send_faulty(self, conn, reply, faults):
+        now = time.monotonic()
+        conn.send_at = max(now + faults.delay(), conn.send_at)
+        parts = [reply]
+        if len(reply) > 1 and faults.hit(faults.truncate):
+            parts = [reply[:faults.random.randrange(1, len(reply))]]
+        elif len(reply) > 1 and faults.hit(faults.fragment):
+            cut = faults.random.randrange(1, len(reply))
+            parts = [reply[:cut], reply[cut:]]
+        for i, part in enumerate(parts):
+            if i:
+                conn.send_at += faults.fragment_delay
+            if conn.send_at <= now:
+                self._send(conn, part)
+            else:
+                self._call_later(conn.send_at - now, self._send, conn, part)
+
+    def _send(self, conn, data):
+        if conn.closed:
+            return
+        conn.outbuf.extend(data)
+        self._flush(conn)
+
+    def _flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                self._close(conn)
+                return
+        del conn.outbuf[:sent]
+        events = selectors.EVENT_READ
+        if conn.outbuf:
+            events |= selectors.EVENT_WRITE
+        self._selector.modify(conn.sock, events,
+                              self._selector.get_key(conn.sock).data)
+
+    def _close(self, conn, reset=False):
+        conn.closed = True
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        if reset:
+            self._reset(conn.sock)
+        else:
+            conn.sock.close()
+
+    @staticmethod
+    def _reset(sock):
+        # closing with a zero linger time sends a RST instead of a FIN
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack('ii', 1, 0))
+        except socket.error:
+            pass
+        sock.close()
+
+    def _on_discovery(self, key, mask):
+        try:
+            data, addr = self._discovery.recvfrom(64)
+        except socket.error:
+            return
+        if data != BulbScanner.DISCOVERY_MSG:
+            return
+        for bulb in self.bulbs:
+            try:
+                self._discovery.sendto(bulb.discovery_reply(), addr)
+            except socket.error:
+                pass
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--count", dest="count", type="int", default=1,
+                      help="Number of bulbs to simulate")
+    parser.add_option("--type", dest="device_type", default="rgbw",
+                      help="Device type: rgb, rgbw, rgbww or original")
+    parser.add_option("--host", dest="host", default="127.0.0.1",
+                      help="Address to listen on")
+    parser.add_option("--discovery-port", dest="discovery_port", type="int",
+                      default=0, help="UDP port for discovery (default: any free port)")
+    parser.add_option("--latency", dest="latency", type="float", default=0,
+                      help="Seconds to delay every reply")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0,
+                      help="Up to this many extra seconds of random delay")
+    for name in ('loss', 'fragment', 'truncate', 'reset', 'refuse'):
+        parser.add_option("--" + name, dest=name, type="float", default=0,
+                          help="Probability of a {} fault".format(name))
+    parser.add_option("--seed", dest="seed", type="int", default=None,
+                      help="Seed for the fault random number generator")
+    (options, args) = parser.parse_args()
+
+    device_types = {'rgb': DEVICE_RGB, 'rgbw': DEVICE_RGBW,
+                    'rgbww': DEVICE_RGBWW, 'original': DEVICE_ORIGINAL}
+    if options.device_type not in device_types:
+        parser.error("unknown device type: {}".format(options.device_type))
+
+    faults = None
+    if (options.latency or options.jitter or options.loss or options.fragment
+            or options.truncate or options.reset or options.refuse):
+        faults = FaultProfile(options.latency, options.jitter, options.loss,
+                              options.fragment, truncate=options.truncate,
+                              reset=options.reset, refuse=options.refuse,
+                              seed=options.seed)
+
+    sim = BulbSimulator(options.host, options.discovery_port)
+    sim.add_bulbs(options.count, device_types[options.device_type],
+                  faults=faults)
+    print("discovery on udp port {}".format(sim.discovery_port))
+    for bulb in sim.bulbs:
+        print("{} {}:{}".format(bulb.id, bulb.ipaddr, bulb.port))
+    sim.start()
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
+import concurrent.futures
+import ipaddress
+import socket
+import time
 import unittest
 import unittest.mock as mock
 from unittest.mock import Mock, MagicMock, patch
 
 import flux_led   
+from flux_led import effects
 
 
 class TestLight(unittest.TestCase):
@@ -459,3 +464,1285 @@ class TestLight(unittest.TestCase):
         self.assertEqual(light.warm_white, 0)
         self.assertEqual(light.brightness, 80)
         self.assertEqual(light.getRgb(), (1, 25, 80))
+
+    @patch('flux_led.WifiLedBulb._send_msg')
+    @patch('flux_led.WifiLedBulb._read_msg')
+    def test_lazy(self, mock_read, mock_send):
+        mock_read.side_effect = [
+            bytearray(b'\x81E'),
+            bytearray(b'\x81E#a!\x10g\xffh\x00\x04\x00\xf0<'),
+        ]
+        light = flux_led.WifiLedBulb("192.168.1.164", lazy=True)
+        self.assertEqual(mock_send.call_count, 0)
+        self.assertEqual(light.capabilities, None)
+
+        # the first command probes the bulb before building the message
+        light.setRgb(1, 25, 80)
+        self.assertEqual(mock_read.call_count, 2)
+        self.assertEqual(mock_send.call_count, 3)
+        self.assertEqual(
+            mock_send.call_args,
+            mock.call(bytearray(b'1\x01\x19P\x00\xf0\x0f'))
+        )
+        self.assertEqual(light.capabilities, {
+            'protocol': None,
+            'rgbwcapable': False,
+            'rgbwprotocol': False,
+            'use_csum': True,
+            'query_len': 14,
+        })
+
+    @patch('flux_led.WifiLedBulb._send_msg')
+    @patch('flux_led.WifiLedBulb._read_msg')
+    def test_known_capabilities(self, mock_read, mock_send):
+        capabilities = {
+            'protocol': 'LEDENET_ORIGINAL',
+            'rgbwcapable': False,
+            'rgbwprotocol': False,
+            'use_csum': False,
+            'query_len': 11,
+        }
+        mock_read.return_value = bytearray(b'f\x01#A!\x08\xff\x80*\x01\x99')
+        light = flux_led.WifiLedBulb("192.168.1.164", capabilities=capabilities)
+        # no protocol probe, straight to the state query
+        self.assertEqual(mock_read.call_count, 1)
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(
+            mock_send.call_args,
+            mock.call(bytearray(b'\xef\x01w'))
+        )
+        self.assertEqual(light.getRgb(), (255, 128, 42))
+        self.assertEqual(light.capabilities, capabilities)
+
+    @patch('flux_led.WifiLedBulb._send_msg')
+    @patch('flux_led.WifiLedBulb._read_msg')
+    def test_transition_send_error(self, mock_read, mock_send):
+        mock_read.return_value = bytearray(b'f\x01#A!\x08\xff\x80*\x01\x99')
+        capabilities = {
+            'protocol': 'LEDENET_ORIGINAL',
+            'rgbwcapable': False,
+            'rgbwprotocol': False,
+            'use_csum': False,
+            'query_len': 11,
+        }
+        light = flux_led.WifiLedBulb("192.168.1.164", capabilities=capabilities)
+        # the bulb goes away after the first frame
+        mock_send.side_effect = [None, socket.error("gone")]
+        results = flux_led.Transition([light], (255, 255, 255), duration=0.1,
+                                      start=(0, 0, 0)).run()
+        self.assertFalse(results[0].ok)
+        self.assertIsInstance(results[0].error, socket.error)
+        self.assertEqual(results[0].value, 1)
+
+        with self.assertRaises(ValueError):
+            flux_led.Transition([light], (1, 2, 3), fps=0)
+
+    def test_read_msg_stops_at_frame_end(self):
+        import socket
+        with patch('flux_led.WifiLedBulb.connect'), \
+                patch('flux_led.WifiLedBulb.update_state'):
+            light = flux_led.WifiLedBulb("192.168.1.164", timeout=5)
+        light._socket, remote = socket.socketpair()
+        light._connected = True
+
+        # an 11 byte original protocol frame when 14 bytes were asked for
+        remote.send(b'f\x01#A!\x08\x01\x19P\x01\x99')
+        begin = time.time()
+        rx = light._read_msg(14)
+        self.assertEqual(rx, bytearray(b'f\x01#A!\x08\x01\x19P\x01\x99'))
+        self.assertLess(time.time() - begin, 1)
+
+        remote.close()
+        self.assertEqual(light._read_msg(14), bytearray())
+        self.assertEqual(light._connected, False)
+        light.close()
+
+
+class TestAsyncLight(unittest.TestCase):
+    def test_rgb(self):
+        import asyncio
+        from flux_led.aio import AsyncWifiLedBulb
+
+        received = []
+        state = bytearray(b'\x81E#a!\x10g\xffh\x00\x04\x00\xf0<')
+
+        async def handle(reader, writer):
+            while True:
+                data = await reader.read(64)
+                if not data:
+                    break
+                received.append(bytes(data))
+                for _ in range(bytes(data).count(b'\x81\x8a\x8b')):
+                    writer.write(state)
+                await writer.drain()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            light = await AsyncWifiLedBulb.create('127.0.0.1', port, timeout=1)
+            self.assertEqual(light.is_on, True)
+            self.assertEqual(light.mode, "color")
+            self.assertEqual(light.getRgb(), (103, 255, 104))
+
+            await light.setRgb(1, 25, 80)
+            await light.turnOff()
+            await light.update_state()
+            await light.setWhiteTemperature(6500, 255)
+            await light.setCustomPattern([(255, 0, 0)], 50, "jump")
+            await light.update_state()
+            # nothing of WifiLedBulb that would block the loop
+            for name in ('transition', 'batch', 'submit_turnOn', '_write'):
+                self.assertFalse(hasattr(light, name))
+            light.close()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+        stream = b''.join(received)
+        self.assertIn(b'1\x01\x19P\x00\xf0\x0f\x9aq$\x0f\xa4', stream)
+        self.assertIn(b'1\x00\x00\x00\x00\x0f\x0f\x4f', stream)
+        self.assertIn(b'Q\xff\x00\x00\x00\x01\x02\x03', stream)
+
+    def test_concurrent_commands(self):
+        import asyncio
+        from flux_led.aio import AsyncWifiLedBulb
+
+        received = {}
+        capabilities = {'protocol': None, 'rgbwcapable': False,
+                        'rgbwprotocol': False, 'use_csum': True,
+                        'query_len': 14}
+
+        def server_for(name):
+            async def handle(reader, writer):
+                data = await reader.read(64)
+                received[name] = bytes(data)
+                writer.close()
+            return asyncio.start_server(handle, '127.0.0.1', 0)
+
+        async def run():
+            servers = [await server_for(name) for name in ('a', 'b')]
+            lights = [AsyncWifiLedBulb(
+                '127.0.0.1', server.sockets[0].getsockname()[1], timeout=1,
+                capabilities=capabilities) for server in servers]
+            # both connect before sending, and must not share a message
+            await asyncio.gather(lights[0].setRgb(10, 20, 30),
+                                 lights[1].setRgb(200, 100, 50))
+            await asyncio.sleep(0.1)
+            for light, server in zip(lights, servers):
+                light.close()
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(run())
+        self.assertEqual(received['a'][:4], b'1\x0a\x14\x1e')
+        self.assertEqual(received['b'][:4], b'1\xc8\x64\x32')
+
+    def test_commands_wait_for_replies(self):
+        import asyncio
+        from flux_led.aio import AsyncWifiLedBulb
+
+        events = []
+        capabilities = {'protocol': None, 'rgbwcapable': False,
+                        'rgbwprotocol': False, 'use_csum': True,
+                        'query_len': 14}
+        clock = bytes([0x0f, 0x11, 0x14, 17, 5, 6, 7, 8, 9, 1, 0, 0])
+
+        async def handle(reader, writer):
+            while True:
+                data = await reader.read(64)
+                if not data:
+                    break
+                events.append(bytes(data))
+                if data[0] == 0x11:
+                    # a slow reply to getClock; keep listening meanwhile
+                    try:
+                        early = await asyncio.wait_for(reader.read(64), 0.1)
+                        events.append(bytes(early))
+                    except asyncio.TimeoutError:
+                        pass
+                    events.append('reply')
+                    writer.write(clock)
+                    await writer.drain()
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            light = AsyncWifiLedBulb(
+                '127.0.0.1', server.sockets[0].getsockname()[1], timeout=1,
+                capabilities=capabilities)
+            await light.connect()
+            clock_task = asyncio.ensure_future(light.getClock())
+            await asyncio.sleep(0.01)
+            await asyncio.gather(light.setPresetPattern(0x25, 50),
+                                 light.setRgb(1, 2, 3))
+            self.assertEqual((await clock_task).year, 2017)
+            await asyncio.sleep(0.05)
+            light.close()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(run())
+        # neither command went out while getClock waited for its reply
+        self.assertEqual(events[1], 'reply')
+        self.assertEqual(events[0][0], 0x11)
+        sent = b''.join(events[2:])
+        self.assertIn(b'a\x25', sent)
+        self.assertIn(b'1\x01\x02\x03', sent)
+
+
+class TestCodec(unittest.TestCase):
+    def test_send_leaves_message_alone(self):
+        light = flux_led.WifiLedBulb("192.168.1.164", lazy=True)
+        light._socket, remote = socket.socketpair()
+        try:
+            msg = bytearray([0x71, 0x23, 0x0f])
+            light._send_msg(msg)
+            # a retry sends the same bytes again
+            light._send_msg(msg)
+            self.assertEqual(msg, bytearray([0x71, 0x23, 0x0f]))
+            self.assertEqual(remote.recv(64), b'\x71\x23\x0f\xa3' * 2)
+
+            light._use_csum = False
+            light._send_msg(b'\xcc\x23\x33')
+            self.assertEqual(remote.recv(64), b'\xcc\x23\x33')
+        finally:
+            light._socket.close()
+            remote.close()
+
+    def test_send_short_write(self):
+        from flux_led import codec
+        sent = bytearray()
+
+        class ShortSocket():
+            def sendmsg(self, buffers):
+                # only part of the body goes out
+                sent.extend(bytes(buffers[0])[:2])
+                return 2
+
+            def sendall(self, data):
+                sent.extend(data)
+
+        codec.send(ShortSocket(), memoryview(b'\x71\x23\x0f'))
+        self.assertEqual(sent, b'\x71\x23\x0f\xa3')
+
+    def test_templates_are_reused(self):
+        from flux_led import codec
+        first = codec.rgbw(1, 2, 3, None, None, True, None, False)
+        self.assertEqual(first, b'\x31\x01\x02\x03\x00\xf0\x0f')
+        second = codec.rgbw(None, None, None, 4, 5, False, 'LEDENET', False)
+        self.assertEqual(second, b'\x41\x00\x00\x00\x04\x05\x0f\x0f')
+        third = codec.rgbw(7, 8, 9, None, None, False, None, True)
+        self.assertIs(third, first)
+        self.assertEqual(first, b'\x41\x07\x08\x09\x00\x00\x0f')
+
+
+class TestBulbState(unittest.TestCase):
+    def test_decode(self):
+        rx = bytearray(b'\x81%#a!\x10\xb6\x00\x98\x19\x04\x25\x0f\xa6')
+        state = flux_led.BulbState.decode(rx, "color", 'LEDENET')
+        self.assertEqual(state.is_on, True)
+        self.assertEqual(state.rgbww, (182, 0, 152, 25, 37))
+        self.assertEqual(state.rgb, (182, 0, 152))
+        self.assertEqual((state.warm_white, state.cold_white), (25, 37))
+        self.assertEqual(state.brightness, 182)
+        self.assertEqual(state, flux_led.BulbState.decode(bytearray(rx),
+                                                          "color", 'LEDENET'))
+        with self.assertRaises(AttributeError):
+            state.brightness = 0
+
+        # original protocol frame, in warm white mode
+        rx = bytearray(b'f\x01$A!\x08\xff\x80*\x01\x99')
+        state = flux_led.BulbState.decode(rx, "ww", 'LEDENET_ORIGINAL')
+        self.assertEqual(state.is_on, False)
+        self.assertEqual(state.rgbww, (255, 255, 255, 255, 255))
+        self.assertEqual(state.brightness, 1)
+
+    @patch('flux_led.WifiLedBulb._send_msg')
+    @patch('flux_led.WifiLedBulb._read_msg')
+    def test_diff(self, mock_read, mock_send):
+        frames = [bytearray(b'\x81D'),
+                  bytearray(b'\x81E#a!\x10g\xffh\x00\x04\x00\xf0<'),
+                  bytearray(b'\x81E#a!\x10g\xffh\x00\x04\x00\xf0<'),
+                  bytearray(b'\x81E$a!\x10\x00\xffh\x00\x04\x00\xf0\xd6')]
+        mock_read.side_effect = lambda expected: frames.pop(0)
+        events = []
+        light = flux_led.WifiLedBulb("192.168.1.166",
+                                     observer=lambda *e: events.append(e))
+        first = light.state
+        self.assertEqual(first.diff(None)['rgb'], (None, (103, 255, 104)))
+
+        light.update_state()
+        self.assertEqual(light.state, first)
+        light.update_state()
+        self.assertEqual(light.state.diff(first), {
+            'is_on': (True, False),
+            'rgb': ((103, 255, 104), (0, 255, 104)),
+            'rgbw': ((103, 255, 104, 0), (0, 255, 104, 0)),
+            'rgbww': ((103, 255, 104, 0, 0), (0, 255, 104, 0, 0)),
+        })
+        changes = [e[1]['changes'] for e in events if e[0] == "state_changed"]
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(changes[1], light.state.diff(first))
+        self.assertEqual(light.getRgb(), (0, 255, 104))
+
+
+class TestRetryPolicy(unittest.TestCase):
+    CAPABILITIES = {'protocol': None, 'rgbwcapable': False,
+                    'rgbwprotocol': False, 'use_csum': True, 'query_len': 14}
+
+    def test_delay(self):
+        policy = flux_led.RetryPolicy(backoff=0.1, factor=2, max_backoff=0.3,
+                                      jitter=0)
+        self.assertEqual([policy.delay(n) for n in range(4)],
+                         [0.1, 0.2, 0.3, 0.3])
+        policy.jitter = 0.5
+        for i in range(20):
+            self.assertTrue(0.05 <= policy.delay(0) <= 0.1)
+
+    @patch('flux_led.WifiLedBulb.connect')
+    @patch('flux_led.WifiLedBulb._send_msg')
+    def test_backoff(self, mock_send, mock_connect):
+        mock_send.side_effect = socket.error("unreachable")
+        events = []
+        policy = flux_led.RetryPolicy(retries=3, backoff=0.01, jitter=0)
+        light = flux_led.WifiLedBulb("192.168.1.164", lazy=True,
+                                     capabilities=self.CAPABILITIES,
+                                     observer=lambda *e: events.append(e),
+                                     retry_policy=policy)
+        light.setRgb(1, 2, 3)
+        self.assertEqual(mock_send.call_count, 4)
+        retries = [e[1] for e in events if e[0] == "retry"]
+        self.assertEqual([r['delay'] for r in retries], [0.01, 0.02, 0.04])
+        self.assertEqual([r['retries_left'] for r in retries], [2, 1, 0])
+
+        # the retry argument still overrides the policy for one call
+        mock_send.reset_mock()
+        light.turnOn(retry=0)
+        self.assertEqual(mock_send.call_count, 1)
+        self.assertEqual(light.is_on, False)
+
+    @patch('flux_led.WifiLedBulb.connect')
+    @patch('flux_led.WifiLedBulb._send_msg')
+    def test_deadline(self, mock_send, mock_connect):
+        mock_send.side_effect = socket.error("unreachable")
+        policy = flux_led.RetryPolicy(retries=100, backoff=0.02, factor=1,
+                                      jitter=0, deadline=0.2)
+        light = flux_led.WifiLedBulb("192.168.1.164", lazy=True,
+                                     capabilities=self.CAPABILITIES,
+                                     retry_policy=policy)
+        start = time.time()
+        light.setRgb(1, 2, 3)
+        self.assertLess(time.time() - start, 0.25)
+
+    @patch('flux_led.WifiLedBulb.connect')
+    @patch('flux_led.WifiLedBulb._send_msg')
+    @patch('flux_led.WifiLedBulb._read_msg')
+    def test_probe(self, mock_read, mock_send, mock_connect):
+        # neither probe is answered the first time round
+        mock_read.side_effect = [
+            bytearray(), bytearray(), bytearray(b'\x81E'),
+            bytearray(b'\x81E#a!\x10g\xffh\x00\x04\x00\xf0<'),
+        ]
+        events = []
+        policy = flux_led.RetryPolicy(retries=1, backoff=0.01)
+        light = flux_led.WifiLedBulb("192.168.1.164", lazy=True,
+                                     observer=lambda *e: events.append(e),
+                                     retry_policy=policy)
+        light.update_state()
+        self.assertEqual(light.getRgb(), (103, 255, 104))
+        self.assertEqual([e[1]['method'] for e in events if e[0] == "retry"],
+                         ["_determine_query_len"])
+
+        # the probe shares the query's retries
+        mock_read.side_effect = None
+        mock_read.return_value = bytearray()
+        mock_read.reset_mock()
+        light._query_len = 0
+        light.update_state()
+        self.assertEqual(mock_read.call_count, 4)
+        self.assertGreater(mock_send.call_count, 1)
+        self.assertLessEqual(mock_send.call_count, 10)
+
+
+class TestCapabilityCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name + '/capabilities.json'
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @patch('flux_led.WifiLedBulb._send_msg')
+    @patch('flux_led.WifiLedBulb._read_msg')
+    def test_probe_skipped_when_cached(self, mock_read, mock_send):
+        state = bytearray(b'\x81\x25\x23\x61\x21\x10\xb6\x00\x98\x00\x04\x00\xf0\xbc')
+        mock_read.side_effect = [bytearray(b'\x81\x25'), state]
+        cache = flux_led.CapabilityCache(self.path)
+        light = flux_led.WifiLedBulb("192.168.1.164", capability_cache=cache,
+                                     bulb_id='ACCF235FFFFF')
+        self.assertEqual(mock_read.call_count, 2)
+        self.assertEqual(light.protocol, 'LEDENET')
+
+        # a fresh process reads the file and goes straight to the query
+        mock_read.reset_mock()
+        mock_read.side_effect = [state]
+        cache = flux_led.CapabilityCache(self.path)
+        self.assertEqual(cache.get('ACCF235FFFFF'), light.capabilities)
+        light = flux_led.WifiLedBulb("192.168.1.164", capability_cache=cache,
+                                     bulb_id='ACCF235FFFFF')
+        self.assertEqual(mock_read.call_count, 1)
+        self.assertEqual(light.protocol, 'LEDENET')
+        self.assertEqual(light.rgbwcapable, True)
+
+    @patch('flux_led.WifiLedBulb._send_msg')
+    @patch('flux_led.WifiLedBulb._read_msg')
+    def test_stale_entry_replaced(self, mock_read, mock_send):
+        cache = flux_led.CapabilityCache(self.path)
+        cache.set('192.168.1.164', {
+            'protocol': 'LEDENET',
+            'rgbwcapable': True,
+            'rgbwprotocol': False,
+            'use_csum': True,
+            'query_len': 14,
+        })
+        mock_read.return_value = bytearray(b'\x81E#a!\x10g\xffh\x00\x04\x00\xf0<')
+        light = flux_led.WifiLedBulb("192.168.1.164", capability_cache=cache)
+        self.assertEqual(light.protocol, None)
+        self.assertEqual(light.rgbwcapable, False)
+        self.assertEqual(flux_led.CapabilityCache(self.path).get('192.168.1.164'),
+                         light.capabilities)
+
+
+class TestPersistentConnection(unittest.TestCase):
+    def test_reuses_socket(self):
+        import socket
+        import threading
+
+        state = b'\x81E#a!\x10g\xffh\x00\x04\x00\xf0<'
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        port = listener.getsockname()[1]
+        connections = []
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except OSError:
+                    return
+                connections.append(conn)
+                threading.Thread(target=answer, args=(conn,), daemon=True).start()
+
+        def answer(conn):
+            while True:
+                try:
+                    data = conn.recv(64)
+                except OSError:
+                    return
+                if not data:
+                    return
+                try:
+                    conn.sendall(state * data.count(b"\x81\x8a\x8b"))
+                except OSError:
+                    return
+
+        threading.Thread(target=serve, daemon=True).start()
+        light = flux_led.WifiLedBulb('127.0.0.1', port, timeout=1, persistent=True)
+        for _ in range(3):
+            light.update_state()
+        self.assertEqual(light.getRgb(), (103, 255, 104))
+        self.assertEqual(len(connections), 1)
+
+        # the bulb dropping the connection is noticed before the next query
+        connections[0].shutdown(socket.SHUT_RDWR)
+        connections[0].close()
+        time.sleep(0.1)
+        light.update_state()
+        self.assertEqual(light.is_on, True)
+        self.assertEqual(len(connections), 2)
+
+        light.close()
+        listener.close()
+
+
+class TestBulbGroup(unittest.TestCase):
+    def test_fan_out(self):
+        good = Mock(ipaddr="192.168.1.10")
+        bad = Mock(ipaddr="192.168.1.11")
+        bad.turnOn.side_effect = OSError("unreachable")
+        group = flux_led.BulbGroup([good, bad], max_workers=2)
+
+        results = group.turnOn()
+        self.assertEqual([r.bulb for r in results], [good, bad])
+        self.assertTrue(results[0].ok)
+        self.assertFalse(results[1].ok)
+        self.assertIsInstance(results[1].error, OSError)
+        self.assertIsNotNone(results[1].latency)
+        good.turnOn.assert_called_once_with(retry=None)
+
+        group.setRgb(1, 2, 3, persist=False)
+        good.setRgb.assert_called_once_with(1, 2, 3, persist=False,
+                                            brightness=None, retry=None)
+        group.close()
+
+    def test_timeout(self):
+        import threading
+        release = threading.Event()
+        fast = Mock(ipaddr="192.168.1.10")
+        slow = Mock(ipaddr="192.168.1.11")
+        slow.update_state.side_effect = lambda retry: release.wait(5)
+        group = flux_led.BulbGroup([fast, slow], timeout=0.1)
+
+        results = group.update_state()
+        release.set()
+        self.assertTrue(results[0].ok)
+        self.assertFalse(results[1].ok)
+        # the hung call held a thread of the group's own pool
+        self.assertIsNot(group._get_executor(),
+                         flux_led.WifiLedBulb.shared_executor())
+        group.close()
+
+        shared = flux_led.BulbGroup([fast], max_workers=None)
+        self.assertIs(shared._get_executor(),
+                      flux_led.WifiLedBulb.shared_executor())
+
+
+class TestCommandLine(unittest.TestCase):
+    def test_run_in_order(self):
+        from flux_led.__main__ import runInOrder
+
+        def job(delay, value):
+            def run():
+                time.sleep(delay)
+                if value is None:
+                    raise OSError("unreachable")
+                return value
+            return run
+
+        jobs = [job(0.2, 'a'), job(0.0, 'b'), job(0.0, None), job(5, 'd')]
+        begin = time.time()
+        results = list(runInOrder(jobs, concurrency=4, deadline=0.5))
+        self.assertLess(time.time() - begin, 2)
+        self.assertEqual(results[0], ('a', None))
+        self.assertEqual(results[1], ('b', None))
+        self.assertIsInstance(results[2][1], OSError)
+        self.assertIsInstance(results[3][1], TimeoutError)
+
+
+class FakeDiscoverySocket():
+    """Stands in for the UDP socket, answering with canned datagrams."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.sent = []
+        self.closed = False
+
+    def bind(self, address):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+    def recvfrom(self, size):
+        import socket
+        if not self.responses:
+            time.sleep(self.timeout)
+            raise socket.timeout()
+        return self.responses.pop(0), ('192.168.1.1', 48899)
+
+    def close(self):
+        self.closed = True
+
+
+class TestBulbScanner(unittest.TestCase):
+    responses = [
+        b'HF-A11ASSISTHREAD',
+        b'192.168.1.10,ACCF23000001,HF-LPB100-ZJ200',
+        b'192.168.1.11,ACCF23000002,HF-LPB100-ZJ200',
+        b'192.168.1.10,ACCF23000001,HF-LPB100-ZJ200',
+        b'garbage',
+        b'192.168.1.12,ACCF23000003,HF-LPB100-ZJ200',
+    ]
+
+    def test_scan_deduplicates(self):
+        fake = FakeDiscoverySocket(self.responses)
+        scanner = flux_led.BulbScanner()
+        with patch('socket.socket', return_value=fake):
+            bulbs = scanner.scan(timeout=0.2)
+        self.assertEqual([b['id'] for b in bulbs],
+                         ['ACCF23000001', 'ACCF23000002', 'ACCF23000003'])
+        self.assertEqual(scanner.getBulbInfoByID('ACCF23000002')['ipaddr'],
+                         '192.168.1.11')
+        self.assertEqual(scanner.getBulbInfoByID('missing'), None)
+        self.assertTrue(fake.closed)
+
+    def test_scan_iter_stops_early(self):
+        fake = FakeDiscoverySocket(self.responses)
+        scanner = flux_led.BulbScanner()
+        begin = time.time()
+        with patch('socket.socket', return_value=fake):
+            found = [b['id'] for b in scanner.scan_iter(timeout=10,
+                                                         ids=['ACCF23000002'])]
+        self.assertLess(time.time() - begin, 1)
+        self.assertEqual(found, ['ACCF23000001', 'ACCF23000002'])
+
+        fake = FakeDiscoverySocket(self.responses)
+        with patch('socket.socket', return_value=fake):
+            bulbs = scanner.scan(timeout=10, count=1)
+        self.assertEqual(len(bulbs), 1)
+
+    def test_sweep(self):
+        import socket
+        import threading
+
+        responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        responder.bind(('127.0.0.1', 0))
+        port = responder.getsockname()[1]
+        probes = []
+
+        def answer():
+            while True:
+                try:
+                    data, addr = responder.recvfrom(64)
+                except OSError:
+                    return
+                probes.append(data)
+                responder.sendto(b'127.0.0.1,ACCF23000001,HF-LPB100-ZJ200', addr)
+
+        threading.Thread(target=answer, daemon=True).start()
+        scanner = flux_led.BulbScanner()
+        begin = time.time()
+        bulbs = scanner.sweep(['127.0.0.0/28'], timeout=0.2, rate=100, port=port)
+        elapsed = time.time() - begin
+        responder.close()
+
+        self.assertEqual(bulbs, [{'ipaddr': '127.0.0.1', 'id': 'ACCF23000001',
+                                  'model': 'HF-LPB100-ZJ200'}])
+        self.assertEqual(probes, [b'HF-A11ASSISTHREAD'])
+        # 14 hosts at 100 packets per second, then the timeout
+        self.assertGreater(elapsed, 0.3)
+        self.assertLess(elapsed, 1)
+
+    def test_sweep_nothing(self):
+        scanner = flux_led.BulbScanner()
+        self.assertEqual(scanner.sweep([], timeout=0.2), [])
+        self.assertEqual([str(host) for host in scanner._hosts(
+            ipaddress.ip_network(u'127.0.0.1/32'))], ['127.0.0.1'])
+
+
+class TestDiscoveryService(unittest.TestCase):
+    def test_tracks_moved_bulb(self):
+        scanner = Mock()
+        scanner.scan_iter.return_value = [
+            {'ipaddr': '192.168.1.10', 'id': 'ACCF23000001', 'model': 'HF-LPB100'},
+        ]
+        service = flux_led.DiscoveryService(scanner=scanner)
+        events = []
+        service.subscribe(lambda event, info: events.append((event, info['ipaddr'])))
+
+        service.refresh()
+        self.assertEqual(service.get('ACCF23000001')['ipaddr'], '192.168.1.10')
+        self.assertIn('last_seen', service.get('ACCF23000001'))
+
+        with patch('flux_led.WifiLedBulb.connect'), \
+                patch('flux_led.WifiLedBulb.update_state'):
+            light = flux_led.WifiLedBulb('192.168.1.10')
+        service.track(light, 'ACCF23000001')
+
+        # seen again at the same address: nothing to report
+        service.refresh()
+        scanner.scan_iter.return_value = [
+            {'ipaddr': '192.168.1.57', 'id': 'ACCF23000001', 'model': 'HF-LPB100'},
+        ]
+        service.refresh()
+        self.assertEqual(events, [('added', '192.168.1.10'),
+                                  ('moved', '192.168.1.57')])
+        self.assertEqual(light.ipaddr, '192.168.1.57')
+        self.assertEqual(len(service.bulbs()), 1)
+
+    def test_background_refresh(self):
+        import threading
+        scanned = threading.Event()
+        scanner = Mock()
+        scanner.scan_iter.side_effect = lambda timeout: scanned.set() or []
+        service = flux_led.DiscoveryService(interval=60, scanner=scanner)
+        service.start()
+        self.assertTrue(scanned.wait(1))
+        service.stop()
+
+
+class TestSimulator(unittest.TestCase):
+    def setUp(self):
+        from flux_led import simulator
+        self.simulator = simulator
+        self.sim = simulator.BulbSimulator()
+        self.sim.start()
+
+    def tearDown(self):
+        self.sim.stop()
+
+    def test_rgbw_bulb(self):
+        virtual = self.sim.add_bulb()
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1)
+        self.assertEqual(light.rgbwcapable, True)
+        self.assertEqual(light.is_on, True)
+
+        light.setRgb(1, 25, 80, persist=False)
+        light.turnOff()
+        light.update_state()
+        self.assertEqual(light.getRgb(), (1, 25, 80))
+        self.assertEqual(light.is_on, False)
+        self.assertEqual(virtual.persistent_writes, 0)
+
+        light.setClock()
+        self.assertIsNotNone(light.getClock())
+        timers = light.getTimers()
+        self.assertEqual(len(timers), 6)
+        timers[0] = flux_led.LedTimer()
+        timers[0].setActive(True)
+        timers[0].setRepeatMask(flux_led.LedTimer.Weekdays)
+        timers[0].setModeColor(255, 0, 0)
+        light.sendTimers(timers)
+        self.assertEqual(str(light.getTimers()[0]), str(timers[0]))
+
+    def test_ledenet_and_original(self):
+        ledenet = self.sim.add_bulb(self.simulator.DEVICE_RGBWW)
+        light = flux_led.WifiLedBulb(ledenet.ipaddr, ledenet.port, timeout=1)
+        self.assertEqual(light.protocol, 'LEDENET')
+        light.setRgbw(w=25, w2=37)
+        light.update_state()
+        self.assertEqual(light.getRgbww(), (255, 255, 255, 25, 37))
+
+        original = self.sim.add_bulb(self.simulator.DEVICE_ORIGINAL)
+        light = flux_led.WifiLedBulb(original.ipaddr, original.port, timeout=0.2)
+        self.assertEqual(light.protocol, 'LEDENET_ORIGINAL')
+        light.setRgb(1, 25, 80)
+        light.update_state()
+        self.assertEqual(light.getRgb(), (1, 25, 80))
+
+    def test_discovery(self):
+        self.sim.add_bulbs(3)
+        scanner = flux_led.BulbScanner()
+        bulbs = scanner.sweep('127.0.0.1/32', timeout=1, count=3,
+                              port=self.sim.discovery_port)
+        self.assertEqual(sorted(b['id'] for b in bulbs),
+                         [b.id for b in self.sim.bulbs])
+
+    def test_slow_fragmented_replies(self):
+        faults = self.simulator.FaultProfile(latency=0.05, fragment=1,
+                                             fragment_delay=0.02, seed=1)
+        virtual = self.sim.add_bulb(faults=faults)
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1)
+        light.setRgb(1, 25, 80)
+        start = time.time()
+        light.update_state()
+        self.assertGreaterEqual(time.time() - start, 0.07)
+        self.assertEqual(light.getRgb(), (1, 25, 80))
+
+    def test_lost_frames_and_resets(self):
+        lossy = self.sim.add_bulb(faults=self.simulator.FaultProfile(loss=1))
+        light = flux_led.WifiLedBulb(lossy.ipaddr, lossy.port, timeout=0.1)
+        self.assertEqual(light.is_on, False)
+        self.assertEqual(lossy.frames, 0)
+        self.assertGreater(lossy.frames_lost, 0)
+
+        resetting = self.sim.add_bulb(faults=self.simulator.FaultProfile(reset=1))
+        with self.assertRaises(socket.error):
+            flux_led.WifiLedBulb(resetting.ipaddr, resetting.port, timeout=0.1)
+        self.assertGreater(resetting.resets, 0)
+
+        refusing = self.sim.add_bulb(faults=self.simulator.FaultProfile(refuse=1))
+        with self.assertRaises(socket.error):
+            flux_led.WifiLedBulb(refusing.ipaddr, refusing.port, timeout=0.1)
+        self.assertGreater(refusing.refused, 0)
+
+    def test_transition(self):
+        virtual = self.sim.add_bulb()
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     persistent=True)
+        light.setRgb(0, 0, 0, persist=False)
+        light.update_state()
+        start = time.time()
+        frames = light.transition((200, 100, 0), duration=0.3, fps=20)
+        elapsed = time.time() - start
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 0.6)
+        self.assertGreater(frames, 1)
+        self.assertLessEqual(frames, 0.3 * 20 + 2)
+        light.update_state()
+        self.assertEqual(light.getRgb(), (200, 100, 0))
+        self.assertEqual(virtual.persistent_writes, 0)
+
+        # a slow link drops frames but still finishes on time
+        virtual.faults = self.simulator.FaultProfile(latency=0.1)
+        light.update_state()
+        start = time.time()
+        transition = flux_led.Transition([light], (0, 0, 255), duration=0.2,
+                                         fps=100, easing='ease_in_out')
+        transition.run()
+        self.assertLess(time.time() - start, 0.4)
+        virtual.faults = None
+        light.update_state()
+        self.assertEqual(light.getRgb(), (0, 0, 255))
+
+        with self.assertRaises(ValueError):
+            light.transition((1, 2, 3), easing='bounce')
+
+    def test_group_transition(self):
+        lights = [flux_led.WifiLedBulb(v.ipaddr, v.port, timeout=1,
+                                       persistent=True)
+                  for v in self.sim.add_bulbs(3)]
+        group = flux_led.BulbGroup(lights)
+        results = group.transition("(10, 20, 30)", duration=0.1, persist=True,
+                                   start=[0, 0, 0])
+        self.assertTrue(all(r.ok and r.value >= 1 for r in results))
+        group.update_state()
+        group.close()
+        for light, virtual in zip(lights, self.sim.bulbs):
+            self.assertEqual(light.getRgb(), (10, 20, 30))
+            self.assertEqual(virtual.persistent_writes, 1)
+
+    def test_submit(self):
+        self.sim.add_bulbs(3)
+        lights = [flux_led.WifiLedBulb(virtual.ipaddr, virtual.port,
+                                       timeout=1, lazy=True)
+                  for virtual in self.sim.bulbs]
+        futures = []
+        for i, light in enumerate(lights):
+            futures.append(light.submit_setRgb(i, 2, 3, persist=False))
+            futures.append(light.submit_turnOff())
+            futures.append(light.submit_update_state())
+            futures.append(light.submit_getTimers())
+        concurrent.futures.wait(futures, timeout=5)
+        self.assertEqual([f.exception() for f in futures], [None] * 12)
+        for i, light in enumerate(lights):
+            # each bulb ran its calls in order
+            self.assertEqual(light.getRgb(), (i, 2, 3))
+            self.assertEqual(light.is_on, False)
+            self.assertEqual(len(futures[i * 4 + 3].result()), 6)
+
+        flux_led.WifiLedBulb.set_executor_size(2)
+        try:
+            self.assertEqual(
+                flux_led.WifiLedBulb.shared_executor()._max_workers, 2)
+            futures = [light.submit_turnOn() for light in lights]
+            concurrent.futures.wait(futures, timeout=5)
+            self.assertEqual([light.is_on for light in lights], [True] * 3)
+        finally:
+            flux_led.WifiLedBulb.set_executor_size(32)
+
+    def test_submit_after_pool_shutdown(self):
+        virtual = self.sim.add_bulb()
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     lazy=True)
+        dead = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        dead.shutdown()
+        old = flux_led.WifiLedBulb._executor
+        flux_led.WifiLedBulb._executor = dead
+        try:
+            future = light.submit_turnOn()
+            self.assertIsInstance(future.exception(timeout=1), RuntimeError)
+        finally:
+            flux_led.WifiLedBulb._executor = old
+        # the bulb's queue is not left stuck
+        light.submit_turnOn().result(timeout=5)
+        self.assertEqual(light.is_on, True)
+
+    def test_concurrent_requests(self):
+        import threading
+        virtual = self.sim.add_bulb()
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     persistent=True)
+        errors = []
+
+        def run(work):
+            try:
+                for i in range(30):
+                    work(i)
+            except Exception as e:
+                errors.append(e)
+
+        def query(i):
+            rx = light.query_state()
+            self.assertEqual((rx[0], len(rx)), (0x81, 14))
+
+        def timers(i):
+            self.assertEqual(len(light.getTimers()), 6)
+
+        def color(i):
+            light.setRgb(i, 0, 0, persist=False)
+
+        threads = [threading.Thread(target=run, args=(work,))
+                   for work in (query, timers, color)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        light.update_state()
+        self.assertEqual(light.getRgb(), (29, 0, 0))
+
+    def test_lazy(self):
+        for persistent in (False, True):
+            virtual = self.sim.add_bulb(self.simulator.DEVICE_RGB)
+            light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port,
+                                         timeout=1, lazy=True,
+                                         persistent=persistent)
+            self.assertEqual(virtual.frames, 0)
+            # the first command connects and probes the bulb
+            light.setRgb(1, 25, 80)
+            light.update_state()
+            self.assertEqual(light.getRgb(), (1, 25, 80))
+            self.assertEqual(light.capabilities['query_len'], 14)
+
+            # or the first query does
+            light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port,
+                                         timeout=1, lazy=True,
+                                         persistent=persistent)
+            light.update_state()
+            self.assertEqual(light.getRgb(), (1, 25, 80))
+            self.assertEqual(light.capabilities['query_len'], 14)
+
+    def test_queue_reconnect_during_query(self):
+        import threading
+        virtual = self.sim.add_bulb()
+        policy = flux_led.RetryPolicy(backoff=0.2, jitter=0)
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     coalesce=True, retry_policy=policy)
+        light._socket.close()
+        # the send fails, and the queue reconnects after the backoff, while
+        # the query below is waiting for the queue
+        light.setRgb(1, 2, 3)
+        query = threading.Thread(target=light.update_state)
+        query.daemon = True
+        query.start()
+        query.join(3)
+        self.assertFalse(query.is_alive())
+        self.assertEqual(light.getRgb(), (1, 2, 3))
+
+    def test_batch(self):
+        virtual = self.sim.add_bulb()
+        events = []
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     persistent=True,
+                                     observer=lambda *e: events.append(e))
+        del events[:]
+        with light.batch():
+            light.setRgb(1, 25, 80, persist=False)
+            light.turnOff()
+            light.setClock()
+            self.assertEqual(events, [])
+        sends = [e[1]['bytes'] for e in events if e[0] == "send"]
+        self.assertEqual(sends, [8 + 4 + 12])
+
+        # a read sends what was batched so far, request included
+        del events[:]
+        with light.batch():
+            light.turnOn()
+            light.update_state()
+            self.assertEqual(light.is_on, True)
+            light.setPresetPattern(0x25, 50)
+        sends = [e[1]['bytes'] for e in events if e[0] == "send"]
+        self.assertEqual(sends, [4 + 4, 5])
+        light.update_state()
+        self.assertEqual(light.mode, "preset")
+        self.assertEqual(virtual.frames, 7 + 2)
+
+        with self.assertRaises(ValueError):
+            with light.batch():
+                light.turnOff()
+                raise ValueError()
+        light.update_state()
+        self.assertEqual(light.is_on, True)
+
+    def test_coalesce(self):
+        virtual = self.sim.add_bulb()
+        metrics = flux_led.BulbMetrics()
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     persistent=True, coalesce=True,
+                                     observer=metrics)
+        frames = virtual.frames
+
+        # a slow link: each send takes a while
+        send_msg = light._send_msg
+        def slow_send_msg(msg):
+            time.sleep(0.02)
+            send_msg(msg)
+        light._send_msg = slow_send_msg
+
+        start = time.time()
+        for i in range(20):
+            light.setRgb(i, 0, 0, persist=False)
+            light.turnOff()
+            light.turnOn()
+        # the calls don't wait for the sends
+        self.assertLess(time.time() - start, 0.1)
+        light.turnOff()
+        self.assertTrue(light.flush(timeout=1))
+
+        light.update_state()
+        self.assertEqual(light.getRgb(), (19, 0, 0))
+        self.assertEqual(light.is_on, False)
+        # far fewer than the 61 commands given, plus the query
+        self.assertLess(virtual.frames - frames, 10)
+        self.assertGreater(metrics.counts['coalesced'], 50)
+
+    def test_observer(self):
+        metrics = flux_led.BulbMetrics()
+        virtual = self.sim.add_bulb()
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     persistent=True, observer=metrics)
+        light.setRgb(1, 25, 80)
+        light.update_state()
+        self.assertEqual(metrics.counts['connect'], 1)
+        # probe, query, colour, query
+        self.assertEqual(metrics.counts['send'], 4)
+        self.assertEqual(metrics.bytes_out, 4 + 4 + 8 + 4)
+        # the probe reply is read in two parts
+        self.assertEqual(metrics.counts['frame'], 4)
+        self.assertEqual(metrics.bytes_in, 14 * 3)
+        self.assertEqual(metrics.counts['first_byte'], 4)
+        self.assertIsNotNone(metrics.mean_seconds('frame'))
+        self.assertNotIn('timeout', metrics.counts)
+        self.assertEqual(list(metrics.bulbs), [virtual.ipaddr])
+
+        metrics.reset()
+        virtual.faults = self.simulator.FaultProfile(loss=1)
+        light.timeout = 0.1
+        light.update_state(retry=1)
+        self.assertEqual(metrics.counts['timeout'], 2)
+        self.assertEqual(metrics.counts['retry'], 1)
+        self.assertEqual(metrics.bytes_in, 0)
+
+        events = []
+        scanner = flux_led.BulbScanner(observer=lambda *e: events.append(e))
+        scanner.sweep('127.0.0.1/32', timeout=1, count=1,
+                      port=self.sim.discovery_port)
+        self.assertEqual([e[0] for e in events],
+                         ['discovery_probe', 'discovery_reply'])
+        self.assertEqual(events[1][1]['id'], virtual.id)
+
+
+    def test_observer_set_during_connect(self):
+        metrics = flux_led.BulbMetrics()
+        virtual = self.sim.add_bulb()
+        light = flux_led.WifiLedBulb(virtual.ipaddr, virtual.port, timeout=1,
+                                     persistent=True, lazy=True)
+
+        def attach(bulb, sock):
+            bulb.observer = metrics
+        with patch.object(flux_led.WifiLedBulb, '_set_keepalive', attach):
+            light.connect()
+        self.assertTrue(light._connected)
+        light.update_state()
+        self.assertGreater(metrics.counts['frame'], 0)
+
+
+class TestReactor(unittest.TestCase):
+    def setUp(self):
+        from flux_led import reactor, simulator
+        self.simulator = simulator
+        self.sim = simulator.BulbSimulator()
+        self.sim.start()
+        self.ReactorBulb = reactor.ReactorBulb
+        self.reactor = reactor.Reactor()
+
+    def tearDown(self):
+        self.reactor.close()
+        self.sim.stop()
+
+    def test_commands(self):
+        self.sim.add_bulbs(3)
+        self.sim.add_bulb(self.simulator.DEVICE_ORIGINAL)
+        lights = [self.ReactorBulb(virtual.ipaddr, virtual.port, timeout=0.2,
+                                   reactor=self.reactor)
+                  for virtual in self.sim.bulbs]
+        states = [f.result(5) for f in [l.update_state() for l in lights]]
+        self.assertTrue(all(states))
+        self.assertEqual(lights[3].protocol, 'LEDENET_ORIGINAL')
+
+        futures = [l.setRgb(1, 25, 80, persist=False) for l in lights]
+        futures += [l.turnOff() for l in lights]
+        futures += [l.update_state() for l in lights]
+        for future in futures:
+            future.result(5)
+        for light in lights:
+            self.assertEqual(light.getRgb(), (1, 25, 80))
+            self.assertEqual(light.is_on, False)
+        self.assertEqual(len(lights[0].getTimers().result(5)), 6)
+        self.assertIsNotNone(lights[0].getClock().result(5))
+
+        lights[0].setCustomPattern([(255, 0, 0), (0, 0, 255)], 50,
+                                   "jump").result(5)
+        lights[0].update_state().result(5)
+        self.assertEqual(lights[0].mode, "custom")
+        self.assertIsNone(lights[0].setCustomPattern([], 50, "jump").result(5))
+        rx = lights[0].query_state().result(5)
+        self.assertEqual((rx[0], len(rx)), (0x81, 14))
+        rx = lights[3].query_state().result(5)
+        self.assertEqual((rx[0], len(rx)), (0x66, 11))
+        # nothing of WifiLedBulb that would block
+        for name in ('transition', 'batch', 'submit_turnOn', '_write'):
+            self.assertFalse(hasattr(lights[0], name))
+
+    def test_send_frame(self):
+        from flux_led import effects
+        lights = [self.ReactorBulb(virtual.ipaddr, virtual.port, timeout=0.2,
+                                   reactor=self.reactor)
+                  for virtual in self.sim.add_bulbs(3)]
+        frame = [(10, 20, 30), (40, 50, 60), (70, 80, 90)]
+        results = effects.send_frame(lights, frame)
+        self.assertTrue(all(result.ok for result in results))
+        for light, color in zip(lights, frame):
+            light.update_state().result(5)
+            self.assertEqual(light.getRgb(), color)
+
+        # nothing listens on the second bulb's new port
+        unused = socket.socket()
+        unused.bind((lights[1].ipaddr, 0))
+        lights[1].port = unused.getsockname()[1]
+        unused.close()
+        lights[1].close().result(5)
+        results = effects.send_frame(lights, frame)
+        self.assertEqual([result.ok for result in results],
+                         [True, False, True])
+
+    def test_unreachable(self):
+        virtual = self.sim.add_bulb(
+            faults=self.simulator.FaultProfile(refuse=1))
+        light = self.ReactorBulb(virtual.ipaddr, virtual.port, timeout=0.2,
+                                 reactor=self.reactor)
+        self.assertIsNone(light.update_state(retry=0).result(5))
+        self.assertEqual(light.is_on, False)
+        with self.assertRaises(socket.error):
+            light.setRgb(1, 2, 3).result(5)
+
+        pending = light.update_state()
+        self.reactor.close()
+        self.assertTrue(pending.done())
+
+    def test_retry_keeps_message(self):
+        first, second = self.sim.add_bulbs(2)
+        # nothing listens on the port until the retry
+        unused = socket.socket()
+        unused.bind((first.ipaddr, 0))
+        closed_port = unused.getsockname()[1]
+        unused.close()
+        capabilities = {'protocol': None, 'rgbwcapable': False,
+                        'rgbwprotocol': False, 'use_csum': True,
+                        'query_len': 14}
+        policy = flux_led.RetryPolicy(retries=1, backoff=0.3, jitter=0)
+        light = self.ReactorBulb(first.ipaddr, closed_port, timeout=0.2,
+                                 capabilities=capabilities,
+                                 reactor=self.reactor, retry_policy=policy)
+        other = self.ReactorBulb(second.ipaddr, second.port, timeout=0.2,
+                                 capabilities=capabilities,
+                                 reactor=self.reactor)
+        pending = light.setRgb(10, 20, 30)
+        # sent while the first bulb waits to retry
+        other.setRgb(200, 100, 50).result(5)
+        light.port = first.port
+        pending.result(5)
+        light.update_state().result(5)
+        self.assertEqual(light.getRgb(), (10, 20, 30))
+
+
+class TestEffects(unittest.TestCase):
+    CAPABILITIES = [
+        {'protocol': None, 'rgbwcapable': True, 'rgbwprotocol': True,
+         'use_csum': True, 'query_len': 14},
+        {'protocol': None, 'rgbwcapable': False, 'rgbwprotocol': False,
+         'use_csum': True, 'query_len': 14},
+        {'protocol': 'LEDENET', 'rgbwcapable': True, 'rgbwprotocol': False,
+         'use_csum': True, 'query_len': 14},
+        {'protocol': 'LEDENET_ORIGINAL', 'rgbwcapable': False,
+         'rgbwprotocol': False, 'use_csum': False, 'query_len': 11},
+    ]
+
+    def setUp(self):
+        self.effects = effects
+        self.bulbs = [flux_led.WifiLedBulb("192.168.1.164", lazy=True,
+                                           capabilities=capabilities)
+                      for capabilities in self.CAPABILITIES]
+
+    @staticmethod
+    def rows(frame):
+        return [tuple(int(level) for level in row) for row in frame]
+
+    def test_colors(self):
+        self.assertEqual(self.rows(self.effects.rainbow(3)),
+                         [(255, 0, 0), (0, 255, 0), (0, 0, 255)])
+        self.assertEqual(self.rows(self.effects.gradient(3, (0, 0, 0), (200, 100, 0))),
+                         [(0, 0, 0), (100, 50, 0), (200, 100, 0)])
+        self.assertEqual(self.rows(self.effects.breathe([(200, 100, 0)], 0.5, low=0.5)),
+                         [(100, 50, 0)])
+        colors = [(10, 20, 30), (255, 128, 0), (0, 0, 0)]
+        expected = [tuple(int(level) for level in
+                          self.bulbs[0]._calculateBrightness(color, 77))
+                    for color in colors]
+        self.assertEqual(self.rows(self.effects.scale_brightness(colors, 77)),
+                         expected)
+
+    def test_encode_frame(self):
+        frame = self.effects.rainbow(len(self.bulbs), offset=0.1)
+        for persist in (True, False):
+            expected = [bulb._rgbw_msg(*color, persist=persist)
+                        for bulb, color in zip(self.bulbs, self.rows(frame))]
+            self.assertEqual(self.effects.encode_frame(self.bulbs, frame, persist),
+                             expected)
+
+    @unittest.skipUnless(effects.numpy_available, "numpy is not installed")
+    def test_numpy_encode_frame(self):
+        import numpy
+        colors = [(1, 2, 3), (250, 128, 0), (0, 0, 255), (17, 34, 51)]
+        for frame in (colors, numpy.array(colors, dtype=numpy.uint8)):
+            self.assertEqual(self.effects.encode_frame(self.bulbs, frame), [
+                bytearray(b'\x41\x01\x02\x03\x00\x00\x0f'),
+                bytearray(b'\x41\xfa\x80\x00\x00\xf0\x0f'),
+                bytearray(b'\x41\x00\x00\xff\x00\x00\xf0\x0f'),
+                bytearray(b'\x56\x11\x22\x33\xaa'),
+            ])
+            for persist in (True, False):
+                self.assertEqual(
+                    self.effects.encode_frame(self.bulbs, frame, persist),
+                    [bulb._rgbw_msg(*color, persist=persist)
+                     for bulb, color in zip(self.bulbs, colors)])
+
+    @unittest.skipUnless(effects.numpy_available, "numpy is not installed")
+    def test_numpy_matches_python(self):
+        colors = [(i * 7 % 256, i * 13 % 256, i * 29 % 256) for i in range(100)]
+        bulbs = self.bulbs * 25
+        calls = [
+            lambda: self.effects.rainbow(100, 0.3),
+            lambda: self.effects.gradient(100, (255, 0, 10), (0, 100, 255), 'ease_in'),
+            lambda: self.effects.scale_brightness(colors, list(range(100))),
+            lambda: self.effects.breathe(colors, [i / 100.0 for i in range(100)]),
+            lambda: self.effects.blend(colors, colors[::-1], 0.37),
+            lambda: self.effects.encode_frame(bulbs, colors),
+        ]
+        for call in calls:
+            with patch.object(self.effects, 'numpy_available', False):
+                expected = call()
+            self.assertEqual(self.rows(call()), self.rows(expected))
+
+    def test_send_frame(self):
+        from flux_led import simulator
+        with simulator.BulbSimulator() as sim:
+            lights = [flux_led.WifiLedBulb(v.ipaddr, v.port, timeout=1,
+                                           persistent=True)
+                      for v in sim.add_bulbs(3)]
+            frame = self.effects.rainbow(3)
+            results = self.effects.send_frame(lights, frame)
+            self.assertTrue(all(result.ok for result in results))
+            for light, color in zip(lights, self.rows(frame)):
+                light.update_state()
+                self.assertEqual(light.getRgb(), color)
+            self.assertEqual(sum(v.persistent_writes for v in sim.bulbs), 0)